@@ -0,0 +1,65 @@
+import json, os, threading, time
+
+from django.core.management.base import BaseCommand
+
+from main.utils.exiftool_ctxmngr import read_response
+
+
+class Command(BaseCommand):
+    help = "Replays a recorded exiftool response through a pipe, and compares how long the old and the new reader take to read it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--response", help="file with recorded exiftool output (e.g. of exiftool -G1 -j -n <dir>), without sentinel")
+        parser.add_argument("--size-mb", type=int, default=50, help="size of the generated response, when no --response is given")
+
+    def handle(self, *args, **options):
+        if options["response"]:
+            with open(options["response"], "rb") as f:
+                response = f.read()
+        else:
+            response = self._generate(options["size_mb"] * 1024 * 1024)
+        self.stdout.write(f"Response of {len(response) / 1024 / 1024:.1f} MB")
+
+        sentinel = b"{ready1}\n"
+        old = self._replay(response + sentinel, b"", lambda out, err: self._read_old(out, sentinel))
+        new = self._replay(response + sentinel, sentinel, lambda out, err: read_response(out, err, sentinel, sentinel)[0])
+        self.stdout.write(f"old reader: {old:8.2f}s")
+        self.stdout.write(f"new reader: {new:8.2f}s")
+
+    def _generate(self, size):
+        record = json.dumps({"SourceFile": "/photos/2021/01/DSCF0001.JPG", "ExifTool:ExifToolVersion": 12.4,
+            "IFD0:Make": "FUJIFILM", "IFD0:Model": "X-T20", "ExifIFD:DateTimeOriginal": "2021:01:16 10:00:00",
+            "XMP-digiKam:TagsList": ["Places/Belgium/Ghent", "Categories/Family"], "GPS:GPSLatitude": 51.0583333,
+            "GPS:GPSLongitude": 3.7166667}, indent=2).encode("utf-8")
+        count = size // (len(record) + 2) + 1
+        return b"[" + b",\n".join([record] * count) + b"]\n"
+
+    def _replay(self, stdout, stderr, reader):
+        """ Writes the response to pipes from another thread, like exiftool would, and times the reader. """
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+
+        def write(fd, data):
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        writers = [threading.Thread(target=write, args=(out_w, stdout)), threading.Thread(target=write, args=(err_w, stderr))]
+        for w in writers:
+            w.start()
+        start = time.perf_counter()
+        output = reader(out_r, err_r)
+        duration = time.perf_counter() - start
+        for w in writers:
+            w.join()
+        os.close(out_r)
+        os.close(err_r)
+        if len(output) != len(stdout) - len(b"{ready1}\n"):
+            raise ValueError("reader returned the wrong output")
+        return duration
+
+    def _read_old(self, fd, sentinel):
+        """ The reader ExifTool.execute used before: appends 4 KB reads to an immutable bytes object. """
+        output = b""
+        while not output.endswith(sentinel):
+            blk = os.read(fd, 4096)
+            output += blk
+        return output[: -len(sentinel)]
@@ -0,0 +1,54 @@
+import os, time
+
+from io import BytesIO
+from PIL import Image as PIL_Image
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.model.preview import encode, quality_for, render_preview
+from main.model.thumbnail import ImageThumbnailCreator
+from main.services import PreviewService
+
+
+class Command(BaseCommand):
+    help = "Reports how many bytes browsing a directory takes per image format: its thumbnails, and a preview in the " \
+        "viewer per image. 'before' is JPEG at the default quality, as it was before IMAGE_QUALITY."
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="directory with sample JPEG files")
+        parser.add_argument("--limit", type=int, default=50, help="maximum number of files to use")
+        parser.add_argument("--maxw", type=int, default=1920, help="width of the viewer")
+        parser.add_argument("--maxh", type=int, default=1080, help="height of the viewer")
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options["directory"])
+        paths = sorted(e.path for e in os.scandir(directory) if e.is_file() and ImageThumbnailCreator().can_thumbnail(os.path.splitext(e.name)[1]))[:options["limit"]]
+        if not paths:
+            self.stderr.write(f"No JPEG files found in {directory}")
+            return
+
+        qualities = getattr(settings, 'IMAGE_QUALITY', None)
+        mode = getattr(settings, 'THUMBNAIL_MODE', 'fast')
+        thumbnails = [ImageThumbnailCreator(mode, qualities).create_thumbnail(path, 300, 200).getvalue() for path in paths]
+        before_thumbnails = [ImageThumbnailCreator(mode).create_thumbnail(path, 300, 200).getvalue() for path in paths]
+        self.stdout.write(f"{len(paths)} images, previews of {options['maxw']}x{options['maxh']}")
+
+        rows = [("before", None, 'JPEG', before_thumbnails), ("JPEG", qualities, 'JPEG', thumbnails)]
+        rows = rows + [(format, qualities, format, None) for format in PreviewService.instance().formats]
+        reference = None
+        for name, row_qualities, format, row_thumbnails in rows:
+            if row_thumbnails is None:
+                # like the ThumbnailService: from the JPEG thumbnail
+                row_thumbnails = []
+                for data in thumbnails:
+                    thumbnail = PIL_Image.open(BytesIO(data))
+                    row_thumbnails.append(encode(thumbnail, format, quality_for(row_qualities, format, thumbnail.size)))
+            start = time.perf_counter()
+            previews = [render_preview(path, options["maxw"], options["maxh"], format, row_qualities) for path in paths]
+            elapsed = time.perf_counter() - start
+            total = sum(len(t) for t in row_thumbnails) + sum(len(p) for p in previews)
+            reference = reference or total
+            self.stdout.write(f"{name:7} thumbnails {sum(len(t) for t in row_thumbnails) / len(paths) / 1024:6.1f} KB, "
+                f"previews {sum(len(p) for p in previews) / len(paths) / 1024:7.1f} KB per image, "
+                f"{total / 1024 / 1024:7.2f} MB in total ({100 * total / reference:3.0f}%), preview {1000 * elapsed / len(paths):6.1f} ms/image")
@@ -0,0 +1,53 @@
+import os, time
+
+from django.core.management.base import BaseCommand
+
+from main.model.jpeg_metadata import JpegMetadataReader
+from main.services import ExifToolService
+
+
+class Command(BaseCommand):
+    help = "Checks that the native JPEG metadata reader gives the same values as exiftool, and compares their speed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="directory with sample JPEG files")
+        parser.add_argument("--limit", type=int, default=1000, help="maximum number of files to use")
+
+    def handle(self, *args, **options):
+        reader = JpegMetadataReader()
+        directory = os.path.abspath(options["directory"])
+        paths = sorted(e.path for e in os.scandir(directory) if e.is_file() and reader.can_read(os.path.splitext(e.name)[1]))[:options["limit"]]
+        if not paths:
+            self.stderr.write(f"No JPEG files found in {directory}")
+            return
+
+        start = time.perf_counter()
+        native = [reader.read(path) for path in paths]
+        native_time = time.perf_counter() - start
+
+        pool = ExifToolService.instance().pool
+        with pool.lease() as et:
+            et.execute("-ver") # don't measure the startup of exiftool, the pool keeps it running
+            start = time.perf_counter()
+            exiftool = et.get_metadata(*paths)
+            exiftool_time = time.perf_counter() - start
+
+        fallbacks = 0
+        mismatches = 0
+        for path, n, e in zip(paths, native, exiftool):
+            if n is None:
+                fallbacks = fallbacks + 1
+                continue
+            for key, value in n.items():
+                if key != "SourceFile" and not self._same(value, e.get(key)):
+                    mismatches = mismatches + 1
+                    self.stdout.write(f"{os.path.basename(path)}: {key} is {value!r} natively, {e.get(key)!r} with exiftool")
+
+        self.stdout.write(f"{len(paths)} files, {fallbacks} not readable natively, {mismatches} mismatching values")
+        self.stdout.write(f"native:   {len(paths) / native_time:10.1f} files/s")
+        self.stdout.write(f"exiftool: {len(paths) / exiftool_time:10.1f} files/s")
+
+    def _same(self, a, b):
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            return abs(a - b) < 1e-6
+        return a == b
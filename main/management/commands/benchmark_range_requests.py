@@ -0,0 +1,87 @@
+import os, random, time
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from main.views.image import file_response
+
+
+class Command(BaseCommand):
+    help = "Compares how fast videos are served when scrubbing (seeking to random places) and when playing them from " \
+        "start to end, with the Range handling of ImageDownloadView as it was and as it is now. The responses are read " \
+        "in-process, so this measures what the view copies itself, not what sendfile saves on top of that."
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="a (big) video file")
+        parser.add_argument("--seeks", type=int, default=50, help="number of seeks to simulate")
+        parser.add_argument("--read", type=float, default=2, help="MB the player reads after every seek, before it seeks again")
+        parser.add_argument("--play", type=float, default=512, help="MB to play from the start of the file")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        path = os.path.abspath(options["file"])
+        size = os.path.getsize(path)
+        read = int(options["read"] * 1024 * 1024)
+        play = min(size, int(options["play"] * 1024 * 1024))
+        positions = random.Random(options["seed"]).sample(range(max(1, size - read)), options["seeks"])
+        self.stdout.write(f"{path}: {size / 1024 / 1024:.0f} MB, {len(positions)} seeks reading {read / 1024 / 1024:.1f} MB, playing {play / 1024 / 1024:.0f} MB")
+
+        for name, view in [("before", self._legacy_response), ("now", file_response)]:
+            start = time.perf_counter()
+            first_bytes = []
+            for position in positions:
+                self._read(view, path, f"bytes={position}-", read, first_bytes)
+            scrub = time.perf_counter() - start
+
+            start = time.perf_counter()
+            position = 0
+            requests = 0
+            while position < play:
+                # like a browser: ask for the rest of the file, and ask again from where the response ended
+                position = position + self._read(view, path, f"bytes={position}-", play - position, [])
+                requests = requests + 1
+            playing = time.perf_counter() - start
+            self.stdout.write(f"{name:7} scrub: {1000 * scrub / len(positions):7.1f} ms/seek, first byte after {1000 * sum(first_bytes) / len(first_bytes):6.1f} ms"
+                f" | play: {play / 1024 / 1024 / playing:7.0f} MB/s in {requests} requests")
+
+    def _read(self, view, path, http_range, limit, first_bytes) -> int:
+        """ Reads up to limit bytes of the response to a request with this range, like a player that stops reading
+        when it seeks elsewhere. Returns how many it read. """
+        start = time.perf_counter()
+        response = view(RequestFactory().get("/", HTTP_RANGE=http_range), path, "video/mp4")
+        content = iter(response.streaming_content) if response.streaming else iter([response.content])
+        count = 0
+        for chunk in content:
+            if count == 0:
+                first_bytes.append(time.perf_counter() - start)
+            count = count + len(chunk)
+            if count >= limit:
+                break
+        response.close()
+        return min(count, limit)
+
+    def _legacy_response(self, request, path, content_type):
+        """ The Range branch of ImageDownloadView before it used file_response """
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            file_length = stat.st_size
+            start, end = request.META['HTTP_RANGE'].split('=')[1].split('-')
+            if not start:
+                start = max(0, file_length - int(end))
+                end = ''
+            start, end = int(start), int(end or file_length - 1)
+            start = max(0, start)
+            end = min(end, file_length - 1, start + 5000000)
+            f.seek(start)
+            response = HttpResponse(content_type=content_type)
+            response.status_code = 206
+            response['Accept-Ranges'] = 'bytes'
+            response['Content-Length'] = end + 1 - start
+            response['Content-Range'] = f"bytes {start}-{end}/{file_length}"
+            c = start
+            while c < end:
+                buf = f.read(min(1024, end - c + 1))
+                c += len(buf)
+                response.write(buf)
+            return response
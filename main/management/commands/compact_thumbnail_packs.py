@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Directory
+
+
+class Command(BaseCommand):
+    help = "Rewrites the thumbnail packs without the thumbnails that are no longer used"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="also the packs that do not waste THUMBNAIL_PACK_COMPACT_RATIO yet")
+
+    def handle(self, *args, **options):
+        compacted = sum(1 for directory in Directory.objects.all() if directory.compact_thumbnail_pack(options["force"]))
+        self.stdout.write(f"Compacted {compacted} thumbnail packs")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from main.models import MetadataReparseService
+
+
+class Command(BaseCommand):
+    help = "Re-parses the metadata of all images from the raw metadata kept in the DB, without reading the files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="number of images to update per transaction")
+        parser.add_argument("--discard-edits", action="store_true", help="also re-parse images with edits that were not written to their file yet, losing those edits")
+
+    def handle(self, *args, **options):
+        reparsed, skipped = MetadataReparseService.instance().reparse(options["batch_size"], self._progress, options["discard_edits"])
+        self.stdout.write(f"\nRe-parsed {reparsed} images, skipped {skipped} of which the file changed or the raw metadata is missing (rescan those)"
+            f"{'' if options['discard_edits'] else ', or that have unwritten edits (write those first, or use --discard-edits)'}")
+
+    def _progress(self, reparsed, skipped):
+        self.stdout.write(f"{reparsed} re-parsed, {skipped} skipped", ending="\r")
+        self.stdout.flush()
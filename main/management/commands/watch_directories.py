@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from main.models import DirectoryWatcherService
+
+
+class Command(BaseCommand):
+    help = "Watches all directories in the DB and scans new and changed files as they come in (Linux only)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--debounce", type=float, help="seconds without events before a directory is scanned")
+
+    def handle(self, *args, **options):
+        watcher = DirectoryWatcherService(options["debounce"])
+        self.stdout.write("Watching directories, press Ctrl+C to stop")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
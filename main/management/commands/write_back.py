@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from main.models import WriteBackService
+
+
+class Command(BaseCommand):
+    help = "Writes the metadata of edited images back to their files as they come in (needs METADATA_WRITE_BACK)"
+
+    def handle(self, *args, **options):
+        service = WriteBackService.instance()
+        if not service.enabled:
+            self.stderr.write("METADATA_WRITE_BACK is off")
+            return
+        self.stdout.write("Writing back metadata, press Ctrl+C to stop")
+        try:
+            service.run()
+        except KeyboardInterrupt:
+            pass
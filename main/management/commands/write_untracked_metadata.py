@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Directory, MetadataWriteError
+
+
+class Command(BaseCommand):
+    help = ("Writes the metadata of the images that were not read from or written to their files since edits are tracked, "
+        "so edits made before that are not lost. Only needed once, after upgrading.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="only show which images would be written")
+
+    def handle(self, *args, **options):
+        written = failed = 0
+        for directory in Directory.objects.filter(images__metadata_hashes__isnull=True).distinct():
+            images = list(directory.images.filter(metadata_hashes__isnull=True).select_related('author').prefetch_related('tags', 'attachments'))
+            for img in images:
+                if img.errors:
+                    self.stderr.write(f"Skipping {directory.get_absolute_path()}/{img.name}: {', '.join(img.errors)}")
+            images = [img for img in images if not img.errors]
+            if options["dry_run"]:
+                for entry in directory.write_metadata_of(images, dry_run=True):
+                    self.stdout.write(f"{directory.get_absolute_path()}/{entry['image']}: {', '.join(entry['files'])}")
+                    written += 1
+                continue
+            try:
+                written += len(directory.write_metadata_of(images))
+            except MetadataWriteError as exc:
+                self.stderr.write(str(exc))
+                failed += len(exc.failed)
+        self.stdout.write(f"{'Would write' if options['dry_run'] else 'Wrote'} the metadata of {written} images, {failed} files failed")
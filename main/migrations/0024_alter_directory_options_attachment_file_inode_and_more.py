@@ -0,0 +1,47 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0023_stringsetting_alter_image_options'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='directory',
+            options={'ordering': ['path']},
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='file_inode',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='file_mtime_ns',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='file_size',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='file_inode',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='file_mtime_ns',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='file_size',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0024_alter_directory_options_attachment_file_inode_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reload_metadata', models.BooleanField(default=False)),
+                ('status', models.CharField(default='queued', max_length=10)),
+                ('cancel_requested', models.BooleanField(default=False)),
+                ('error', models.TextField(null=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('dirs_found', models.IntegerField(default=0)),
+                ('dirs_done', models.IntegerField(default=0)),
+                ('files_found', models.IntegerField(default=0)),
+                ('files_processed', models.IntegerField(default=0)),
+                ('files_processed_at_start', models.IntegerField(default=0)),
+                ('completed_dirs', models.ManyToManyField(related_name='+', to='main.directory')),
+                ('directory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scan_jobs', to='main.directory')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0025_scanjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RawMetadata',
+            fields=[
+                ('file_size', models.BigIntegerField(null=True)),
+                ('file_mtime_ns', models.BigIntegerField(null=True)),
+                ('file_inode', models.BigIntegerField(null=True)),
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='raw_metadata', serialize=False, to='main.image')),
+                ('data', models.BinaryField()),
+                ('complete', models.BooleanField(default=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0026_rawmetadata'),
+    ]
+
+    operations = [
+        # existing images are not marked as edited, manage.py write_untracked_metadata writes them if needed
+        migrations.AddField(
+            model_name='image',
+            name='metadata_dirty',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='metadata_hashes',
+            field=models.JSONField(null=True),
+        ),
+    ]
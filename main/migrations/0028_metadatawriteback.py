@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0027_image_metadata_dirty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetadataWriteBack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(default='pending', max_length=10)),
+                ('due', models.DateTimeField()),
+                ('version', models.IntegerField(default=0)),
+                ('error', models.TextField(null=True)),
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='write_back', to='main.image')),
+            ],
+            options={
+                'ordering': ['due'],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:05
+
+from django.db import migrations, models
+
+
+def mark_existing_thumbnails_ready(apps, schema_editor):
+    # they were written when the images were scanned
+    Image = apps.get_model('main', 'Image')
+    Image.objects.exclude(thumbnail='').exclude(thumbnail=None).update(thumbnail_state='ready')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0028_metadatawriteback'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail_state',
+            field=models.CharField(default='missing', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail_updated',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(mark_existing_thumbnails_ready, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0029_image_thumbnail_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail_length',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail_offset',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
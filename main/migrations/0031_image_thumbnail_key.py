@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0030_image_thumbnail_pack'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail_key',
+            field=models.CharField(max_length=32, null=True),
+        ),
+    ]
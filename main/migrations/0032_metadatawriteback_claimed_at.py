@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 05:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0031_image_thumbnail_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metadatawriteback',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+import os
+
+from typing import Iterable
+
+
+class AttachmentMatcher:
+    """ Finds the image a file in the same directory belongs to. IMG_1.RAF, IMG_1.xmp, IMG_1.JPG.xmp, IMG_1.RAF.xmp
+    (sidecars) and IMG_1.JPG_original (backup made by exiftool) all belong to IMG_1.JPG. Lookups are done in a dict on the stem, so
+    matching a whole directory is linear instead of quadratic. """
+
+    def __init__(self, images: Iterable, existing_attachment_names: Iterable[str] = ()):
+        self.images_by_name = {}
+        self.images_by_stem = {}
+        for img in images:
+            self.images_by_name[img.name] = img
+            # if multiple images have the same stem, the first one wins
+            self.images_by_stem.setdefault(os.path.splitext(img.name)[0], img)
+        self.existing_attachment_names = set(existing_attachment_names)
+
+    def find_related_image(self, name: str):
+        for suffix in [".xmp", ".XMP", "_original"]:
+            if name.endswith(suffix) and name[:-len(suffix)] in self.images_by_name:
+                return self.images_by_name[name[:-len(suffix)]]
+        stem = os.path.splitext(name)[0]
+        if stem not in self.images_by_stem and name.casefold().endswith(".xmp"):
+            # sidecar of an attachment, e.g. IMG_1.RAF.xmp
+            stem = os.path.splitext(stem)[0]
+        return self.images_by_stem.get(stem)
+
+    def is_known(self, name: str) -> bool:
+        return name in self.existing_attachment_names
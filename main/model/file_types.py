@@ -1,5 +1,6 @@
 import os
 from enum import Enum
+from typing import List
 
 class FileType(Enum):
     MAIN_MEDIA = 1
@@ -14,5 +15,13 @@ class FileType(Enum):
             return FileType.MAIN_MEDIA
         if ext.casefold() in [".raf", ".orf", ".cr2"]:
             return FileType.RAW
+        if ext.casefold() == ".xmp":
+            return FileType.SIDECAR
         else:
-            return FileType.UNKNOWN
\ No newline at end of file
+            return FileType.UNKNOWN
+
+
+def sidecar_names(name: str) -> List[str]:
+    """ The names an XMP sidecar of the given file can have, in order of preference: IMG_1.MOV.xmp or IMG_1.xmp. """
+    stem = os.path.splitext(name)[0]
+    return [f"{name}.xmp", f"{name}.XMP", f"{stem}.xmp", f"{stem}.XMP"]
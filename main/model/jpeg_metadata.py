@@ -0,0 +1,197 @@
+import logging
+import os
+import struct
+
+from datetime import datetime
+from main.utils.exifdata import format_file_modify_date
+
+import xml.etree.ElementTree as ET
+
+
+class JpegMetadataReader:
+    """ Reads the EXIF and XMP segments at the start of a JPEG file without starting exiftool. It returns the same keys
+    as `exiftool -use MWG -G1 -j -n` for the tags our metadata parsers use, so it can only be used to scan, not to show
+    all metadata. Returns None for anything it cannot decode, the caller should fall back to exiftool then. """
+    logger = logging.getLogger(__name__)
+
+    EXIF_HEADER = b"Exif\0\0"
+    XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\0"
+
+    # tag id -> exiftool name, per IFD
+    IFD0_TAGS = {0x010F: "IFD0:Make", 0x0110: "IFD0:Model", 0x0112: "IFD0:Orientation", 0x0132: "IFD0:ModifyDate",
+        0x013B: "IFD0:Artist", 0x4746: "IFD0:Rating"}
+    EXIF_TAGS = {0x829A: "ExifIFD:ExposureTime", 0x9003: "ExifIFD:DateTimeOriginal", 0x9004: "ExifIFD:CreateDate",
+        0x9010: "ExifIFD:OffsetTime", 0x9011: "ExifIFD:OffsetTimeOriginal", 0x9291: "ExifIFD:SubSecTimeOriginal",
+        0xA431: "ExifIFD:SerialNumber"}
+    GPS_TAGS = {0x0001: "GPS:GPSLatitudeRef", 0x0002: "GPS:GPSLatitude", 0x0003: "GPS:GPSLongitudeRef",
+        0x0004: "GPS:GPSLongitude", 0x0005: "GPS:GPSAltitudeRef", 0x0006: "GPS:GPSAltitude"}
+    EXIF_IFD_POINTER = 0x8769
+    GPS_IFD_POINTER = 0x8825
+    # size in bytes of the TIFF value types we can decode
+    TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+    XMP_NAMESPACES = {
+        "http://www.digikam.org/ns/1.0/": "XMP-digiKam",
+        "http://ns.adobe.com/lightroom/1.0/": "XMP-lr",
+        "http://ns.adobe.com/xap/1.0/": "XMP-xmp",
+        "http://purl.org/dc/elements/1.1/": "XMP-dc",
+        "http://ns.adobe.com/xap/1.0/mm/": "XMP-xmpMM",
+        "http://ns.adobe.com/photoshop/1.0/": "XMP-photoshop",
+    }
+    RDF = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+
+    def can_read(self, extension: str) -> bool:
+        return extension.casefold() in [".jpeg", ".jpg"]
+
+    def read(self, path: str) -> dict:
+        try:
+            exif, xmp = self._read_segments(path)
+            stat = os.stat(path)
+            result = {
+                "SourceFile": path,
+                "System:FileName": os.path.basename(path),
+                "System:FileModifyDate": format_file_modify_date(datetime.fromtimestamp(stat.st_mtime).astimezone()),
+                "File:FileType": "JPEG",
+            }
+            if exif is not None:
+                result.update(self._parse_exif(exif))
+            if xmp is not None:
+                result.update(self._parse_xmp(xmp))
+            result.update(self._mwg_composites(result))
+            return result
+        except Exception as exc:
+            self.logger.info("Cannot read %s natively, falling back to exiftool: %r", path, exc)
+            return None
+
+    def _read_segments(self, path: str):
+        """ Walks the JPEG markers up to the start of the image data, only reading the APP1 segments we need. """
+        exif = None
+        xmp = None
+        with open(path, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                raise ValueError("not a JPEG file")
+            while True:
+                marker, length = struct.unpack(">HH", f.read(4))
+                if marker & 0xFF00 != 0xFF00 or marker == 0xFFDA:  # start of scan: no more metadata
+                    break
+                if marker == 0xFFE1:
+                    data = f.read(length - 2)
+                    if exif is None and data.startswith(self.EXIF_HEADER):
+                        exif = data[len(self.EXIF_HEADER):]
+                    elif xmp is None and data.startswith(self.XMP_HEADER):
+                        xmp = data[len(self.XMP_HEADER):]
+                else:
+                    f.seek(length - 2, os.SEEK_CUR)
+        return exif, xmp
+
+    def _parse_exif(self, tiff: bytes) -> dict:
+        endian = {b"II": "<", b"MM": ">"}[tiff[0:2]]
+        ifd0_offset = struct.unpack(endian + "I", tiff[4:8])[0]
+        result = {}
+        ifd0 = self._read_ifd(tiff, endian, ifd0_offset)
+        self._add_tags(result, ifd0, self.IFD0_TAGS)
+        if self.EXIF_IFD_POINTER in ifd0:
+            self._add_tags(result, self._read_ifd(tiff, endian, ifd0[self.EXIF_IFD_POINTER]), self.EXIF_TAGS)
+        if self.GPS_IFD_POINTER in ifd0:
+            gps = self._read_ifd(tiff, endian, ifd0[self.GPS_IFD_POINTER])
+            for tag in [0x0002, 0x0004]:
+                if tag in gps:
+                    degrees, minutes, seconds = gps[tag]
+                    gps[tag] = degrees + minutes / 60 + seconds / 3600
+            self._add_tags(result, gps, self.GPS_TAGS)
+        return result
+
+    def _add_tags(self, result: dict, ifd: dict, names: dict):
+        for tag, name in names.items():
+            if tag in ifd and ifd[tag] != "":
+                result[name] = ifd[tag]
+
+    def _read_ifd(self, tiff: bytes, endian: str, offset: int) -> dict:
+        """ Returns {tag id: value}, with numbers converted like exiftool -n does. """
+        count = struct.unpack_from(endian + "H", tiff, offset)[0]
+        result = {}
+        for i in range(count):
+            tag, type_, n, value_offset = struct.unpack_from(endian + "HHI4s", tiff, offset + 2 + i * 12)
+            size = self.TYPE_SIZES.get(type_)
+            if size is None:
+                continue
+            data = value_offset if size * n <= 4 else tiff[struct.unpack(endian + "I", value_offset)[0]:][:size * n]
+            result[tag] = self._decode(endian, type_, n, data)
+        return result
+
+    def _decode(self, endian: str, type_: int, n: int, data: bytes):
+        if type_ == 2 or type_ == 7:
+            return data[:n].split(b"\0")[0].decode("utf-8", errors="replace").strip()
+        if type_ == 1:
+            values = list(data[:n])
+        elif type_ in (3, 4, 9):
+            fmt = {3: "H", 4: "I", 9: "i"}[type_]
+            values = list(struct.unpack_from(endian + fmt * n, data))
+        else:
+            fmt = "II" if type_ == 5 else "ii"
+            raw = struct.unpack_from(endian + fmt * n, data)
+            values = [self._number(raw[i] / raw[i + 1]) if raw[i + 1] else 0 for i in range(0, 2 * n, 2)]
+        return values[0] if n == 1 else values
+
+    def _number(self, value: float):
+        return int(value) if value == int(value) else value
+
+    def _parse_xmp(self, xmp: bytes) -> dict:
+        result = {}
+        root = ET.fromstring(xmp.rstrip(b"\0 \n\r\t"))
+        for description in root.iter(self.RDF + "Description"):
+            # simple properties can be written as attributes ...
+            for key, value in description.attrib.items():
+                name = self._xmp_name(key)
+                if name is not None:
+                    result[name] = self._xmp_value(value)
+            # ... or as child elements, possibly holding a Seq, Bag or Alt
+            for child in description:
+                name = self._xmp_name(child.tag)
+                if name is None:
+                    continue
+                items = [li.text or "" for li in child.iter(self.RDF + "li")]
+                if items:
+                    result[name] = self._xmp_value(items[0]) if len(items) == 1 else items
+                elif child.text and child.text.strip():
+                    result[name] = self._xmp_value(child.text.strip())
+        return result
+
+    def _xmp_name(self, key: str) -> str:
+        if not key.startswith("{"):
+            return None
+        namespace, _, local_name = key[1:].partition("}")
+        group = self.XMP_NAMESPACES.get(namespace)
+        if group is None:
+            return None
+        # exiftool uses upper camel case tag names
+        return f"{group}:{local_name[0].upper()}{local_name[1:]}"
+
+    def _xmp_value(self, value: str):
+        try:
+            return self._number(float(value)) if value.lstrip("-").replace(".", "", 1).isdigit() else value
+        except ValueError:
+            return value
+
+    def _mwg_composites(self, tags: dict) -> dict:
+        result = {}
+        if "XMP-xmp:Rating" in tags:
+            result["MWG:Rating"] = tags["XMP-xmp:Rating"]
+        elif "IFD0:Rating" in tags:
+            result["MWG:Rating"] = tags["IFD0:Rating"]
+
+        if "IFD0:Artist" in tags:
+            result["MWG:Creator"] = tags["IFD0:Artist"]
+        elif "XMP-dc:Creator" in tags:
+            result["MWG:Creator"] = tags["XMP-dc:Creator"]
+
+        if "ExifIFD:DateTimeOriginal" in tags:
+            dto = tags["ExifIFD:DateTimeOriginal"]
+            if "ExifIFD:SubSecTimeOriginal" in tags:
+                dto = f"{dto}.{tags['ExifIFD:SubSecTimeOriginal']}"
+            if "ExifIFD:OffsetTimeOriginal" in tags:
+                dto = f"{dto}{tags['ExifIFD:OffsetTimeOriginal']}"
+            result["MWG:DateTimeOriginal"] = dto
+        elif "XMP-photoshop:DateCreated" in tags:
+            result["MWG:DateTimeOriginal"] = tags["XMP-photoshop:DateCreated"].replace("-", ":", 2).replace("T", " ")
+        return result
@@ -4,9 +4,14 @@ import re
 from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
 from main.utils.exifdata import parse_exif_offsettime, parse_exif_datetimeoriginal, parse_file_filemodifytime, parse_exif_fulldatetime
-from typing import Tuple, Set
+from typing import Iterable, List, Tuple, Set
 
-@dataclass
+# e.g. VID_20210116_101500_1.mp4, the timestamp some phones put in the file name
+FILE_NAME_TIMESTAMP = re.compile(r'\w+_(\d{8}_\d{6})[_\.].+')
+
+
+# slots: a scan or re-parse holds one of these per image, so they should be small
+@dataclass(slots=True)
 class Metadata:
     date_time_original: datetime
     rating: int
@@ -23,6 +28,14 @@ class Metadata:
     original_file_name: str
 
 
+def merge_sidecar(json: dict, sidecar: dict) -> dict:
+    """ The metadata of a file with the metadata of its XMP sidecar laid over it. The sidecar wins: when a file type is
+    written to a sidecar, that is where the latest metadata is. """
+    merged = dict(json)
+    merged.update({key: value for key, value in sidecar.items() if key.split(":")[0] not in ("SourceFile", "System", "File", "ExifTool")})
+    return merged
+
+
 class MetadataParser:
     def can_parse(self, json: dict) -> bool:
         raise NotImplementedError
@@ -30,6 +43,10 @@ class MetadataParser:
     def parse(self, json: dict) -> Metadata:
         raise NotImplementedError
 
+    def parse_many(self, records: Iterable[dict]) -> List[Metadata]:
+        parse = self.parse
+        return [parse(json) for json in records]
+
 
 class AuthorMixin:
     def parse_author(self, json: dict) -> str:
@@ -91,7 +108,7 @@ class TagsListMixin:
         tags = []
         if "XMP-lr:HierarchicalSubject" in json:
             tag_val = json["XMP-lr:HierarchicalSubject"]
-            self.logger.info(f'There is a value for XMP-lr:HierarchicalSubject: {tag_val}')
+            self.logger.info('There is a value for XMP-lr:HierarchicalSubject: %s', tag_val)
             lr_tags = tag_val.split(",") if isinstance(tag_val, str) else tag_val
             lr_tags = map(lambda s: s.strip(), lr_tags)
             lr_tags = map(lambda s: s.replace('|', '/'), lr_tags)
@@ -99,21 +116,22 @@ class TagsListMixin:
 
         if "XMP-digiKam:TagsList" in json:
             tag_val = json["XMP-digiKam:TagsList"]
-            self.logger.info(f'There is a value for XMP-digiKam:TagsList: {tag_val}')
+            self.logger.info('There is a value for XMP-digiKam:TagsList: %s', tag_val)
             dk_tags = tag_val.split(",") if isinstance(tag_val, str) else tag_val
             dk_tags = map(lambda s: s.strip(), dk_tags)
             tags.extend(list(dk_tags))
         
         tags_set = set(tags) if tags else None
-        self.logger.info(f'All parsed tags: {tags_set}')
+        self.logger.info('All parsed tags: %s', tags_set)
         return tags_set
 
 
 class GpsCoordinatesMixin:
     def parse_coordinates(self, json: dict) -> Tuple[float, float, float]:
-        lat = json["GPS:GPSLatitude"] if "GPS:GPSLatitude" in json else None
-        lon = json["GPS:GPSLongitude"] if "GPS:GPSLongitude" in json else None
-        alt = json["GPS:GPSAltitude"] if "GPS:GPSAltitude" in json else None
+        # XMP-exif is where XMP sidecars keep them
+        lat = json.get("GPS:GPSLatitude", json.get("XMP-exif:GPSLatitude"))
+        lon = json.get("GPS:GPSLongitude", json.get("XMP-exif:GPSLongitude"))
+        alt = json.get("GPS:GPSAltitude", json.get("XMP-exif:GPSAltitude"))
         return (lon, lat, alt)
 
 
@@ -144,23 +162,23 @@ class FujiXT20ImageParser(AuthorMixin, CameraMixin, RatingMixin, PickLabelMixin,
         )
 
     def parse(self, json: dict) -> Metadata:
-        self.logger.info(f"Parsing with FujiXT20ImageParser: {json['System:FileName']}")
+        self.logger.info('Parsing with FujiXT20ImageParser: %s', json['System:FileName'])
 
         date_time_original = self.parse_date_time_mwg(json)
         if date_time_original is None and "ExifIFD:DateTimeOriginal" in json: # we don't use the MWG:DateTimeOriginal here since that one already uses the ExifIFD:OffsetDateTime to add the timezone
             date_time_original_naive = parse_exif_datetimeoriginal(json["ExifIFD:DateTimeOriginal"])
-            self.logger.info(f'There is a value for ExifIFD:DateTimeOriginal: {date_time_original_naive}')
+            self.logger.info('There is a value for ExifIFD:DateTimeOriginal: %s', date_time_original_naive)
 
             # if we could not find the date_time of the picture, it makes no sense to figure out the offset...
             if date_time_original_naive is not None and "ExifIFD:OffsetTimeOriginal" in json:
                 tz = parse_exif_offsettime(json["ExifIFD:OffsetTimeOriginal"])
-                self.logger.info(f'There is a value for ExifIFD:OffsetTimeOriginal: {tz}')
+                self.logger.info('There is a value for ExifIFD:OffsetTimeOriginal: %s', tz)
                 if tz is not None:
                     date_time_original = date_time_original_naive.replace(tzinfo=tz)
 
             if date_time_original is None and date_time_original_naive is not None and "ExifIFD:OffsetTime" in json:
                 tz = parse_exif_offsettime(json["ExifIFD:OffsetTime"])
-                self.logger.info(f'There is a value for ExifIFD:OffsetTime: {tz}')
+                self.logger.info('There is a value for ExifIFD:OffsetTime: %s', tz)
                 if tz is not None:
                     date_time_original = date_time_original_naive.replace(tzinfo=tz)
 
@@ -169,25 +187,25 @@ class FujiXT20ImageParser(AuthorMixin, CameraMixin, RatingMixin, PickLabelMixin,
                 # and the date_time
                 fmd_str = json["System:FileModifyDate"]
                 fmd = parse_file_filemodifytime(fmd_str).astimezone(timezone.utc).replace(tzinfo=None)
-                self.logger.info(f'Guessing the timezone based on the FileModifyDate: {fmd_str} -- {fmd}')
+                self.logger.info('Guessing the timezone based on the FileModifyDate: %s -- %s', fmd_str, fmd)
                 accepted_delta = 15.0  # diff should be whole half-hours, we accept 15s distance
                 if "ExifIFD:ExposureTime" in json:
                     # on FUJI, the DateTimeOriginal is the moment the shutter is pressed. With long exposure times, this means
                     # the difference between DateTimeOriginal and FileModifyDate (i.e. the time the file was written), gets bigger,
                     # 2x the exposure time in fact (because it does the 'calculation' after the first exposure time)
                     accepted_delta = accepted_delta + 2 * json["ExifIFD:ExposureTime"]
-                    self.logger.info(f'There is a value for ExifIFD:ExposureTime. We will use a bigger accepted_delta: {accepted_delta}')
+                    self.logger.info('There is a value for ExifIFD:ExposureTime. We will use a bigger accepted_delta: %s', accepted_delta)
                 diff = abs((date_time_original_naive - fmd).total_seconds())
-                self.logger.info(f"We have a diff of {diff}")
+                self.logger.info('We have a diff of %s', diff)
                 if abs(diff) >= 24*60*60:
-                    self.logger.warn(f'The difference between DTO and FMD is bigger than 24h, cannot be a timezone difference. Not setting a timezone.')
+                    self.logger.warning('The difference between DTO and FMD is bigger than 24h, cannot be a timezone difference. Not setting a timezone.')
                     date_time_original = date_time_original_naive
                 elif diff % 1800 < accepted_delta or diff % 1800 > 1800 - accepted_delta:
                     timezone_half_hours = round((date_time_original_naive - fmd).total_seconds() / 1800)
                     tz = timezone(timedelta(seconds=timezone_half_hours * 1800))
                     date_time_original = date_time_original_naive.replace(tzinfo=tz)
                 else:
-                    self.logger.warn(f'The difference is too big: {diff}. Not setting a timezone.')
+                    self.logger.warning('The difference is too big: %s. Not setting a timezone.', diff)
                     date_time_original = date_time_original_naive
         lon, lat, alt = self.parse_coordinates(json)
         return Metadata(date_time_original, self.parse_rating(json), self.parse_pick_label(json), self.parse_color_label(json), self.parse_tags(json),
@@ -203,37 +221,37 @@ class FallbackImageParser(AuthorMixin, CameraMixin, RatingMixin, PickLabelMixin,
         return True
 
     def parse(self, json: dict) -> Metadata:
-        self.logger.info(f"Parsing with FallbackImageParser: {json['System:FileName']}")
+        self.logger.info('Parsing with FallbackImageParser: %s', json['System:FileName'])
 
         date_time_original = self.parse_date_time_mwg(json)
         if date_time_original is None and "ExifIFD:DateTimeOriginal" in json:
             date_time_original_naive = parse_exif_datetimeoriginal(json["ExifIFD:DateTimeOriginal"])
-            self.logger.info(f'There is a value for ExifIFD:DateTimeOriginal: {date_time_original_naive}')
+            self.logger.info('There is a value for ExifIFD:DateTimeOriginal: %s', date_time_original_naive)
             # if we could not find the date_time of the picture, it makes no sense to figure out the offset...
             if date_time_original_naive is not None and "ExifIFD:OffsetTimeOriginal" in json:
                 tz = parse_exif_offsettime(json["ExifIFD:OffsetTimeOriginal"])
-                self.logger.info(f'There is a value for ExifIFD:OffsetTimeOriginal: {tz}')
+                self.logger.info('There is a value for ExifIFD:OffsetTimeOriginal: %s', tz)
                 if tz is not None:
                     date_time_original = date_time_original_naive.replace(tzinfo=tz)
             
             if date_time_original is None and date_time_original_naive is not None and "ExifIFD:OffsetTime" in json:
                 tz = parse_exif_offsettime(json["ExifIFD:OffsetTime"])
-                self.logger.info(f'There is a value for ExifIFD:OffsetTime: {tz}')
+                self.logger.info('There is a value for ExifIFD:OffsetTime: %s', tz)
                 if tz is not None:
                     date_time_original = date_time_original_naive.replace(tzinfo=tz)
 
             if date_time_original is None:
-                self.logger.warn(f'No timezone information available for this file.')
+                self.logger.warning('No timezone information available for this file.')
                 date_time_original = date_time_original_naive
         
         if date_time_original is None and "QuickTime:CreateDate" in json:
             date_time_original = parse_exif_datetimeoriginal(json["QuickTime:CreateDate"])
-            self.logger.info(f'There is a value for QuickTime:CreateDate: {date_time_original}')
+            self.logger.info('There is a value for QuickTime:CreateDate: %s', date_time_original)
 
-        if date_time_original is None and re.match(r'\w+_\d{8}_\d{6}[_\.].+', json['System:FileName']):
-            m = re.match(r'\w+_(\d{8}_\d{6})[_\.].+', json['System:FileName'])
+        m = FILE_NAME_TIMESTAMP.match(json['System:FileName']) if date_time_original is None else None
+        if m:
             date_time_original = datetime.strptime(m.group(1), '%Y%m%d_%H%M%S')
-            self.logger.info(f'Parsed timestamp from filename: {date_time_original}')
+            self.logger.info('Parsed timestamp from filename: %s', date_time_original)
 
         lon, lat, alt = self.parse_coordinates(json)
         return Metadata(date_time_original, self.parse_rating(json), self.parse_pick_label(json), self.parse_color_label(json), self.parse_tags(json),
@@ -1,6 +1,9 @@
 from.metadata_parser import Metadata
 from main.utils.exifdata import format_exif_datetimeoriginal, format_exif_offsettime, format_file_modify_date, format_exif_fulldatetime
 from enum import Enum, auto
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+import hashlib
 
 class MetadataType(Enum):
     DATE_TIME = auto()
@@ -12,6 +15,73 @@ class MetadataType(Enum):
     COORDINATES = auto()
 
 
+class WriteStrategy(Enum):
+    """ Where the metadata of a file type is written to. A sidecar is an XMP file next to the file, e.g. IMG_1.MOV.xmp:
+    writing it costs kilobytes, while writing in the file can mean copying gigabytes for videos. """
+    IN_FILE = "in_file"
+    SIDECAR = "sidecar"
+    BOTH = "both"
+
+    @property
+    def in_file(self) -> bool:
+        return self != WriteStrategy.SIDECAR
+
+    @property
+    def sidecar(self) -> bool:
+        return self != WriteStrategy.IN_FILE
+
+
+def metadata_hashes(metadata: Metadata) -> Dict[str, str]:
+    """ A hash per MetadataType (by name) of the part of the metadata that the type covers, so we can tell which types
+    changed since the metadata was last read or written. """
+    parts = {
+        MetadataType.DATE_TIME: metadata.date_time_original.isoformat() if metadata.date_time_original is not None else None,
+        MetadataType.RATING: metadata.rating,
+        MetadataType.PICK_LABEL: metadata.pick_label,
+        MetadataType.COLOR_LABEL: metadata.color_label,
+        MetadataType.TAGS: sorted(metadata.tags) if metadata.tags else [],
+        MetadataType.ARTIST: metadata.artist,
+        MetadataType.COORDINATES: (metadata.longitude, metadata.latitude, metadata.altitude),
+    }
+    return {type.name: hashlib.sha1(repr(value).encode("utf-8")).hexdigest() for type, value in parts.items()}
+
+
+def changed_metadata_types(old_hashes: Dict[str, str], new_hashes: Dict[str, str]) -> Set[MetadataType]:
+    if old_hashes is None:
+        return set(MetadataType)
+    return {type for type in MetadataType if old_hashes.get(type.name) != new_hashes.get(type.name)}
+
+
+@dataclass
+class MetadataWritePlan:
+    """ The existing files to write, grouped by the exiftool arguments they need, the new files (sidecars) to create
+    with their arguments, and the files per image (by id). All paths are absolute. """
+    commands: Dict[tuple, List[str]] = field(default_factory=dict)
+    new_files: Dict[str, tuple] = field(default_factory=dict)
+    files: Dict[int, List[str]] = field(default_factory=dict)
+
+    def add(self, image_id: int, params: list, path: str, new=False):
+        files = self.files.setdefault(image_id, [])
+        # e.g. IMG_1.JPG and IMG_1.RAF sharing IMG_1.xmp
+        if path not in files:
+            if new:
+                self.new_files[path] = tuple(params)
+            else:
+                self.commands.setdefault(tuple(params), []).append(path)
+            files.append(path)
+
+
+@dataclass
+class MetadataWriteResult:
+    """ What happened to every file of a metadata write: the paths that were written, and the error per path that was not. """
+    written: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
 class JpegImageSerializer:
     supported_metadata_types = (MetadataType.ARTIST, MetadataType.RATING, MetadataType.PICK_LABEL, MetadataType.COLOR_LABEL, MetadataType.TAGS, MetadataType.DATE_TIME, MetadataType.COORDINATES)
 
@@ -64,8 +134,47 @@ class OriginalFileSerializer:
         return []
     
 
+class XmpSidecarSerializer:
+    """ Writes everything as XMP, for files of which the metadata goes to a sidecar (see WriteStrategy). Sidecars that
+    are attachments are not written on their own, but as the sidecar of the file they belong to. """
+    supported_metadata_types = (MetadataType.ARTIST, MetadataType.RATING, MetadataType.PICK_LABEL, MetadataType.COLOR_LABEL, MetadataType.TAGS, MetadataType.DATE_TIME, MetadataType.COORDINATES)
+
+    def can_serialize(self, extension) -> bool:
+        return extension.casefold() == ".xmp"
+
+    def serialize(self, metadata: Metadata) -> list:
+        params = []
+        if metadata.artist is not None:
+            params.append(f"-XMP-dc:Creator={metadata.artist}")
+        if metadata.rating is not None:
+            params.append(f"-XMP-xmp:Rating={metadata.rating}")
+        params.append(f"-XMP-digiKam:PickLabel={metadata.pick_label if metadata.pick_label is not None else ''}")
+        params.append(f"-XMP-digiKam:ColorLabel={metadata.color_label if metadata.color_label is not None else ''}")
+        if metadata.date_time_original is not None:
+            # read back as MWG:DateTimeOriginal
+            params.append(f"-XMP-photoshop:DateCreated={format_exif_fulldatetime(metadata.date_time_original)}")
+            params.append(f"-XMP-exif:DateTimeOriginal={format_exif_fulldatetime(metadata.date_time_original)}")
+        if metadata.longitude is not None and metadata.latitude is not None:
+            params.append(f"-XMP-exif:GPSLongitude={metadata.longitude}")
+            params.append(f"-XMP-exif:GPSLatitude={metadata.latitude}")
+            if metadata.altitude is not None:
+                params.append(f"-XMP-exif:GPSAltitude={metadata.altitude}")
+        if metadata.artist is not None and metadata.date_time_original is not None:
+            params.append(f"-XMP-dc:Rights=Copyright © {metadata.date_time_original.year} Dries Hoet, all rights reserved.")
+        # clear the lists first, otherwise exiftool adds to what is already in the sidecar
+        params.append("-XMP-digiKam:TagsList=")
+        params.append("-XMP-lr:HierarchicalSubject=")
+        if metadata.tags:
+            for tag in sorted(metadata.tags):
+                params.append(f"-XMP-digiKam:TagsList={tag}")
+                params.append(f"-XMP-lr:HierarchicalSubject={tag.replace('/', '|')}")
+        if metadata.original_file_name:
+            params.append(f"-XMP-xmpMM:PreservedFileName={metadata.original_file_name}")
+        return params
+
+
 class BasicRawImageSerializer:
-    supported_metadata_types = (MetadataType.DATE_TIME)
+    supported_metadata_types = (MetadataType.DATE_TIME,)
 
     def can_serialize(self, extension) -> bool:
         return ".raf" == extension.lower() or ".cr2" == extension.lower() or ".orf" == extension.lower()
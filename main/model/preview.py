@@ -0,0 +1,67 @@
+from io import BytesIO
+from PIL import Image as PIL_Image, ImageOps as PIL_ImageOps
+from typing import Dict, List, Tuple
+
+try:
+    # adds AVIF to Pillow versions that do not have it built in
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# Pillow format -> MIME type, the formats besides JPEG best first
+MIME_TYPES = {'AVIF': 'image/avif', 'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+EXTENSIONS = {'AVIF': 'avif', 'WEBP': 'webp', 'JPEG': 'jpg'}
+
+
+def fit(size, max_width: int, max_height: int):
+    """ The biggest size with the aspect ratio of size that fits in max_width x max_height """
+    percent = min(max_width / float(size[0]), max_height / float(size[1]))
+    return int(float(size[0]) * percent), int(float(size[1]) * percent)
+
+
+def writable_formats() -> List[str]:
+    """ The formats of MIME_TYPES that this Pillow can write """
+    PIL_Image.init()
+    return [format for format in MIME_TYPES if format in PIL_Image.SAVE]
+
+
+def negotiate_format(accept: str, formats: List[str]) -> str:
+    """ The first of formats that the Accept header names, JPEG if none. Wildcards do not count: browsers name the
+    image formats they can show. """
+    accepted = {}
+    for item in (accept or "").split(","):
+        mime_type, *params = [part.strip() for part in item.split(";")]
+        q = next((param[2:] for param in params if param.startswith("q=")), "1")
+        try:
+            accepted[mime_type.lower()] = float(q)
+        except ValueError:
+            continue
+    return next((format for format in formats if accepted.get(MIME_TYPES[format], 0) > 0), 'JPEG')
+
+
+def quality_for(qualities: Dict[str, List[Tuple[int, int]]], format: str, size) -> int:
+    """ The quality to encode an image of size in, from qualities: per format, a list of (long edge, quality), of which
+    the first with a long edge at least that of the image is used, or the last one. None for the default. """
+    steps = (qualities or {}).get(format)
+    if not steps:
+        return None
+    return next((quality for long_edge, quality in steps if long_edge >= max(size)), steps[-1][1])
+
+
+def encode(pil_image, format: str = 'JPEG', quality: int = None) -> bytes:
+    if pil_image.mode not in ("RGB", "L"):
+        pil_image = pil_image.convert("RGB")
+    out = BytesIO()
+    if quality is None:
+        pil_image.save(out, format)
+    else:
+        pil_image.save(out, format, quality=quality)
+    return out.getvalue()
+
+
+def render_preview(path, max_width: int, max_height: int, format: str = 'JPEG', qualities=None) -> bytes:
+    """ The image at path (or in an open file), upright and scaled to fit in max_width x max_height, encoded in format with the quality
+    for its size in qualities (see quality_for) """
+    pil_image = PIL_ImageOps.exif_transpose(PIL_Image.open(path))
+    pil_image = pil_image.resize(fit(pil_image.size, max_width, max_height), PIL_Image.Resampling.LANCZOS)
+    return encode(pil_image, format, quality_for(qualities, format, pil_image.size))
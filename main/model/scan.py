@@ -0,0 +1,72 @@
+import os
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+from .file_types import FileType, sidecar_names
+from main.utils.fs import file_fingerprint
+
+
+@dataclass
+class ScannedFile:
+    name: str
+    stat: os.stat_result
+
+
+@dataclass
+class DirectoryContents:
+    """ What we found in a directory on disk. Reading this does not touch the DB, so it can be done on any thread. """
+    path: str
+    images: List[ScannedFile] = field(default_factory=list)
+    attachments: List[ScannedFile] = field(default_factory=list)
+    subdirs: List[str] = field(default_factory=list)
+    # all names in the directory, including the ones we don't care about (e.g. skipped dirs)
+    names: set = field(default_factory=set)
+    # the images of which we need to (re-)read the metadata
+    to_read: List[ScannedFile] = field(default_factory=list)
+
+    @classmethod
+    def read(cls, path: str, known_files: Dict[str, Tuple], skip_dirs = [], reads_sidecar: Callable[[str], bool] = None) -> 'DirectoryContents':
+        """ known_files maps the names of the images and attachments we already have to their fingerprint. Only new
+        images, images of which the fingerprint changed and images of which an XMP sidecar is new, changed or removed
+        will be in to_read. The latter only for the images of which the sidecar is read with them: reads_sidecar(name)
+        tells which ones, without it sidecars are ignored. """
+        contents = cls(path)
+        for entry in os.scandir(path):
+            contents.names.add(entry.name)
+            if entry.is_file():
+                scanned = ScannedFile(entry.name, entry.stat())
+                if FileType.from_path(entry.path) == FileType.MAIN_MEDIA:
+                    contents.images.append(scanned)
+                    if contents._needs_read(scanned, known_files):
+                        contents.to_read.append(scanned)
+                else:
+                    contents.attachments.append(scanned)
+            elif entry.is_dir():
+                if entry.name in skip_dirs:
+                    print(f"Skipping dir {entry.name} because it is in the skip list")
+                else:
+                    contents.subdirs.append(entry.name)
+
+        attachments = {att.name: att for att in contents.attachments}
+        to_read = {img.name for img in contents.to_read}
+        for img in contents.images:
+            if img.name not in to_read and reads_sidecar is not None and reads_sidecar(img.name) and contents._sidecar_changed(img, attachments, known_files):
+                contents.to_read.append(img)
+        return contents
+
+    def _sidecar_changed(self, img: ScannedFile, attachments: Dict[str, ScannedFile], known_files: Dict[str, Tuple]) -> bool:
+        for name in sidecar_names(img.name):
+            if name in attachments:
+                if self._needs_read(attachments[name], known_files):
+                    return True
+            elif name in known_files:
+                # removed: what was merged from it has to go
+                return True
+        return False
+
+    def _needs_read(self, scanned: ScannedFile, known_files: Dict[str, Tuple]) -> bool:
+        if scanned.name not in known_files:
+            return True
+        fingerprint = known_files[scanned.name]
+        # no fingerprint means the file was scanned before we kept them: don't re-read it, the DB might have unwritten edits
+        return fingerprint[0] is not None and fingerprint != file_fingerprint(scanned.stat)
@@ -1,12 +1,61 @@
-import logging
+import hashlib, logging, os
 
-from PIL import Image as PIL_Image, ImageOps as PIL_ImageOps
+from dataclasses import dataclass, field
+from PIL import Image as PIL_Image, ImageOps as PIL_ImageOps, ExifTags
 from io import BytesIO
+from typing import Dict, Tuple
 import ffmpeg
 
+from .preview import EXTENSIONS, encode, quality_for
+
+@dataclass(frozen=True)
+class ThumbnailMode:
+    # let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding, instead of decoding all pixels
+    draft: bool
+    # use the preview the camera embedded in the file (EXIF thumbnail, MPF preview), when it is big enough
+    embedded: bool
+    resample: int
+
+
+THUMBNAIL_MODES = {
+    'quality': ThumbnailMode(draft=False, embedded=False, resample=PIL_Image.Resampling.LANCZOS),
+    'fast': ThumbnailMode(draft=True, embedded=False, resample=PIL_Image.Resampling.LANCZOS),
+    'fastest': ThumbnailMode(draft=True, embedded=True, resample=PIL_Image.Resampling.BILINEAR),
+}
+
+# part of every thumbnail key: increase it when the way thumbnails are made changes, so they are all made again
+THUMBNAIL_VERSION = 1
+# bigger files (videos, mostly) are hashed by their size and the parts at the start and the end only
+CONTENT_HASH_FULL_LIMIT = 64 * 1024 * 1024
+CONTENT_HASH_PART = 8 * 1024 * 1024
+
+
 class ImageThumbnailCreator:
     logger = logging.getLogger(__name__)
 
+    ORIENTATION = 0x0112
+    # EXIF orientation -> what to do to show the image upright, as in PIL_ImageOps.exif_transpose
+    ORIENTATION_TRANSPOSE = {
+        2: PIL_Image.Transpose.FLIP_LEFT_RIGHT,
+        3: PIL_Image.Transpose.ROTATE_180,
+        4: PIL_Image.Transpose.FLIP_TOP_BOTTOM,
+        5: PIL_Image.Transpose.TRANSPOSE,
+        6: PIL_Image.Transpose.ROTATE_270,
+        7: PIL_Image.Transpose.TRANSVERSE,
+        8: PIL_Image.Transpose.ROTATE_90,
+    }
+    # where the EXIF thumbnail is in IFD1, relative to the TIFF header
+    JPEG_INTERCHANGE_FORMAT = 0x0201
+    JPEG_INTERCHANGE_FORMAT_LENGTH = 0x0202
+    EXIF_HEADER_LENGTH = len(b"Exif\0\0")
+    # the list of images in the MPF segment
+    MP_ENTRY = 0xB002
+
+    def __init__(self, mode: str = 'quality', qualities=None):
+        """ mode is one of THUMBNAIL_MODES, qualities the JPEG quality per size (see quality_for) """
+        self.mode = THUMBNAIL_MODES[mode]
+        self.qualities = qualities
+
     def can_thumbnail(self, extension: str) -> bool:
         return extension.casefold() in [".jpeg", ".jpg"]
 
@@ -17,22 +66,99 @@ class ImageThumbnailCreator:
         return img_raw
 
     def create_thumbnail(self, path: str, width: int, height: int) -> BytesIO:
+        if not self.mode.draft and not self.mode.embedded:
+            return self._create_full_thumbnail(path, width, height)
+
+        pil_image = PIL_Image.open(path)
+        orientation = pil_image.getexif().get(self.ORIENTATION, 1)
+        # the box in the orientation the pixels are stored in: we only turn the image once it is small
+        box = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+        target_size = self._fit(pil_image.size, box)
+
+        source = self._embedded_preview(path, pil_image, target_size) if self.mode.embedded else None
+        if source is None:
+            source = pil_image
+        if self.mode.draft:
+            source.draft("RGB", target_size)
+        self.logger.info("Resizing image %s from (%d, %d) to %s", path, *source.size, target_size)
+        return self._encode(self._upright(source.resize(target_size, self.mode.resample), orientation))
+
+    def create_previews(self, path: str, width: int, height: int, levels) -> Tuple[BytesIO, Dict[int, bytes]]:
+        """ The thumbnail and the previews of the image at the given levels (the length of their long edge), as JPEG,
+        from a single decode of the image. Each is scaled down from the next bigger one. A level bigger than the image
+        is the image at its own size. """
+        pil_image = PIL_Image.open(path)
+        orientation = pil_image.getexif().get(self.ORIENTATION, 1)
+        # the long edge stays the long edge when the image is turned, so these are fine in the stored orientation
+        sizes = {level: self._fit(pil_image.size, (level, level)) if max(pil_image.size) > level else pil_image.size for level in levels}
+        if self.mode.draft and sizes:
+            pil_image.draft("RGB", max(sizes.values()))
+
+        source = pil_image
+        previews = {}
+        for level in sorted(levels, reverse=True):
+            if source.size != sizes[level]:
+                source = source.resize(sizes[level], self.mode.resample)
+            previews[level] = self._encode(self._upright(source, orientation)).getvalue()
+        box = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+        self.logger.info("Resizing image %s from (%d, %d) to previews %s and a thumbnail", path, *source.size, levels)
+        thumbnail = source.resize(self._fit(source.size, box), self.mode.resample)
+        return self._encode(self._upright(thumbnail, orientation)), previews
+
+    def _upright(self, pil_image, orientation: int):
+        if orientation in self.ORIENTATION_TRANSPOSE:
+            return pil_image.transpose(self.ORIENTATION_TRANSPOSE[orientation])
+        return pil_image
+
+    def _encode(self, pil_image) -> BytesIO:
+        return BytesIO(encode(pil_image, 'JPEG', quality_for(self.qualities, 'JPEG', pil_image.size)))
+
+    def _create_full_thumbnail(self, path: str, width: int, height: int) -> BytesIO:
+        """ Decodes all pixels and turns the image upright before resizing. Slow, but it never takes a shortcut. """
         pil_image = PIL_Image.open(path)
         pil_image = PIL_ImageOps.exif_transpose(pil_image)
-        
-        width_percent = (width / float(pil_image.size[0]))
-        height_percent = (height / float(pil_image.size[1]))
+        target_width, target_height = self._fit(pil_image.size, (width, height))
+        self.logger.info(f"Resizing image {path} to ({target_width}, {target_height})")
+        return self._encode(pil_image.resize((target_width, target_height), self.mode.resample))
+
+    def _fit(self, size: Tuple[int, int], box: Tuple[int, int]) -> Tuple[int, int]:
+        """ The size of an image of this size, scaled to fit in the box """
+        width_percent = (box[0] / float(size[0]))
+        height_percent = (box[1] / float(size[1]))
 
         percent = min(width_percent, height_percent)
 
-        target_width = int((float(pil_image.size[0]) * float(percent)))
-        target_height = int((float(pil_image.size[1]) * float(percent)))
-        self.logger.info(f"Resizing image {path} to ({target_width}, {target_height})")
-        pil_image = pil_image.resize((target_width, target_height), PIL_Image.ANTIALIAS)
+        target_width = int((float(size[0]) * float(percent)))
+        target_height = int((float(size[1]) * float(percent)))
+        return (target_width, target_height)
 
-        img_raw = BytesIO()
-        pil_image.save(img_raw, "JPEG")
-        return img_raw
+    def _embedded_preview(self, path: str, pil_image, target_size: Tuple[int, int]):
+        """ The smallest image embedded in the file that is at least target_size and has the same aspect ratio as the
+        image itself (some cameras add black bars to their EXIF thumbnail), or None. """
+        candidates = []
+        try:
+            ifd1 = pil_image.getexif().get_ifd(ExifTags.IFD.IFD1)
+            offset = ifd1.get(self.JPEG_INTERCHANGE_FORMAT)
+            length = ifd1.get(self.JPEG_INTERCHANGE_FORMAT_LENGTH)
+            exif = pil_image.info.get("exif")
+            if offset and length and exif:
+                start = self.EXIF_HEADER_LENGTH + offset
+                candidates.append(PIL_Image.open(BytesIO(exif[start:start + length])))
+            # MPF: most cameras put a bigger preview after the image itself. We open it on its own instead of seeking
+            # to it, since PIL takes the size of a frame from its EXIF, which not every camera writes.
+            mpinfo = getattr(pil_image, "mpinfo", None) or {}
+            for frame, entry in list(enumerate(mpinfo.get(self.MP_ENTRY, [])))[1:]:
+                with PIL_Image.open(path) as mpo:
+                    mpo.seek(frame)
+                    mpo.fp.seek(mpo.offset)
+                    candidates.append(PIL_Image.open(BytesIO(mpo.fp.read(entry["Size"]))))
+        except Exception as exc:
+            self.logger.info("Cannot read the embedded previews of %s: %r", path, exc)
+
+        aspect = pil_image.size[0] / pil_image.size[1]
+        usable = [c for c in candidates if c.size[0] >= target_size[0] and c.size[1] >= target_size[1]
+            and abs(c.size[0] / c.size[1] - aspect) < 0.01]
+        return min(usable, key=lambda c: c.size[0] * c.size[1]) if usable else None
 
 
 class VideoThumbnailCreator:
@@ -57,3 +183,79 @@ class VideoThumbnailCreator:
         )
         self.logger.debug(err)
         return BytesIO(out)
+
+
+def render_thumbnail(path: str, width: int, height: int, mode: str = 'quality', qualities=None) -> bytes:
+    """ The thumbnail of the file at path as JPEG bytes, or None when we can't make thumbnails of this type. This is
+    what the worker processes of the ThumbnailService run, so it needs nothing but the path. """
+    extension = os.path.splitext(path)[1]
+    for creator in [ImageThumbnailCreator(mode, qualities), VideoThumbnailCreator()]:
+        if creator.can_thumbnail(extension):
+            return creator.create_thumbnail(path, width, height).getvalue()
+    return None
+
+
+def content_hash(path: str) -> bytes:
+    """ A hash of the contents of the file, so a file that was moved or renamed still has the same one """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= CONTENT_HASH_FULL_LIMIT:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        else:
+            h.update(size.to_bytes(8, 'big'))
+            h.update(f.read(CONTENT_HASH_PART))
+            f.seek(-CONTENT_HASH_PART, os.SEEK_END)
+            h.update(f.read(CONTENT_HASH_PART))
+    return h.digest()
+
+
+def thumbnail_key(path: str, width: int, height: int, mode: str, qualities=None) -> str:
+    """ Identifies the thumbnail of the file at path: the same for files with the same contents, different when the
+    file or the way the thumbnail is made changes. """
+    h = hashlib.blake2b(content_hash(path), digest_size=16)
+    h.update(f"{width}x{height}/{mode}/{THUMBNAIL_VERSION}".encode())
+    quality = quality_for(qualities, 'JPEG', (width, height))
+    if quality is not None:
+        h.update(f"/{quality}".encode())
+    return h.hexdigest()
+
+
+def thumbnail_file_name(key: str, format: str = 'JPEG') -> str:
+    return f"thumbnails/{key[:2]}/{key}.{EXTENSIONS[format]}"
+
+
+@dataclass
+class RenderedThumbnail:
+    """ What render_keyed_thumbnail made. key is None when we can't make thumbnails of the file, data is None when
+    the thumbnail was not made since it exists already. """
+    key: str = None
+    data: bytes = None
+    # level -> JPEG
+    previews: Dict[int, bytes] = field(default_factory=dict)
+    # format -> the thumbnail in that format
+    variants: Dict[str, bytes] = field(default_factory=dict)
+
+
+def render_keyed_thumbnail(path: str, width: int, height: int, mode: str = 'quality', root: str = None, levels=(), formats=(), qualities=None) -> RenderedThumbnail:
+    """ The key of the thumbnail of the file at path, the thumbnail itself as JPEG bytes, like render_thumbnail, the
+    previews at the given levels (see ImageThumbnailCreator.create_previews) for images, and the thumbnail in the
+    other formats. When the files with that key already exist in root, nothing is made: not the previews either, as
+    that would mean decoding the image. """
+    extension = os.path.splitext(path)[1]
+    image_creator = ImageThumbnailCreator(mode, qualities)
+    if not any(creator.can_thumbnail(extension) for creator in [image_creator, VideoThumbnailCreator()]):
+        return RenderedThumbnail()
+    result = RenderedThumbnail(key=thumbnail_key(path, width, height, mode, qualities))
+    if root is not None and all(os.path.isfile(os.path.join(root, thumbnail_file_name(result.key, format))) for format in ['JPEG', *formats]):
+        return result
+    if levels and image_creator.can_thumbnail(extension):
+        thumbnail, result.previews = image_creator.create_previews(path, width, height, levels)
+        result.data = thumbnail.getvalue()
+    else:
+        result.data = render_thumbnail(path, width, height, mode, qualities)
+    # from the JPEG, since the video thumbnails are made by ffmpeg
+    thumbnail = PIL_Image.open(BytesIO(result.data))
+    result.variants = {format: encode(thumbnail, format, quality_for(qualities, format, thumbnail.size)) for format in formats if format != 'JPEG'}
+    return result
@@ -1,19 +1,28 @@
-from django.db import models
-from django.db.models import F
+from django.db import models, transaction, connection, OperationalError
+from django.conf import settings
+from django.db.models import F, Case, Value, When
 from django.db.models.functions import Coalesce, Cast
-from django.utils.functional import cached_property
+from django.utils import timezone as django_timezone
 from django.dispatch import receiver
 from datetime import datetime, timezone, timedelta
-from django.core.files import File
-from django.core.cache import caches
 from pathlib import Path
-import logging, time, os, pytz
+import logging, time, os, pytz, threading, zlib
+import json as json_module
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue, Empty
 from typing import List
 
 from .services import ExifToolService, MetadataParserService, GpsTrackParserService, GeotaggingService, ThumbnailService
+from .model.metadata_parser import Metadata
+from .model.metadata_writer import metadata_hashes, changed_metadata_types
 from .model.file_types import FileType
+from .model.scan import DirectoryContents
+from .model.attachments import AttachmentMatcher
+from .model.preview import EXTENSIONS
 from .utils.datetime import has_timezone
-from .utils.fs import rename_safely
+from .utils.fs import rename_safely, file_fingerprint
+from .utils import inotify
 
 class UiException(Exception):
     pass
@@ -34,6 +43,20 @@ class MetadataIncompleteError(UiException):
         }
 
 
+class MetadataWriteError(UiException):
+    def __init__(self, failed):
+        # path -> error
+        self.failed = failed
+        super().__init__(f"Could not write the metadata of {len(failed)} files: {', '.join(f'{os.path.basename(path)} ({error})' for path, error in failed.items())}")
+
+    def as_dict(self):
+        return {
+            "type": "MetadataWriteError",
+            "message": str(self),
+            "file_names": [os.path.basename(path) for path in self.failed]
+        }
+
+
 class ImageSetActionError(UiException):
     def __init__(self, message, image_names):
         self.image_names = image_names
@@ -49,6 +72,10 @@ class ImageSetActionError(UiException):
         }
 
 
+class ScanCancelledError(Exception):
+    pass
+
+
 class SettingsManager(models.Manager):
     def get_single(self, name):
         return self.get(name=name).value
@@ -114,35 +141,140 @@ class Tag(models.Model):
     parent = models.ForeignKey("self", null=True, blank=True, on_delete=models.CASCADE, related_name="subtags")
     name = models.CharField(max_length=255)
 
-    # cached property so it doesn't redo those DB queries all the time. If we want to refresh this, we can delete the property with `del full_name`
-    @cached_property
+    # served from the TagIndex, so this does not need any DB queries
+    @property
     def full_name(self):
-        if self.parent_id is None:
+        full_name = TagIndex.instance().full_name(self.id) if self.id is not None else None
+        if full_name is not None:
+            return full_name
+        elif self.parent_id is None:
             return self.name
         else:
-            # HACK! instead of getting the parent through the .parent reference here, we will get it from the cache.
-            # By doing so, we will not do another DB lookup here. This avoids a LOT of lookups, since the parents
-            # are now shared by all tags, even over multiple images. Since this property is also cached, this means
-            # we make getting the full_name a lot quicker
-            cache = caches['tags']
-            if not self.parent_id in cache:
-               cache.set(self.parent_id, self.parent, 30)
-            cached_parent = cache.get(self.parent_id)
-            return f"{cached_parent.full_name}/{self.name}"
+            return f"{self.parent.full_name}/{self.name}"
 
     def __str__(self):
         return self.full_name
 
+
+class TagIndex:
+    """ All tags in memory, in a trie on the path segments of their full name, so finding a tag by its full name takes
+    O(depth) and no queries. The index is loaded on first use and reloaded after any tag was saved or deleted, once that
+    is committed. Other processes (and other web workers) don't tell us about their changes, so a tag that is not found
+    is looked for again after a reload, when there are tags we don't know yet. """
+    __instance = None
+
     @classmethod
-    def find_hierarchical_tag(cls, parent, name):
-        (first_section_name, _, remainder) = name.partition('/')
-        first_section_tag = Tag.objects.get(parent = parent, name = first_section_name)
-        if not first_section_tag:
-            return None
-        elif not remainder:
-            return first_section_tag
+    def instance(cls):
+        if cls.__instance is not None:
+            return cls.__instance
         else:
-            return Tag.find_hierarchical_tag(first_section_tag, remainder)
+            cls.__instance = TagIndex()
+            return cls.__instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (trie, full names by id, highest id), replaced as a whole so readers never see a half-built index
+        self.index = None
+        # incremented by every invalidate, so an index that was loading meanwhile is not kept
+        self.generation = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.generation = self.generation + 1
+            self.index = None
+
+    def find(self, full_name: str):
+        """ Returns the id of the tag with the given full name (e.g. "Places/Belgium/Ghent"), or None. """
+        tag_id = self._find(self._get_index(), full_name)
+        if tag_id is None and self._has_new_tags():
+            tag_id = self._find(self._get_index(), full_name)
+        return tag_id
+
+    def full_name(self, tag_id):
+        full_name = self._get_index()[1].get(tag_id)
+        if full_name is None and self._has_new_tags():
+            full_name = self._get_index()[1].get(tag_id)
+        return full_name
+
+    def _find(self, index, full_name: str):
+        node = index[0]
+        for segment in full_name.split('/'):
+            node = node[1].get(segment)
+            if node is None:
+                return None
+        return node[0]
+
+    def _has_new_tags(self) -> bool:
+        """ Invalidates the index when another process added tags, returns whether it did """
+        max_id = Tag.objects.aggregate(max_id=models.Max('id'))['max_id'] or 0
+        if max_id > self._get_index()[2]:
+            self.invalidate()
+            return True
+        return False
+
+    def _get_index(self):
+        index = self.index
+        if index is None:
+            with self.lock:
+                generation = self.generation
+            # without the lock, so invalidate never waits for a load
+            index = self._load()
+            with self.lock:
+                if self.generation == generation:
+                    self.index = index
+        return index
+
+    def _load(self):
+        tags = list(Tag.objects.order_by('id').values_list('id', 'parent_id', 'name'))
+        children = {}
+        for tag_id, parent_id, name in tags:
+            children.setdefault(parent_id, []).append((tag_id, name))
+
+        # every trie node is (tag id, {segment: child node})
+        trie = (None, {})
+        full_names = {}
+        todo = [(None, trie, None)]
+        while todo:
+            parent_id, parent_node, parent_name = todo.pop()
+            for tag_id, name in children.get(parent_id, []):
+                node = (tag_id, {})
+                # duplicate names under the same parent are ambiguous, we take the first one
+                parent_node[1].setdefault(name, node)
+                full_names[tag_id] = name if parent_name is None else f"{parent_name}/{name}"
+                todo.append((tag_id, node, full_names[tag_id]))
+        return trie, full_names, tags[-1][0] if tags else 0
+
+
+@receiver(models.signals.post_save, sender=Tag)
+@receiver(models.signals.post_delete, sender=Tag)
+def invalidate_tag_index(sender, instance, **kwargs):
+    # before that, other threads would load the index without the change
+    transaction.on_commit(TagIndex.instance().invalidate)
+
+
+class FingerprintedFile(models.Model):
+    """ A file on disk of which we remember the size, mtime and inode, so a rescan can tell whether it changed. """
+    file_size = models.BigIntegerField(null=True)
+    file_mtime_ns = models.BigIntegerField(null=True)
+    file_inode = models.BigIntegerField(null=True)
+
+    FINGERPRINT_FIELDS = ['file_size', 'file_mtime_ns', 'file_inode']
+
+    class Meta:
+        abstract = True
+
+    @property
+    def fingerprint(self):
+        return (self.file_size, self.file_mtime_ns, self.file_inode)
+
+    def has_fingerprint(self):
+        return self.file_size is not None
+
+    def set_fingerprint(self, stat_result):
+        self.file_size, self.file_mtime_ns, self.file_inode = file_fingerprint(stat_result)
+
+    def fingerprint_matches(self, stat_result):
+        return self.fingerprint == file_fingerprint(stat_result)
 
 
 class Directory(models.Model):
@@ -162,58 +294,149 @@ class Directory(models.Model):
             self.images.all().delete()
             self.subdirs.all().delete()
 
-        # then scan for all contents and add them to the DB
+        # then scan for all contents and compare them with what we have in the DB
         abs_path = self.get_absolute_path()
-        contents = list(os.scandir(abs_path))
-        new_images : List[Image] = []
-        new_dirs : List[Directory] = []
-        new_attachments : List[Attachment] = []
+        contents = DirectoryContents.read(abs_path, self.known_fingerprints(), skip_dirs, ExifToolService.instance().reads_sidecar)
+        for records in ExifToolService.instance().read_metadata_chunks(abs_path, *contents.to_read, fast=True):
+            self.apply_metadata(contents, records)
+        self.apply_contents(contents)
 
-        # create sub-items (both images and subdirs)
-        existing_images = self.images.values_list('name', flat=True)
-        existing_dirs = self.subdirs.values_list('path', flat=True)
-        for entry in contents:
-            if self._is_image(entry) and not entry.name in existing_images:
-                img = Image(parent=self, name=entry.name)
-                new_images.append(img)
-            elif entry.is_dir() and not entry.name in existing_dirs:
-                if entry.name in skip_dirs:
-                    print(f"Skipping dir {entry.name} because it is in the skip list")
-                else:
-                    new_dirs.append(Directory(parent=self, path=entry.name))
+        for d in self.subdirs.all():
+            d.scan(skip_dirs=skip_dirs) # don't set reload_metadata here because we deleted the subdirs above, no need to do that again
 
+        print("Scanned %s [%d], %ss" % (self.get_absolute_path(), self.id, time.time()-start))
 
-        # if we have new images, scan their metadata and create a thumbnail
-        if new_images:
-            json = ExifToolService.instance().read_metadata(self.get_absolute_path(), *new_images)
-            for i, j in zip(new_images, json):
-                i.load_metadata(j)
-                i.create_dummy_thumbnail()
+    def known_fingerprints(self):
+        """ The fingerprints of the images and attachments in this directory, by name. """
+        images = self.images.values_list('name', *Image.FINGERPRINT_FIELDS)
+        attachments = Attachment.objects.filter(parent__parent=self).values_list('name', *Attachment.FINGERPRINT_FIELDS)
+        return {name: (size, mtime_ns, inode) for name, size, mtime_ns, inode in [*images, *attachments]}
+
+    def queue_missing_thumbnails(self):
+        """ Queues the thumbnails of this directory that were not made yet, e.g. because the app stopped before it got
+        to them, before anything else. """
+        service = ThumbnailService.instance()
+        images = [img for img in self.images.exclude(thumbnail_state='ready') if not service.is_queued(img.thumbnail_source()) and img.thumbnail_retry_due()]
+        if images:
+            Image.refresh_thumbnails(images, urgent=True)
+
+    def compact_thumbnail_pack(self, force=False) -> bool:
+        """ Rewrites the thumbnail pack of this directory without the thumbnails of removed images and the ones that
+        were replaced, once they take more than THUMBNAIL_PACK_COMPACT_RATIO of it. Returns whether it did. """
+        pack = ThumbnailService.instance().pack(self.id)
+        size = pack.size()
+        if not size:
+            return False
+        live = {image_id: (offset, length) for image_id, offset, length in self.images.filter(thumbnail_offset__isnull=False).values_list('id', 'thumbnail_offset', 'thumbnail_length')}
+        if not force and size - pack.used_bytes(live) <= size * getattr(settings, 'THUMBNAIL_PACK_COMPACT_RATIO', 0.5):
+            return False
+        moved = pack.compact(live)
+        with transaction.atomic():
+            for image_id, (offset, length) in live.items():
+                # only if the thumbnail was not replaced in the meantime
+                unchanged = Image.objects.filter(id=image_id, thumbnail_offset=offset)
+                if image_id in moved:
+                    unchanged.update(thumbnail_offset=moved[image_id][0])
+                else:
+                    unchanged.update(thumbnail_offset=None, thumbnail_length=None, thumbnail_state='missing')
+        return True
+
+    def apply_metadata(self, contents: DirectoryContents, records: List[dict]):
+        """ Creates or updates the images of which the metadata was read, for one chunk of exiftool output. """
+        scanned = {f.name: f for f in contents.to_read}
+        names = [os.path.basename(json["SourceFile"]) for json in records]
+        records_by_name = dict(zip(names, records))
+        existing_images = {img.name: img for img in self.images.filter(name__in=names)}
+        new_images : List[Image] = []
+        changed_images : List[Image] = []
+        # changed outside of the app, but also edited in the app and not written yet
+        conflicting_images : List[Image] = []
+        parsed = MetadataParserService.instance().parse_many(records)
+        for name, json, metadata in zip(names, records, parsed):
+            img = existing_images.get(name)
+            if img is None:
+                img = Image(parent=self, name=name)
+                img.set_fingerprint(scanned[name].stat)
+                img.load_metadata(json, metadata)
+                new_images.append(img)
+            elif img.metadata_dirty:
+                # the edits win, they are written to the file later. Only remember that we saw this version of the file.
+                self.logger.warning(f"{name} in {contents.path} changed on disk, but has unwritten edits: keeping the edits")
+                img.set_fingerprint(scanned[name].stat)
+                conflicting_images.append(img)
+            else:
+                # changed outside of the app: start from a clean image, so metadata that was removed from the file is also cleared
+                reloaded = Image(id=img.id, parent=self, name=img.name, thumbnail=img.thumbnail)
+                reloaded.set_fingerprint(scanned[name].stat)
+                reloaded.load_metadata(json, metadata)
+                changed_images.append(reloaded)
 
         Image.objects.bulk_create(new_images, batch_size=100)
-        Directory.objects.bulk_create(new_dirs, batch_size=100)
-        
-        image_tags = [Image.tags.through(image_id=img.id, tag_id=tag.id) for img in new_images for tag in img._unsaved_tags]
+        Image.objects.bulk_update(changed_images, Image.METADATA_FIELDS + Image.FINGERPRINT_FIELDS, batch_size=100)
+        Image.objects.bulk_update(conflicting_images, Image.FINGERPRINT_FIELDS, batch_size=100)
+
+        # keep the raw metadata, so it can be shown and re-parsed without reading the files again
+        RawMetadata.objects.filter(image_id__in=[img.id for img in changed_images + conflicting_images]).delete()
+        RawMetadata.objects.bulk_create([RawMetadata.of(img, records_by_name[img.name]) for img in new_images + changed_images + conflicting_images], batch_size=100)
+
+        Image.tags.through.objects.filter(image_id__in=[img.id for img in changed_images]).delete()
+        image_tags = [Image.tags.through(image_id=img.id, tag_id=tag_id) for img in new_images + changed_images for tag_id in img._unsaved_tag_ids]
         Image.tags.through.objects.bulk_create(image_tags, batch_size=100)
 
-        # schedule refreshing thumbnails
-        for i in new_images:
-            i.refresh_thumbnail()
+        # the thumbnails are made in the background, the scan itself does not touch them
+        Image.refresh_thumbnails(new_images + changed_images + conflicting_images)
+
+    def apply_contents(self, contents: DirectoryContents):
+        """ Brings the rest of the DB in line with the contents that were read from disk: subdirs, attachments and
+        removed files. Must be called after the metadata of all images was applied. """
+        existing_images = {img.name: img for img in self.images.all()}
+        existing_dirs = {d.path: d for d in self.subdirs.all()}
+
+        # scanned before we kept fingerprints. The DB might contain edits that are not written to the file yet,
+        # so we don't want to overwrite those by re-reading the file. Just remember the fingerprint from now on.
+        refingerprinted_images : List[Image] = []
+        for entry in contents.images:
+            img = existing_images.get(entry.name)
+            if img is not None and not img.has_fingerprint():
+                img.set_fingerprint(entry.stat)
+                refingerprinted_images.append(img)
+        Image.objects.bulk_update(refingerprinted_images, Image.FINGERPRINT_FIELDS, batch_size=100)
+
+        new_dirs = [Directory(parent=self, path=name) for name in contents.subdirs if not name in existing_dirs]
+        Directory.objects.bulk_create(new_dirs, batch_size=100)
 
-        # create attachments
-        existing_images = self.images.all()
-        for entry in contents:
-            if self._is_attachment(entry):
-                related_image = self._find_related_image(existing_images, entry.name)
-                if related_image is not None and not related_image.attachments.filter(name=entry.name).exists():
-                    att = Attachment(parent=related_image, name=entry.name, attachment_type=FileType.from_path(entry.path).name)
+        # drop everything that is no longer on disk
+        removed_image_ids = [img.id for name, img in existing_images.items() if name not in contents.names]
+        removed_dir_ids = [d.id for path, d in existing_dirs.items() if path not in contents.names]
+        if removed_image_ids:
+            self.logger.info(f"Removing {len(removed_image_ids)} images from {contents.path} that no longer exist")
+            Image.objects.filter(pk__in=removed_image_ids).delete()
+        # drops the thumbnails of removed images and the ones that were replaced, if there are enough of them
+        self.compact_thumbnail_pack()
+        if removed_dir_ids:
+            self.logger.info(f"Removing {len(removed_dir_ids)} directories from {contents.path} that no longer exist")
+            Directory.objects.filter(pk__in=removed_dir_ids).delete()
+
+        # create attachments, or update the fingerprint of the ones we already know
+        new_attachments : List[Attachment] = []
+        changed_attachments : List[Attachment] = []
+        existing_attachments = {att.name: att for att in Attachment.objects.filter(parent__parent=self)}
+        matcher = AttachmentMatcher(self.images.all(), existing_attachments.keys())
+        for entry in contents.attachments:
+            if matcher.is_known(entry.name):
+                att = existing_attachments[entry.name]
+                if not att.fingerprint_matches(entry.stat):
+                    att.set_fingerprint(entry.stat)
+                    changed_attachments.append(att)
+            else:
+                related_image = matcher.find_related_image(entry.name)
+                if related_image is not None:
+                    att = Attachment(parent=related_image, name=entry.name, attachment_type=FileType.from_path(entry.name).name)
+                    att.set_fingerprint(entry.stat)
                     new_attachments.append(att)
         Attachment.objects.bulk_create(new_attachments, batch_size=100)
-
-        for d in self.subdirs.all():
-            d.scan(skip_dirs=skip_dirs) # don't set reload_metadata here because we deleted the subdirs above, no need to do that again
-
-        print("Scanned %s [%d], %ss" % (self.get_absolute_path(), self.id, time.time()-start))
+        Attachment.objects.bulk_update(changed_attachments, Attachment.FINGERPRINT_FIELDS, batch_size=100)
+        Attachment.objects.filter(pk__in=[att.id for name, att in existing_attachments.items() if name not in contents.names]).delete()
 
     def remove_from_db(self):
         Directory.objects.filter(id=self.id).delete()
@@ -224,11 +447,66 @@ class Directory(models.Model):
         else:
             return os.path.join(self.parent.get_absolute_path(), self.path)
 
-    def write_images_metadata(self):
-        for img in self.images.all():
+    def write_images_metadata(self, dry_run=False):
+        """ Writes the metadata of the images that were changed in the app, see write_metadata_of. """
+        images = list(self.images.filter(metadata_dirty=True).select_related('author').prefetch_related('tags', 'attachments'))
+        for img in images:
             if img.errors:
                 raise MetadataIncompleteError(img.name, img.errors)
-        ExifToolService.instance().write_metadata(self.get_absolute_path(), *self.images.all())
+        return self.write_metadata_of(images, dry_run)
+
+    def write_metadata_of(self, images, dry_run=False, workers=None):
+        """ Writes the metadata of the given images of this directory, but only the types that changed since the file was
+        last read or written, and only to the files (image or attachment) that support one of those types. Returns what
+        was (or with dry_run: would be) written: a list with the name, changed types and files of every image.
+        Images of which all files were written are marked clean even if others failed, after which a MetadataWriteError
+        tells which files failed. Images that were edited again while they were written (their MetadataWriteBack got a
+        new version) stay dirty, their new edits still have to be written. """
+        abs_path = self.get_absolute_path()
+        changed_types = {img.id: img.changed_metadata_types() for img in images}
+        plan = ExifToolService.instance().plan_metadata_write(abs_path, *images, changed_types=changed_types)
+        files_of = {img.id: [os.path.basename(path) for path in plan.files.get(img.id, [])] for img in images}
+        report = [{"image": img.name, "changed": sorted(t.name for t in changed_types[img.id]), "files": files_of[img.id]} for img in images if changed_types[img.id]]
+        if dry_run:
+            return report
+
+        write_backs = MetadataWriteBack.objects.filter(image_id__in=[img.id for img in images])
+        versions = dict(write_backs.values_list('image_id', 'version'))
+        result = ExifToolService.instance().write_planned(plan, workers)
+        failed = {os.path.basename(path) for path in result.failed}
+        done = [img for img in images if not failed.intersection(files_of[img.id])]
+        with transaction.atomic():
+            edited = {image_id for image_id, version in write_backs.values_list('image_id', 'version') if versions.get(image_id) != version}
+            for img in done:
+                img.metadata_dirty = img.id in edited
+                # what is in the files now
+                img.metadata_hashes = metadata_hashes(img.as_metadata())
+            Image.objects.bulk_update(done, ['metadata_dirty', 'metadata_hashes'], batch_size=100)
+        self.refresh_fingerprints([img for img in done if files_of[img.id]])
+
+        # sidecars we just created: make them attachments right away, otherwise the next scan sees them as a change
+        new_sidecars = []
+        for img in done:
+            attachment_names = {att.name for att in img.attachments.all()}
+            for name in files_of[img.id]:
+                if FileType.from_path(name) == FileType.SIDECAR and name not in attachment_names:
+                    att = Attachment(parent=img, name=name, attachment_type=FileType.SIDECAR.name)
+                    att.set_fingerprint(os.stat(os.path.join(abs_path, name)))
+                    new_sidecars.append(att)
+        Attachment.objects.bulk_create(new_sidecars, batch_size=100)
+        if not result.ok:
+            raise MetadataWriteError(result.failed)
+        return report
+
+    def refresh_fingerprints(self, images):
+        """ Re-reads the fingerprints of the given images (and their attachments) after we modified the files ourselves,
+        so the next scan does not see them as changed. """
+        abs_path = self.get_absolute_path()
+        attachments = [att for img in images for att in img.attachments.all()]
+        for f in [*images, *attachments]:
+            f.set_fingerprint(os.stat(os.path.join(abs_path, f.name)))
+        Image.objects.bulk_update(images, Image.FINGERPRINT_FIELDS, batch_size=100)
+        Attachment.objects.bulk_update(attachments, Attachment.FINGERPRINT_FIELDS, batch_size=100)
     
     def parse_tracks(self):
         abs_path = self.get_absolute_path()
@@ -273,23 +551,11 @@ class Directory(models.Model):
             idx = idx + 1
             img.rename_to_standard_format(idx)
 
-    def _is_image(self, dirEntry):
-        return dirEntry.is_file() and FileType.from_path(dirEntry.path) == FileType.MAIN_MEDIA
-
-    def _is_attachment(self, dirEntry):
-        return dirEntry.is_file() and FileType.from_path(dirEntry.path) != FileType.MAIN_MEDIA
-
-    def _find_related_image(self, images, path):
-        for i in images:
-            if os.path.splitext(path)[0] == os.path.splitext(i.name)[0]:
-                return i
-        return None
-
     def __str__(self):
         return self.get_absolute_path()
 
 
-class Image(models.Model):
+class Image(FingerprintedFile):
     logger = logging.getLogger(__name__)
 
     parent = models.ForeignKey(Directory, on_delete=models.CASCADE, related_name="images")
@@ -299,6 +565,15 @@ class Image(models.Model):
     # store the time offset, since DateTimeFields are stored in UTC...
     tz_offset = models.DurationField(null=True)
     thumbnail = models.FileField(upload_to=f"thumbnails", null=True)
+    # missing, pending, ready, failed. Thumbnails are made in the background after a scan, or when they are requested.
+    thumbnail_state = models.CharField(max_length=10, default='missing')
+    # identifies the contents of the thumbnail, see thumbnail_key. Thumbnail files are named after it.
+    thumbnail_key = models.CharField(max_length=32, null=True)
+    # when thumbnail_state last changed, so we know when to retry a failed one
+    thumbnail_updated = models.DateTimeField(null=True)
+    # with THUMBNAIL_PACKS: where the thumbnail is in the pack file of the directory, instead of in its own file
+    thumbnail_offset = models.BigIntegerField(null=True)
+    thumbnail_length = models.IntegerField(null=True)
     gps_longitude = models.FloatField(null=True)
     gps_latitude = models.FloatField(null=True)
     gps_altitude = models.FloatField(null=True)
@@ -308,6 +583,16 @@ class Image(models.Model):
     tags = models.ManyToManyField(Tag, related_name='tags')
     camera = models.ForeignKey(Camera, on_delete=models.SET_NULL, null=True)
     original_file_name = models.CharField(max_length=255, null=True)
+    # set when the metadata was changed in the app and is not written to the file yet
+    metadata_dirty = models.BooleanField(default=False)
+    # hash per MetadataType of the metadata as it was last read from or written to the file, see metadata_hashes
+    metadata_hashes = models.JSONField(null=True)
+
+    # how often _thumbnail_done tries to store where the thumbnail is, when the DB is busy
+    THUMBNAIL_DONE_ATTEMPTS = 3
+
+    # the fields that are filled in by load_metadata
+    METADATA_FIELDS = ['author', 'date_time_utc', 'tz_offset', 'gps_longitude', 'gps_latitude', 'gps_altitude', 'rating', 'pick_label', 'color_label', 'camera', 'original_file_name', 'metadata_dirty', 'metadata_hashes']
 
     class Meta:
         ordering = ["date_time_utc"]
@@ -317,11 +602,13 @@ class Image(models.Model):
         json = self.read_exif_json_from_file()
         self.load_metadata(json)
 
-    def load_metadata(self, json):
-        if not json["SourceFile"] == self.name:
+    def load_metadata(self, json, metadata: Metadata = None):
+        """ metadata is json already parsed, for callers that parse many records at once with parse_many. """
+        if not os.path.basename(json["SourceFile"]) == self.name:
             raise ValueError("metadata does not match this image: %s <> %s" % (json["SourceFile"], self.name))
 
-        metadata = MetadataParserService.instance().parse_metadata(json)
+        if metadata is None:
+            metadata = MetadataParserService.instance().parse_metadata(json)
 
         if metadata.artist:  # check for empty string
             new_auth = Author.objects.filter(name=metadata.artist).first()
@@ -349,33 +636,136 @@ class Image(models.Model):
             if metadata.altitude is not None:
                 self.gps_altitude = metadata.altitude
         
-        self._unsaved_tags = []
+        self._unsaved_tag_ids = []
         if metadata.tags: # check for empty list
             for tag in metadata.tags:
-                db_tag = Tag.find_hierarchical_tag(None, tag)
-                if db_tag:
+                tag_id = TagIndex.instance().find(tag)
+                if tag_id is not None:
                     # cannot append to self.tags here, since this object is probably not saved to the DB yet, so does not have an id
-                    self._unsaved_tags.append(db_tag)
+                    self._unsaved_tag_ids.append(tag_id)
+                else:
+                    self.logger.warning(f"Unknown tag {tag} in {self.name}, ignoring it")
         
         self.camera = CameraMatcherService.instance().find_matching_camera(metadata.camera_manufacturer, metadata.camera_model, metadata.camera_serial)
-        self.logger.info(f'Picture taken by camera: {self.camera}')
+        self.logger.info('Picture taken by camera: %s', self.camera)
 
         if metadata.original_file_name:
             self.original_file_name = metadata.original_file_name
         else:
             self.original_file_name = self.name
 
-    def create_dummy_thumbnail(self):
-        try:
-            img_raw = ThumbnailService.instance().create_dummy_thumbnail()
-            thumbnail_path = Path(f"{self.parent.id}/{self.name}").with_suffix('.jpg')
-            self.thumbnail = File(img_raw, name=thumbnail_path)
-        except Exception as err:
-            self.logger.warn(f"Could not create thumbnail for {self.name}: {err}")
+        # this is what the file contains now
+        self.metadata_dirty = False
+        self.metadata_hashes = metadata_hashes(self.as_metadata([TagIndex.instance().full_name(tag_id) for tag_id in self._unsaved_tag_ids]))
+
+    def as_metadata(self, tag_names=None) -> Metadata:
+        """ The metadata as it should be written to the file. tag_names can be given for an image without tags in the DB yet. """
+        tags_text = set(tag_names) if tag_names is not None else set(map(lambda t: t.full_name, self.tags.all()))
+        return Metadata(self.date_time, self.rating, self.pick_label, self.color_label, tags_text, self.author.name if self.author else None, self.gps_longitude, self.gps_latitude, self.gps_altitude, None, None, None, self.original_file_name)
+
+    def changed_metadata_types(self):
+        return changed_metadata_types(self.metadata_hashes, metadata_hashes(self.as_metadata()))
+
+    def thumbnail_source(self) -> str:
+        """ The path of the file the thumbnail is made of """
+        return os.path.join(self.parent.get_absolute_path(), self.name)
 
     def refresh_thumbnail(self):
-        path = os.path.join(self.parent.get_absolute_path(), self.name)
-        ThumbnailService.instance().create_thumbnail_async(path, self.thumbnail)
+        Image.refresh_thumbnails([self])
+
+    @classmethod
+    def refresh_thumbnails(cls, images, urgent=False):
+        """ Marks the thumbnails of these saved images as pending, and queues them once the current transaction is
+        committed: queueing can block until the thumbnail workers caught up, which should not happen while we hold a
+        transaction. """
+        Image.objects.filter(id__in=[img.id for img in images]).update(thumbnail_state='pending', thumbnail_updated=django_timezone.now())
+        storage = Image.thumbnail.field.storage
+        jobs = [(img.id, img.parent_id, img.thumbnail_source(), img.fingerprint if img.has_fingerprint() else None) for img in images]
+
+        def submit():
+            service = ThumbnailService.instance()
+            for image_id, directory_id, path, fingerprint in jobs:
+                service.create_thumbnail_async(path, storage, directory_id, on_done=partial(Image._thumbnail_done, image_id), urgent=urgent, image_id=image_id, fingerprint=fingerprint)
+        transaction.on_commit(submit)
+
+    @staticmethod
+    def _thumbnail_done(image_id, key=None, name=None, offset=None, length=None):
+        """ Called by the ThumbnailService, on one of its threads, with the key of the thumbnail and the name it was
+        saved as or where it is in the pack of the directory. """
+        try:
+            for attempt in range(Image.THUMBNAIL_DONE_ATTEMPTS):
+                try:
+                    Image._store_thumbnail_location(image_id, key, name, offset, length)
+                    return
+                except OperationalError as exc:
+                    # e.g. "database is locked" while a scan writes: otherwise the image stays pending until it is viewed
+                    if attempt == Image.THUMBNAIL_DONE_ATTEMPTS - 1:
+                        raise
+                    Image.logger.warning(f"Could not store the thumbnail of image {image_id}, trying again: {exc}")
+                    time.sleep(attempt + 1)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _store_thumbnail_location(image_id, key, name, offset, length):
+        if key is None:
+            Image.objects.filter(id=image_id).update(thumbnail_state='failed', thumbnail_updated=django_timezone.now())
+            return
+        old_name = Image.objects.filter(id=image_id).values_list('thumbnail', flat=True).first()
+        if offset is not None:
+            Image.objects.filter(id=image_id).update(thumbnail=None, thumbnail_key=key, thumbnail_offset=offset, thumbnail_length=length, thumbnail_state='ready', thumbnail_updated=django_timezone.now())
+        else:
+            Image.objects.filter(id=image_id).update(thumbnail=name, thumbnail_key=key, thumbnail_offset=None, thumbnail_length=None, thumbnail_state='ready', thumbnail_updated=django_timezone.now())
+        # the previous one, or this one when the image was removed while we were making it
+        Image.delete_unused_thumbnail(old_name if old_name != name else None)
+        Image.delete_unused_thumbnail(name)
+
+    @staticmethod
+    def delete_unused_thumbnail(name):
+        """ Thumbnail files are shared by identical images, so one can only go when no image uses it anymore. The same
+        goes for the thumbnail in the other formats. """
+        if name and not Image.objects.filter(thumbnail=name).exists():
+            base = os.path.splitext(name)[0]
+            for extension in EXTENSIONS.values():
+                Image.thumbnail.field.storage.delete(f"{base}.{extension}")
+
+    def has_stored_thumbnail(self) -> bool:
+        if self.thumbnail_offset is not None:
+            return ThumbnailService.instance().pack(self.parent_id).contains(self.id, self.thumbnail_offset, self.thumbnail_length)
+        return bool(self.thumbnail) and self.thumbnail.storage.exists(self.thumbnail.name)
+
+    def read_thumbnail(self) -> bytes:
+        """ The stored thumbnail, None if there is none """
+        if self.thumbnail_offset is not None:
+            return ThumbnailService.instance().pack(self.parent_id).read(self.id, self.thumbnail_offset, self.thumbnail_length)
+        if not self.thumbnail:
+            return None
+        try:
+            with self.thumbnail.open("rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def ensure_thumbnail(self, timeout: float) -> bool:
+        """ Whether the thumbnail is ready. If it is not, it is made before anything else, and we wait up to timeout
+        seconds for it. A failed one is retried THUMBNAIL_RETRY_DELAY seconds after the last attempt. """
+        if self.thumbnail_state == 'ready' and self.has_stored_thumbnail():
+            return True
+        service = ThumbnailService.instance()
+        if not service.is_queued(self.thumbnail_source()):
+            if not self.thumbnail_retry_due():
+                return False
+            # missing, removed from disk, or pending in a queue that was lost when the app stopped
+            Image.refresh_thumbnails([self], urgent=True)
+        if not service.wait(self.thumbnail_source(), timeout):
+            return False
+        self.refresh_from_db(fields=['thumbnail', 'thumbnail_key', 'thumbnail_state', 'thumbnail_updated', 'thumbnail_offset', 'thumbnail_length'])
+        return self.thumbnail_state == 'ready'
+
+    def thumbnail_retry_due(self) -> bool:
+        if self.thumbnail_state != 'failed' or self.thumbnail_updated is None:
+            return True
+        return django_timezone.now() - self.thumbnail_updated >= timedelta(seconds=getattr(settings, 'THUMBNAIL_RETRY_DELAY', 3600))
     
     def rename_to_standard_format(self, idx):
         if self.original_file_name and self.camera:
@@ -465,34 +855,167 @@ class Image(models.Model):
         return self.mime_type.startswith('video/')
     
     def read_exif_json_from_file(self):
-        return ExifToolService.instance().read_metadata(self.parent.get_absolute_path(), self)[0]
+        json = next(ExifToolService.instance().read_metadata(self.parent.get_absolute_path(), self), None)
+        if json is None:
+            raise ValueError("exiftool cannot read the metadata of %s" % self.name)
+        return json
+
+    def read_raw_metadata(self):
+        """ All metadata exiftool has for this file. Served from the RawMetadata of the image if the file did not change
+        since it was read, otherwise the file is read again and the result is kept for the next time. """
+        stat = os.stat(os.path.join(self.parent.get_absolute_path(), self.name))
+        raw = RawMetadata.objects.filter(image=self).first()
+        if raw is not None and raw.complete and raw.fingerprint_matches(stat):
+            return raw.json
+        json = self.read_exif_json_from_file()
+        raw = RawMetadata.of(self, json)
+        raw.set_fingerprint(stat)
+        raw.save()
+        return json
 
     def write_metadata(self):
         if self.errors:
             raise MetadataIncompleteError(self.name, self.errors)
         else:
-            ExifToolService.instance().write_metadata(self.parent.get_absolute_path(), self)
+            self.parent.write_metadata_of([self])
 
     def __str__(self):
         return os.path.join(self.parent.get_absolute_path(), self.name)
 
+@receiver(models.signals.post_delete, sender=Directory)
+def delete_thumbnail_pack(sender, instance, **kwargs):
+    ThumbnailService.instance().delete_pack(instance.id)
+
+
 @receiver(models.signals.post_delete, sender=Image)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
     """
     Deletes file from filesystem when corresponding Image object is deleted.
     """
     if instance.thumbnail:
-        if os.path.isfile(instance.thumbnail.path):
-            os.remove(instance.thumbnail.path)
+        Image.delete_unused_thumbnail(instance.thumbnail.name)
+
+
+class RawMetadata(FingerprintedFile):
+    """ The raw exiftool JSON of an image, zlib compressed, together with the fingerprint the file had when it was
+    read. As long as the fingerprint matches, this can be used instead of reading the file again. """
+    image = models.OneToOneField(Image, on_delete=models.CASCADE, primary_key=True, related_name="raw_metadata")
+    data = models.BinaryField()
+    # False if it was read by the native reader, which only returns the tags the metadata parsers need
+    complete = models.BooleanField(default=True)
 
+    @classmethod
+    def of(cls, image: Image, json: dict) -> 'RawMetadata':
+        """ Keeps the given metadata of the image, which must have been read when the file had the fingerprint that
+        the image has now. """
+        raw = cls(image=image, data=zlib.compress(json_module.dumps(json).encode("utf-8")), complete="ExifTool:ExifToolVersion" in json)
+        raw.file_size, raw.file_mtime_ns, raw.file_inode = image.fingerprint
+        return raw
+
+    @property
+    def json(self):
+        return json_module.loads(zlib.decompress(self.data))
 
-class Attachment(models.Model):
+
+class Attachment(FingerprintedFile):
     parent = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="attachments")
     name = models.CharField(max_length=255)
     attachment_type = models.CharField(max_length=50)
 
 
+class MetadataWriteBack(models.Model):
+    """ An image of which the metadata still has to be written to its files by the WriteBackService. There is one row
+    per image, so repeated edits are coalesced into one write. """
+    image = models.OneToOneField(Image, on_delete=models.CASCADE, related_name="write_back")
+    status = models.CharField(max_length=10, default='pending') # pending, writing, failed
+    # not written before this time, every edit pushes it back
+    due = models.DateTimeField()
+    # incremented by every edit, so we can tell whether the image was edited again while we were writing it
+    version = models.IntegerField(default=0)
+    error = models.TextField(null=True)
+    # when a worker started writing it, renewed as the worker goes. Rows it has been writing for too long are left over
+    # by a worker that stopped, another worker takes those over.
+    claimed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        ordering = ["due"]
+
+
+class ScanJob(models.Model):
+    """ A scan running in the background. Every directory that is completely scanned is remembered, so a cancelled or
+    crashed scan can be resumed without redoing those. """
+    directory = models.ForeignKey(Directory, on_delete=models.CASCADE, related_name="scan_jobs")
+    reload_metadata = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, default='queued') # queued, running, done, cancelled, failed
+    cancel_requested = models.BooleanField(default=False)
+    error = models.TextField(null=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    dirs_found = models.IntegerField(default=0)
+    dirs_done = models.IntegerField(default=0)
+    files_found = models.IntegerField(default=0)
+    files_processed = models.IntegerField(default=0)
+    # files_processed when this run started, so the speed is not skewed by a previous run after resuming
+    files_processed_at_start = models.IntegerField(default=0)
+    completed_dirs = models.ManyToManyField(Directory, related_name="+")
+
+    PROGRESS_FIELDS = ['dirs_found', 'dirs_done', 'files_found', 'files_processed']
+
+    def start(self):
+        self.status = 'running'
+        self.started = django_timezone.now()
+        self.finished = None
+        self.error = None
+        # when resuming, whatever was found but not processed yet will be found again
+        self.dirs_found = self.dirs_done
+        self.files_found = self.files_processed
+        self.files_processed_at_start = self.files_processed
+        self.save(update_fields=['status', 'started', 'finished', 'error', 'files_processed_at_start'] + self.PROGRESS_FIELDS)
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished = django_timezone.now()
+        self.save(update_fields=['status', 'error', 'finished'] + self.PROGRESS_FIELDS)
+
+    def check_cancelled(self):
+        if ScanJob.objects.filter(pk=self.pk, cancel_requested=True).exists():
+            raise ScanCancelledError(f"Scan of {self.directory} was cancelled")
+
+    def on_listed(self, contents: DirectoryContents):
+        self.dirs_found = self.dirs_found + 1
+        self.files_found = self.files_found + len(contents.to_read)
+
+    def on_metadata(self, records: List[dict]):
+        self.files_processed = self.files_processed + len(records)
+
+    def on_directory_done(self, directory):
+        self.dirs_done = self.dirs_done + 1
+        self.completed_dirs.add(directory)
+
+    def save_progress(self):
+        self.save(update_fields=self.PROGRESS_FIELDS)
+
+    @property
+    def files_per_second(self):
+        if self.started is None:
+            return None
+        elapsed = ((self.finished or django_timezone.now()) - self.started).total_seconds()
+        return (self.files_processed - self.files_processed_at_start) / elapsed if elapsed > 0 else None
+
+    @property
+    def eta_seconds(self):
+        """ Estimate only: files_found still grows while new directories are discovered. """
+        if self.status != 'running' or not self.files_per_second:
+            return None
+        return (self.files_found - self.files_processed) / self.files_per_second
+
+    def __str__(self):
+        return f"Scan of {self.directory} ({self.status})"
+
+
 class ImageSetService:
+    """ The metadata mutations mark the images dirty and queue them for the WriteBackService. """
     __instance = None
     logger = logging.getLogger(__name__)
 
@@ -507,13 +1030,15 @@ class ImageSetService:
     def overwrite_timezone(self, image_ids, tz_minutes):
         self.logger.info(f"Setting time zone to '{tz_minutes}' for images {image_ids}")
         images = Image.objects.filter(pk__in = image_ids, date_time_utc__isnull=False)
-        images.update(tz_offset = timedelta(minutes=tz_minutes), date_time_utc = F('date_time_utc') + Cast(Coalesce(F('tz_offset'), 0), output_field=models.DurationField()) - timedelta(minutes=tz_minutes))
+        images.update(tz_offset = timedelta(minutes=tz_minutes), date_time_utc = F('date_time_utc') + Cast(Coalesce(F('tz_offset'), 0), output_field=models.DurationField()) - timedelta(minutes=tz_minutes), metadata_dirty=True)
+        WriteBackService.instance().enqueue(image_ids)
     
     def translate_timezone(self, image_ids, tz_minutes):
         images = Image.objects.filter(pk__in = image_ids, date_time_utc__isnull=False, tz_offset__isnull=False)
         # below should really just be F('tz_offset') + timedelta(minutes=tz_minutes) but then django seems to think the output needs to be a
         # DateTimeField and things get messed up.
-        images.update(tz_offset = Cast(F('tz_offset'), output_field=models.IntegerField()) + Cast(timedelta(minutes=tz_minutes), output_field=models.IntegerField()), date_time_utc = F('date_time_utc') - timedelta(minutes=tz_minutes))
+        images.update(tz_offset = Cast(F('tz_offset'), output_field=models.IntegerField()) + Cast(timedelta(minutes=tz_minutes), output_field=models.IntegerField()), date_time_utc = F('date_time_utc') - timedelta(minutes=tz_minutes), metadata_dirty=True)
+        WriteBackService.instance().enqueue(image_ids)
     
     def overwrite_timezone_with_named(self, image_ids, named_zone):
         self.logger.info(f"Setting time zone to '{named_zone}' for images {image_ids}")
@@ -527,16 +1052,20 @@ class ImageSetService:
                 else:
                     img.date_time_utc = img.date_time_utc - new_offset
                 img.tz_offset = new_offset
+                img.metadata_dirty = True
                 img.save()
+        WriteBackService.instance().enqueue(image_ids)
     
     def shift_time(self, image_ids, minutes):
         images = Image.objects.filter(pk__in = image_ids, date_time_utc__isnull=False)
-        images.update(date_time_utc = F('date_time_utc') + timedelta(minutes=minutes))
+        images.update(date_time_utc = F('date_time_utc') + timedelta(minutes=minutes), metadata_dirty=True)
+        WriteBackService.instance().enqueue(image_ids)
 
     def set_author(self, image_ids, author):
         self.logger.info(f"Setting author to '{author}' for images {image_ids}")
         images = Image.objects.filter(pk__in = image_ids)
-        images.update(author=author)
+        images.update(author=author, metadata_dirty=True)
+        WriteBackService.instance().enqueue(image_ids)
     
     def set_camera(self, image_ids, camera):
         self.logger.info(f"Setting camera to '{camera}' for images {image_ids}")
@@ -571,7 +1100,9 @@ class ImageSetService:
             image.gps_longitude=lon
             image.gps_latitude=lat
             image.gps_altitude=alt
+            image.metadata_dirty=True
             image.save()
+        WriteBackService.instance().enqueue(image_ids)
     
     def set_coordinates(self, image_ids, latitude, longitude, overwrite):
         self.logger.info(f"Setting coordinates for {image_ids} with overwrite {overwrite} to {latitude}, {longitude}")
@@ -580,22 +1111,26 @@ class ImageSetService:
         else:
             images = Image.objects.filter(pk__in = image_ids, gps_longitude__isnull=True, gps_latitude__isnull=True)
         
-        images.update(gps_latitude=latitude, gps_longitude=longitude, gps_altitude=None)
+        images.update(gps_latitude=latitude, gps_longitude=longitude, gps_altitude=None, metadata_dirty=True)
+        WriteBackService.instance().enqueue(image_ids)
 
     def set_rating(self, image_ids, rating):
         self.logger.info(f"Setting rating for {image_ids} to {rating}")
         images = Image.objects.filter(pk__in = image_ids)
-        images.update(rating = rating)
+        images.update(rating = rating, metadata_dirty = True)
+        WriteBackService.instance().enqueue(image_ids)
     
     def set_pick_label(self, image_ids, pick_label):
         self.logger.info(f"Setting PickLabel for {image_ids} to {pick_label}")
         images = Image.objects.filter(pk__in = image_ids)
-        images.update(pick_label = pick_label)
+        images.update(pick_label = pick_label, metadata_dirty = True)
+        WriteBackService.instance().enqueue(image_ids)
     
     def set_color_label(self, image_ids, color_label):
         self.logger.info(f"Setting ColorLabel for {image_ids} to {color_label}")
         images = Image.objects.filter(pk__in = image_ids)
-        images.update(color_label = color_label)
+        images.update(color_label = color_label, metadata_dirty = True)
+        WriteBackService.instance().enqueue(image_ids)
 
     def set_tags(self, image_ids, tagIds):
         self.logger.info(f"Setting Tags for {image_ids} to {tagIds}")
@@ -603,9 +1138,14 @@ class ImageSetService:
         images = Image.objects.filter(pk__in = image_ids)
         for image in images:
             image.tags.set(tags)
+        images.update(metadata_dirty = True)
+        WriteBackService.instance().enqueue(image_ids)
     
     def remove_from_db(self, image_ids):
+        directory_ids = set(Image.objects.filter(pk__in = image_ids).values_list('parent_id', flat=True))
         Image.objects.filter(pk__in = image_ids).delete()
+        for directory in Directory.objects.filter(id__in=directory_ids):
+            directory.compact_thumbnail_pack()
 
     def organize_in_directories(self, image_ids):
         self.logger.info(f"Organize in directories for {image_ids}")
@@ -631,6 +1171,485 @@ class ImageSetService:
                     rename_safely(os.path.join(old_parent_dir, att.name), os.path.join(new_parent_dir, att.name))
 
 
+class ScanService:
+    """ Scans directory trees with a pool of workers. The workers only read from disk (directory listings and exiftool)
+    and hand their results over in chunks. All DB changes are done by the calling thread, grouped in transactions.
+    This gives the same result as Directory.scan. """
+    __instance = None
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is not None:
+            return cls.__instance
+        else:
+            cls.__instance = ScanService()
+            return cls.__instance
+
+    def __init__(self):
+        self.workers = getattr(settings, 'SCAN_WORKERS', 4)
+
+    def read_directory(self, directory, abs_path, known_files, skip_dirs, results: Queue):
+        """ Runs on a worker thread: must not touch the DB. """
+        try:
+            contents = DirectoryContents.read(abs_path, known_files, skip_dirs, ExifToolService.instance().reads_sidecar)
+            results.put(('listed', directory, contents, None))
+            for records in ExifToolService.instance().read_metadata_chunks(abs_path, *contents.to_read, fast=True):
+                results.put(('metadata', directory, contents, records))
+            results.put(('done', directory, contents, None))
+        except BaseException as exc:
+            results.put(('error', directory, None, exc))
+
+    def scan(self, directory, reload_metadata=False, skip_dirs = [], workers=None, job=None, recursive=True):
+        """ If a ScanJob is given, its progress is kept up to date, the directories it already completed are skipped and
+        a ScanCancelledError is raised when it gets cancelled. """
+        start = time.time()
+        if reload_metadata:
+            directory.images.all().delete()
+            directory.subdirs.all().delete()
+
+        workers = workers or self.workers
+        # bounded, so the workers wait for us instead of piling up exiftool output in memory
+        results = Queue(maxsize=workers * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+
+            completed_dirs = set(job.completed_dirs.values_list('id', flat=True)) if job is not None else set()
+
+            def submit(d):
+                """ Returns the number of directories that will be read """
+                if d.id in completed_dirs:
+                    # done in a previous run of the job, only its subdirs might still need work
+                    return sum(submit(subdir) for subdir in d.subdirs.all())
+                futures.append(executor.submit(self.read_directory, d, d.get_absolute_path(), d.known_fingerprints(), skip_dirs, results))
+                return 1
+
+            outstanding = submit(directory)
+            dir_count = 0
+            try:
+                while outstanding:
+                    # everything that is ready is written in one go
+                    messages = [results.get()]
+                    while not results.empty():
+                        messages.append(results.get())
+                    with transaction.atomic():
+                        for kind, d, contents, payload in messages:
+                            if kind == 'error':
+                                raise payload
+                            elif kind == 'listed':
+                                if job is not None:
+                                    job.on_listed(contents)
+                            elif kind == 'metadata':
+                                d.apply_metadata(contents, payload)
+                                if job is not None:
+                                    job.on_metadata(payload)
+                            else:
+                                d.apply_contents(contents)
+                                outstanding = outstanding - 1
+                                dir_count = dir_count + 1
+                                if job is not None:
+                                    job.on_directory_done(d)
+                                if recursive:
+                                    for subdir in d.subdirs.all():
+                                        outstanding = outstanding + submit(subdir)
+                        if job is not None:
+                            job.save_progress()
+                    if job is not None:
+                        job.check_cancelled()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                # unblock the workers that are still running, so the executor can shut down
+                while any(not f.done() for f in futures):
+                    try:
+                        results.get(timeout=0.1)
+                    except Empty:
+                        pass
+                raise
+
+        self.logger.info(f"Scanned {dir_count} directories under {directory} in {time.time() - start:.2f}s")
+
+
+class ScanJobService:
+    """ Runs ScanJobs in the background, one at a time. """
+    __instance = None
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is not None:
+            return cls.__instance
+        else:
+            cls.__instance = ScanJobService()
+            return cls.__instance
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.active_jobs = set()
+        self.lock = threading.Lock()
+
+    def submit(self, directory, reload_metadata=False) -> ScanJob:
+        job = ScanJob(directory=directory, reload_metadata=reload_metadata)
+        job.save()
+        self._schedule(job)
+        return job
+
+    def resume(self, job: ScanJob):
+        if job.status == 'done' or self.is_active(job):
+            raise ValueError(f"Cannot resume {job}")
+        job.status = 'queued'
+        job.cancel_requested = False
+        job.save()
+        self._schedule(job)
+
+    def cancel(self, job: ScanJob):
+        ScanJob.objects.filter(pk=job.pk).update(cancel_requested=True)
+
+    def is_active(self, job: ScanJob):
+        with self.lock:
+            return job.pk in self.active_jobs
+
+    def _schedule(self, job: ScanJob):
+        with self.lock:
+            self.active_jobs.add(job.pk)
+        self.executor.submit(self._run, job.pk)
+
+    def _run(self, job_id):
+        try:
+            self._run_job(ScanJob.objects.get(pk=job_id))
+        except Exception as exc:
+            self.logger.error(exc, exc_info=True)
+        finally:
+            with self.lock:
+                self.active_jobs.discard(job_id)
+            # this runs on our own thread, so django won't clean up the connection for us
+            connection.close()
+
+    def _run_job(self, job: ScanJob):
+        try:
+            job.check_cancelled()
+            # only delete everything on the first run, when resuming we would throw away the work that was done
+            reload_metadata = job.reload_metadata and job.dirs_done == 0
+            job.start()
+            CameraMatcherService.instance().reload_cameras()
+            skip_dirs = StringSetting.objects.get_multiple(name="skip_dirs")
+            ScanService.instance().scan(job.directory, reload_metadata, skip_dirs = skip_dirs, job=job)
+            job.finish('done')
+        except ScanCancelledError:
+            job.finish('cancelled')
+        except Exception as exc:
+            self.logger.error(exc, exc_info=True)
+            job.finish('failed', repr(exc))
+
+
+class DirectoryWatcherService:
+    """ Watches all directories in the DB with inotify (Linux only) and scans the directories in which something
+    changed. Events are debounced per directory, so copying a whole card results in a few scans instead of one per
+    file. Renames within the watched trees only update the DB, the scan then sees an unchanged file. The watcher never
+    touches the files themselves: attachments that are moved along with their image keep their rows, the ones left
+    behind are sorted out by the scans. """
+    logger = logging.getLogger(__name__)
+
+    WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB | inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM
+        | inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+
+    def __init__(self, debounce_seconds=None):
+        self.debounce_seconds = debounce_seconds if debounce_seconds is not None else getattr(settings, 'WATCHER_DEBOUNCE_SECONDS', 2)
+        self.inotify = inotify.Inotify()
+        self.watches = {}  # wd -> directory id
+        self.watched_dirs = {}  # directory id -> wd
+        # directory id -> (time of last event, scan recursively)
+        self.pending = {}
+        # cookie -> (directory id, name) of IN_MOVED_FROM events that we didn't see the IN_MOVED_TO of yet
+        self.moved_from = {}
+
+    def run(self, stop_event: threading.Event = None):
+        self.refresh_watches()
+        try:
+            while stop_event is None or not stop_event.is_set():
+                for event in self.inotify.read_events(timeout=0.5):
+                    self._handle(event)
+                self._flush()
+        finally:
+            self.inotify.close()
+
+    def refresh_watches(self):
+        """ Makes sure every directory in the DB is watched. """
+        dirs = {d.id: d for d in Directory.objects.all()}
+        paths = {}
+
+        def abs_path(d):
+            if d.id not in paths:
+                paths[d.id] = d.path if d.parent_id is None else os.path.join(abs_path(dirs[d.parent_id]), d.path)
+            return paths[d.id]
+
+        for dir_id, d in dirs.items():
+            if dir_id not in self.watched_dirs:
+                try:
+                    wd = self.inotify.add_watch(abs_path(d), self.WATCH_MASK)
+                except OSError as err:
+                    self.logger.warning(f"Cannot watch {abs_path(d)}: {err}")
+                    continue
+                self.watches[wd] = dir_id
+                self.watched_dirs[dir_id] = wd
+        for dir_id in [dir_id for dir_id in self.watched_dirs if dir_id not in dirs]:
+            wd = self.watched_dirs.pop(dir_id)
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def _handle(self, event: inotify.InotifyEvent):
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            self.logger.warning("Lost inotify events, rescanning everything")
+            for root in Directory.objects.filter(parent=None):
+                self._touch(root.id, recursive=True)
+            return
+        dir_id = self.watches.get(event.wd)
+        if dir_id is None:
+            return
+        if event.mask & inotify.IN_IGNORED:
+            # the directory itself is gone, the scan of its parent will remove it from the DB
+            del self.watches[event.wd]
+            del self.watched_dirs[dir_id]
+            return
+
+        if event.mask & inotify.IN_MOVED_FROM:
+            self.moved_from[event.cookie] = (dir_id, event.name)
+        elif event.mask & inotify.IN_MOVED_TO and event.cookie in self.moved_from:
+            from_dir_id, from_name = self.moved_from.pop(event.cookie)
+            if not event.mask & inotify.IN_ISDIR:
+                self._rename(from_dir_id, from_name, dir_id, event.name)
+        # a new directory might already contain files by the time we watch it, so scan it completely
+        self._touch(dir_id, recursive=bool(event.mask & inotify.IN_ISDIR))
+
+    def _touch(self, dir_id, recursive=False):
+        _, was_recursive = self.pending.get(dir_id, (None, False))
+        self.pending[dir_id] = (time.monotonic(), recursive or was_recursive)
+
+    def _rename(self, from_dir_id, from_name, to_dir_id, to_name):
+        img = Image.objects.filter(parent_id=from_dir_id, name=from_name).first()
+        if img is not None and FileType.from_path(to_name) == FileType.MAIN_MEDIA:
+            self.logger.info(f"{from_name} was renamed to {to_name}")
+            img.parent_id = to_dir_id
+            img.name = to_name
+            img.save(update_fields=['parent', 'name'])
+        else:
+            self._rename_attachment(from_dir_id, from_name, to_dir_id, to_name)
+
+    def _rename_attachment(self, from_dir_id, from_name, to_dir_id, to_name):
+        att = Attachment.objects.filter(parent__parent_id=from_dir_id, name=from_name).select_related('parent').first()
+        if att is None and from_dir_id != to_dir_id:
+            # moved after its image, e.g. by mv IMG_1.JPG IMG_1.RAF dest/: the image took the row along already
+            att = Attachment.objects.filter(parent__parent_id=to_dir_id, name=from_name).select_related('parent').first()
+        # one that was moved away from its image is left to the scans of both directories
+        if att is not None and att.parent.parent_id == to_dir_id:
+            att.name = to_name
+            att.save(update_fields=['name'])
+
+    def _flush(self):
+        now = time.monotonic()
+        ready = [(dir_id, recursive) for dir_id, (last_event, recursive) in self.pending.items() if now - last_event >= self.debounce_seconds]
+        if not ready:
+            return
+        # moves that were not matched within the debounce time went out of the watched trees, the scans will clean up
+        self.moved_from.clear()
+        CameraMatcherService.instance().reload_cameras()
+        skip_dirs = StringSetting.objects.get_multiple(name="skip_dirs")
+        for dir_id, recursive in ready:
+            del self.pending[dir_id]
+            directory = Directory.objects.filter(pk=dir_id).first()
+            if directory is None:
+                continue
+            try:
+                ScanService.instance().scan(directory, skip_dirs = skip_dirs, recursive=recursive)
+            except Exception as exc:
+                self.logger.error(exc, exc_info=True)
+        self.refresh_watches()
+
+
+class MetadataReparseService:
+    """ Re-runs the metadata parsers on the RawMetadata of all images, e.g. after a parser changed. This does not read
+    any files: images of which the file changed since the metadata was kept are skipped, those need a rescan. Like a
+    rescan of a changed file, this overwrites the metadata in the DB with the metadata of the file, except for images
+    with edits that were not written to their file yet: those are skipped too, unless discard_edits is set. """
+    __instance = None
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is not None:
+            return cls.__instance
+        else:
+            cls.__instance = MetadataReparseService()
+            return cls.__instance
+
+    def reparse(self, batch_size=500, progress=None, discard_edits=False):
+        """ Returns the number of images that were re-parsed and the number that had to be skipped. progress is called
+        with those numbers after every batch. """
+        CameraMatcherService.instance().reload_cameras()
+        reparsed = 0
+        skipped = 0
+        last_id = 0
+        while True:
+            batch = list(Image.objects.filter(id__gt=last_id).select_related('raw_metadata').order_by('id')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            images = []
+            records = []
+            for img in batch:
+                raw = getattr(img, 'raw_metadata', None)
+                if raw is None or raw.fingerprint != img.fingerprint or not img.has_fingerprint() or (img.metadata_dirty and not discard_edits):
+                    skipped = skipped + 1
+                    continue
+                json = raw.json
+                if os.path.basename(json["SourceFile"]) != img.name:
+                    # renamed by us after it was read
+                    skipped = skipped + 1
+                    continue
+                # start from a clean image, the same as a rescan does
+                images.append(Image(id=img.id, parent_id=img.parent_id, name=img.name))
+                records.append(json)
+            for reparsed_img, json, metadata in zip(images, records, MetadataParserService.instance().parse_many(records)):
+                reparsed_img.load_metadata(json, metadata)
+
+            with transaction.atomic():
+                if not discard_edits:
+                    # edited while we were parsing
+                    edited = set(Image.objects.filter(id__in=[img.id for img in images], metadata_dirty=True).values_list('id', flat=True))
+                    skipped = skipped + len(edited)
+                    images = [img for img in images if img.id not in edited]
+                Image.objects.bulk_update(images, Image.METADATA_FIELDS, batch_size=100)
+                Image.tags.through.objects.filter(image_id__in=[img.id for img in images]).delete()
+                image_tags = [Image.tags.through(image_id=img.id, tag_id=tag_id) for img in images for tag_id in img._unsaved_tag_ids]
+                Image.tags.through.objects.bulk_create(image_tags, batch_size=100)
+            reparsed = reparsed + len(images)
+            if progress is not None:
+                progress(reparsed, skipped)
+        return reparsed, skipped
+
+
+class WriteBackService:
+    """ Writes the metadata of edited images back to their files in the background, when METADATA_WRITE_BACK is on.
+    Every ImageSetService mutation queues the images it changed, and an image is written once it was not edited for
+    METADATA_WRITE_BACK_DELAY seconds, so a burst of edits results in a single write. The queue is kept in the DB
+    (MetadataWriteBack), so it survives restarts. The worker runs on a thread of the web server, started by the first
+    edit or status request, or on its own with `manage.py write_back`. """
+    __instance = None
+    logger = logging.getLogger(__name__)
+
+    BATCH_SIZE = 200
+    # rows that are writing for longer than this are left over by a worker that stopped
+    CLAIM_TIMEOUT = timedelta(hours=1)
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is not None:
+            return cls.__instance
+        else:
+            cls.__instance = WriteBackService()
+            return cls.__instance
+
+    def __init__(self):
+        self.enabled = getattr(settings, 'METADATA_WRITE_BACK', False)
+        self.delay = getattr(settings, 'METADATA_WRITE_BACK_DELAY', 10)
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def enqueue(self, image_ids):
+        if not self.enabled:
+            return
+        due = django_timezone.now() + timedelta(seconds=self.delay)
+        queued = MetadataWriteBack.objects.filter(image_id__in=image_ids)
+        # a row that is being written stays claimed by its writer, which sees the new version and queues it again
+        queued.update(status=Case(When(status='writing', then=F('status')), default=Value('pending')), due=due, version=F('version') + 1, error=None)
+        new_ids = set(int(i) for i in image_ids) - set(queued.values_list('image_id', flat=True))
+        MetadataWriteBack.objects.bulk_create([MetadataWriteBack(image_id=i, due=due) for i in new_ids], batch_size=100, ignore_conflicts=True)
+        self.ensure_running()
+        self.wakeup.set()
+
+    def ensure_running(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="write-back", daemon=True)
+                self.thread.start()
+
+    def status(self):
+        counts = dict(MetadataWriteBack.objects.values_list('status').annotate(count=models.Count('id')))
+        return {status: counts.get(status, 0) for status in ['pending', 'writing', 'failed']}
+
+    def run(self, stop_event: threading.Event = None):
+        while stop_event is None or not stop_event.is_set():
+            try:
+                self.reclaim_stale()
+                if not self.write_due():
+                    # edits in other processes don't wake us up, so look at the DB again after a while
+                    self.wakeup.wait(min(self.delay, self._seconds_until_next_due() or self.delay))
+                    self.wakeup.clear()
+            except Exception as exc:
+                self.logger.error(exc, exc_info=True)
+                time.sleep(self.delay)
+            finally:
+                # this runs on our own thread, so django won't clean up the connection for us
+                connection.close()
+
+    def _seconds_until_next_due(self):
+        next_due = MetadataWriteBack.objects.filter(status='pending').values_list('due', flat=True).first()
+        if next_due is None:
+            return None
+        return max(0.1, (next_due - django_timezone.now()).total_seconds())
+
+    def reclaim_stale(self) -> int:
+        """ Makes the rows that a worker that stopped was writing pending again. Rows that other workers are still
+        writing are left alone. """
+        # without claimed_at: claimed before we kept it
+        stale = MetadataWriteBack.objects.filter(models.Q(claimed_at__lt=django_timezone.now() - self.CLAIM_TIMEOUT) | models.Q(claimed_at__isnull=True), status='writing')
+        return stale.update(status='pending', claimed_at=None)
+
+    def write_due(self) -> int:
+        """ Writes one batch of due images, returns how many there were. """
+        due = list(MetadataWriteBack.objects.filter(status='pending', due__lte=django_timezone.now()).values_list('id', 'version')[:self.BATCH_SIZE])
+        # claim them one by one, another worker could be doing the same
+        claimed = {row_id: version for row_id, version in due if MetadataWriteBack.objects.filter(id=row_id, status='pending', version=version).update(status='writing', claimed_at=django_timezone.now())}
+        if not claimed:
+            return 0
+
+        rows = MetadataWriteBack.objects.filter(id__in=claimed.keys()).select_related('image')
+        images_by_dir = {}
+        for row in rows:
+            images_by_dir.setdefault(row.image.parent_id, []).append(row)
+        for dir_id, dir_rows in images_by_dir.items():
+            # still busy with them
+            MetadataWriteBack.objects.filter(id__in=claimed.keys(), status='writing').update(claimed_at=django_timezone.now())
+            directory = Directory.objects.get(pk=dir_id)
+            images = list(Image.objects.filter(id__in=[row.image_id for row in dir_rows]).select_related('author').prefetch_related('tags', 'attachments'))
+            errors = {img.id: str(MetadataIncompleteError(img.name, img.errors)) for img in images if img.errors}
+            try:
+                # one process: this runs next to the UI, which needs exiftool as well
+                directory.write_metadata_of([img for img in images if img.id not in errors], workers=1)
+            except MetadataWriteError as exc:
+                failed = {os.path.basename(path) for path in exc.failed}
+                for img in images:
+                    if img.name in failed or any(att.name in failed for att in img.attachments.all()):
+                        errors[img.id] = str(exc)
+            except Exception as exc:
+                self.logger.error(exc, exc_info=True)
+                errors.update({img.id: repr(exc) for img in images if img.id not in errors})
+
+            for row in dir_rows:
+                mine = MetadataWriteBack.objects.filter(id=row.id, version=claimed[row.id])
+                if row.image_id in errors:
+                    mine.update(status='failed', error=errors[row.image_id])
+                else:
+                    mine.delete()
+                # edited while we were writing: it has a new version, write that once it is due
+                MetadataWriteBack.objects.filter(id=row.id, status='writing').update(status='pending', claimed_at=None)
+        self.logger.info(f"Wrote back the metadata of {len(claimed)} images")
+        return len(claimed)
+
+
 class CameraMatcherService:
     __instance = None
 
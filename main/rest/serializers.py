@@ -1,8 +1,9 @@
 import os
+from django.urls import reverse
 from rest_framework import serializers
 from rest_framework_recursive.fields import RecursiveField
-from main.models import Directory, Image, Author, Attachment, Tag, Camera
-from main.services import MetadataSerializerService
+from main.models import Directory, Image, Author, Attachment, Tag, Camera, ScanJob, MetadataWriteBack
+from main.services import MetadataSerializerService, ThumbnailService
 
 class AttachmentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -60,14 +61,24 @@ class ImageNestedSerializer(serializers.HyperlinkedModelSerializer):
     supported_metadata_types = serializers.SerializerMethodField()
     tags = TagNestedSerializer(many=True)
     camera = CameraSerializer(read_only=True)
+    thumbnail = serializers.SerializerMethodField()
 
     class Meta:
         model = Image
-        fields = ['id', 'name', 'author', 'date_time', 'coordinates', 'rating', 'pick_label', 'color_label', 'tags', 'camera', 'supported_metadata_types', 'errors', 'attachments', 'thumbnail', 'mime_type']
+        fields = ['id', 'name', 'author', 'date_time', 'coordinates', 'rating', 'pick_label', 'color_label', 'tags', 'camera', 'supported_metadata_types', 'errors', 'attachments', 'thumbnail', 'thumbnail_state', 'mime_type']
     
     def get_date_time(self, obj):
         return obj.date_time.isoformat() if obj.date_time is not None else None
     
+    def get_thumbnail(self, obj):
+        if obj.thumbnail_state == 'ready' and obj.thumbnail_key:
+            # changes with the thumbnail, so the browser can keep it as long as it likes
+            url = reverse('main:img_thumbnail_key', args=[obj.id, obj.thumbnail_key])
+        else:
+            url = reverse('main:img_thumbnail', args=[obj.id])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
+
     def get_coordinates(self, obj):
         if obj.gps_longitude is not None and obj.gps_latitude is not None:
             return {
@@ -95,10 +106,31 @@ class DirectorySerializer(serializers.HyperlinkedModelSerializer):
     parent = DirectoryNestedSerializer(read_only=True)
     images = ImageNestedSerializer(many=True)
     subdirs = DirectoryNestedSerializer(many=True)
+    # whether the thumbnails can be fetched all at once from img/thumbnails
+    thumbnail_packs = serializers.SerializerMethodField()
 
     class Meta:
         model = Directory
-        fields = ['id', 'parent', 'path', 'images', 'subdirs']
+        fields = ['id', 'parent', 'path', 'images', 'subdirs', 'thumbnail_packs']
+
+    def get_thumbnail_packs(self, obj):
+        return ThumbnailService.instance().use_packs
+
+
+class ScanJobSerializer(serializers.ModelSerializer):
+    directory = DirectoryNestedSerializer(read_only=True)
+
+    class Meta:
+        model = ScanJob
+        fields = ['id', 'directory', 'status', 'error', 'started', 'finished', 'dirs_found', 'dirs_done', 'files_found', 'files_processed', 'files_per_second', 'eta_seconds']
+
+
+class MetadataWriteBackSerializer(serializers.ModelSerializer):
+    image_name = serializers.CharField(source='image.name', read_only=True)
+
+    class Meta:
+        model = MetadataWriteBack
+        fields = ['id', 'image', 'image_name', 'status', 'due', 'error']
 
 
 class CoordinateSerializer(serializers.Serializer):
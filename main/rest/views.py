@@ -6,8 +6,9 @@ from rest_framework.response import Response
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 
-from main.models import Directory, Image, Attachment, Author, Camera, ImageSetActionError, ImageSetService, MetadataIncompleteError, Tag, CameraMatcherService, StringSetting
-from main.rest.serializers import DirectorySerializer, AuthorSerializer, CameraSerializer, AttachmentSerializer, DirectoryNestedSerializer, GpsTrackWithMetadataSerializer, TagSerializer
+from main.models import Directory, Image, Attachment, Author, Camera, ImageSetActionError, ImageSetService, MetadataIncompleteError, MetadataWriteError, Tag, ScanJob, ScanJobService, MetadataWriteBack, WriteBackService
+from main.services import ThumbnailService
+from main.rest.serializers import DirectorySerializer, AuthorSerializer, CameraSerializer, AttachmentSerializer, DirectoryNestedSerializer, GpsTrackWithMetadataSerializer, TagSerializer, ScanJobSerializer, MetadataWriteBackSerializer
 
 class AuthorListView(generics.ListAPIView):
     queryset = Author.objects.all()
@@ -69,11 +70,18 @@ class DirectoryDetailView(generics.RetrieveAPIView):
     queryset = Directory.objects.all()
     serializer_class = DirectorySerializer
 
+    def get_object(self):
+        directory = super().get_object()
+        # this is the directory the user is looking at now
+        ThumbnailService.instance().prioritize(directory.id)
+        directory.queue_missing_thumbnails()
+        return directory
+
 
 class ImageMetadataView(APIView):
     def get(self, request, *args, **kwargs):
         image = get_object_or_404(Image, pk=kwargs.get("pk"))
-        return Response(image.read_exif_json_from_file())
+        return Response(image.read_raw_metadata())
 
 
 class DirectoryCrumbsView(APIView):
@@ -97,13 +105,14 @@ class DirectoryActionsView(APIView):
             action = request.POST["action"]
             if action == "scan":
                 reload = request.POST["reload"]
-                CameraMatcherService.instance().reload_cameras()
-                skip_dirs = StringSetting.objects.get_multiple(name="skip_dirs")
-                directory.scan(reload == 'true', skip_dirs = skip_dirs)
+                job = ScanJobService.instance().submit(directory, reload == 'true')
+                return Response({'result': 'OK', 'job': job.id}, 200)
             elif action == "rename_files":
                 directory.rename_files()
             elif action == "write_metadata":
-                 directory.write_images_metadata()
+                dry_run = request.POST.get("dry_run", "false") == 'true'
+                written = directory.write_images_metadata(dry_run)
+                return Response({'result': 'OK', 'images': written}, 200)
             elif action == "remove_dir_from_db":
                 directory.remove_from_db()
             elif action == "trash_flagged_for_removal":
@@ -118,7 +127,7 @@ class DirectoryActionsView(APIView):
             return Response({'result': 'OK'}, 200)
         except Http404:
             return Response({'message': "Not found"}, 404)
-        except MetadataIncompleteError as exc:
+        except (MetadataIncompleteError, MetadataWriteError) as exc:
             return Response(exc.as_dict(), 400)
         except Exception as exc:
             self.logger.error(exc, exc_info=True)
@@ -132,6 +141,54 @@ class DirectoryTracksView(APIView):
         return Response(serializer.data)
 
 
+class ScanJobDetailView(generics.RetrieveAPIView):
+    queryset = ScanJob.objects.all()
+    serializer_class = ScanJobSerializer
+
+
+class ScanJobActionsView(APIView):
+    logger = logging.getLogger(__name__)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            job = get_object_or_404(ScanJob, pk=kwargs.get("pk"))
+            action = request.POST["action"]
+            if action == "cancel":
+                ScanJobService.instance().cancel(job)
+            elif action == "resume":
+                ScanJobService.instance().resume(job)
+            else:
+                return Response({'message': "Unsupported action"}, 400)
+
+            return Response({'result': 'OK'}, 200)
+        except Http404:
+            return Response({'message': "Not found"}, 404)
+        except Exception as exc:
+            self.logger.error(exc, exc_info=True)
+            return Response({'message': "Unknown exception: " + getattr(exc, 'message', repr(exc))}, 500)
+
+
+class WriteBackStatusView(APIView):
+    """ The images of which the metadata still has to be written back: how many per status, the ones that are being
+    written or failed, and the first ones that are pending. """
+    def get(self, request, *args, **kwargs):
+        service = WriteBackService.instance()
+        # picks up what was left in the queue by a previous run
+        service.ensure_running()
+        writes = [*MetadataWriteBack.objects.exclude(status='pending').select_related('image'), *MetadataWriteBack.objects.filter(status='pending').select_related('image')[:100]]
+        return Response({
+            'enabled': service.enabled,
+            'counts': service.status(),
+            'writes': MetadataWriteBackSerializer(writes, many=True).data,
+        })
+
+
+class ThumbnailStatusView(APIView):
+    """ How far the thumbnail workers are: what is queued and in progress, and how many thumbnails per second they make. """
+    def get(self, request, *args, **kwargs):
+        return Response(ThumbnailService.instance().stats())
+
+
 class ImageSetActionsView(APIView):
     logger = logging.getLogger(__name__)
 
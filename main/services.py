@@ -1,14 +1,24 @@
 from concurrent.futures import ThreadPoolExecutor
-import os, logging
-
-from .utils.exiftool_ctxmngr import ExifTool
-from .model.metadata_parser import Metadata, FujiXT20ImageParser, FallbackImageParser
-from .model.metadata_writer import JpegImageSerializer, MetadataType, OriginalFileSerializer, BasicRawImageSerializer, MovVideoSerializer
-from .model.thumbnail import ImageThumbnailCreator, VideoThumbnailCreator
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import prefetch_related_objects
+import os, logging, atexit, threading
+
+from .utils.exiftool_ctxmngr import ExifToolPool, ExifToolError
+from .utils.preview_cache import PreviewCache
+from .utils.priority_pool import PriorityProcessPool
+from .utils.thumbnail_pack import ThumbnailPack
+from .model.metadata_parser import Metadata, FujiXT20ImageParser, FallbackImageParser, merge_sidecar
+from .model.file_types import FileType, sidecar_names
+from .model.metadata_writer import JpegImageSerializer, MetadataType, MetadataWritePlan, MetadataWriteResult, WriteStrategy, OriginalFileSerializer, XmpSidecarSerializer, BasicRawImageSerializer, MovVideoSerializer
+from .model.preview import fit, negotiate_format, render_preview, writable_formats
+from .model.thumbnail import ImageThumbnailCreator, RenderedThumbnail, VideoThumbnailCreator, render_keyed_thumbnail, thumbnail_file_name
+from .model.jpeg_metadata import JpegMetadataReader
 from .model.gps_track import GpsTrack, GpsTrackSection, GpxTrackParser, KmlTrackParser
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from datetime import datetime
 from io import BytesIO
+from PIL import Image as PIL_Image
 
 class ExifToolService(object):
     __instance = None
@@ -19,34 +29,143 @@ class ExifToolService(object):
             return cls.__instance
         else:
             cls.__instance = ExifToolService()
+            cls.__instance.logger = logging.getLogger(__name__)
+            atexit.register(cls.__instance.pool.close)
             return cls.__instance
 
-    def read_metadata(self, path, *images):
+    def __init__(self):
+        self.pool = ExifToolPool(
+            size=getattr(settings, 'EXIFTOOL_POOL_SIZE', 4),
+            max_commands=getattr(settings, 'EXIFTOOL_MAX_COMMANDS', 1000),
+            executable=getattr(settings, 'EXIFTOOL_EXECUTABLE', '/usr/local/bin/exiftool'),
+            timeout=getattr(settings, 'EXIFTOOL_TIMEOUT', 300))
+        self.chunk_size = getattr(settings, 'EXIFTOOL_CHUNK_SIZE', 200)
+        self.native_reader = JpegMetadataReader() if getattr(settings, 'NATIVE_JPEG_READER', False) else None
+
+    def read_metadata(self, path, *images, chunk_size=None, fast=False):
+        """ Generator that yields the metadata of the images one by one, in the same order as the images. Images that
+        exiftool cannot read are left out, match the metadata to the images by its SourceFile. """
+        for chunk in self.read_metadata_chunks(path, *images, chunk_size=chunk_size, fast=fast):
+            yield from chunk
+
+    def read_metadata_chunks(self, path, *images, chunk_size=None, fast=False):
+        """ Generator that feeds the images to exiftool in chunks of chunk_size, and yields the metadata of every chunk
+        as soon as it is read. This keeps the memory usage flat for very large directories.
+        With fast, files that the native reader supports are read without exiftool. That only returns the tags the
+        metadata parsers need, so it can be used when scanning but not to show all metadata.
+        Like read_metadata, a chunk has no metadata for the images that could not be read. """
         if not os.path.isdir(path):
             raise ValueError("path is not a directory: %s" % path)
 
-        files = [img.name for img in images]
-        with ExifTool(path) as et:
-            return et.get_metadata(*files)
+        chunk_size = chunk_size or self.chunk_size
+        files = [os.path.join(path, img.name) for img in images]
+        for i in range(0, len(files), chunk_size):
+            chunk_files = files[i:i + chunk_size]
+            chunk = [self._read_native(f) for f in chunk_files] if fast else [None] * len(chunk_files)
+            remaining = [f for f, json in zip(chunk_files, chunk) if json is None]
+            sidecars = {f: sidecar for f in chunk_files for sidecar in [self._find_sidecar(f)] if sidecar is not None}
+            if remaining or sidecars:
+                # don't hold on to the process while the caller is handling the chunk
+                with self.pool.lease() as et:
+                    results = et.get_metadata(*remaining, *sidecars.values())
+                # exiftool leaves out the files it cannot read (or that are gone), so don't count on the order
+                records = {os.path.normpath(json.get("SourceFile", "")): json for json in results}
+                chunk = [json if json is not None else records.get(os.path.normpath(f)) for f, json in zip(chunk_files, chunk)]
+                sidecar_results = {f: records.get(os.path.normpath(sidecar)) for f, sidecar in sidecars.items()}
+                chunk = [merge_sidecar(json, sidecar_results[f]) if json is not None and sidecar_results.get(f) is not None else json for f, json in zip(chunk_files, chunk)]
+            yield [json for json in chunk if json is not None]
+
+    def reads_sidecar(self, name: str) -> bool:
+        """ Whether the metadata of the file is read together with its XMP sidecar: when its type is written to one. """
+        return MetadataSerializerService.instance().write_strategy(os.path.splitext(name)[1]).sidecar
+
+    def _find_sidecar(self, file):
+        """ The XMP sidecar to merge into the metadata of the file, if its type is written to a sidecar and it has one. """
+        if not self.reads_sidecar(file):
+            return None
+        return next((path for path in [os.path.join(os.path.dirname(file), name) for name in sidecar_names(os.path.basename(file))] if os.path.isfile(path)), None)
+
+    def _read_native(self, file):
+        if self.native_reader is not None and self.native_reader.can_read(os.path.splitext(file)[1]):
+            return self.native_reader.read(file)
+        return None
+
+    def write_metadata(self, path, *images, changed_types=None, workers=None) -> MetadataWriteResult:
+        """ Writes the metadata of the images and their attachments, see plan_metadata_write and write_planned. """
+        return self.write_planned(self.plan_metadata_write(path, *images, changed_types=changed_types), workers)
 
-    def write_metadata(self, path, *images):
+    def plan_metadata_write(self, path, *images, changed_types=None) -> MetadataWritePlan:
+        """ Decides which files to write: the images and their attachments, or their XMP sidecars, depending on the
+        WriteStrategy of their type. Sidecars that are attachments are only written as the sidecar of another file.
+        With changed_types (image id -> set of MetadataType), only the files of which the serializer supports one of
+        the changed types of their image are included. """
         if not os.path.isdir(path):
             raise ValueError("path is not a directory: %s" % path)
 
-        with ExifTool(path) as et:
-            for image in images:
-                ext = os.path.splitext(image.name)[1]
-                tags_text = set(map(lambda t: t.full_name, image.tags.all()))
-                metadata = Metadata(image.date_time, image.rating, image.pick_label, image.color_label, tags_text, image.author.name if image.author else None, image.gps_longitude, image.gps_latitude, image.gps_altitude, None, None, None, image.original_file_name)
-                params = MetadataSerializerService.instance().serialize_metadata(ext, metadata);
-                if params is not None:
-                    et.execute("-overwrite_original", "-use", "MWG", "-preserve", *params, image.name)
-                
-                for att in image.attachments.all():
-                    ext = os.path.splitext(att.name)[1]
-                    params = MetadataSerializerService.instance().serialize_metadata(ext, metadata);
-                    if params is not None:
-                        et.execute("-overwrite_original", "-use", "MWG", "-preserve", *params, att.name)
+        serializers = MetadataSerializerService.instance()
+        prefetch_related_objects(images, 'author', 'tags', 'attachments')
+        plan = MetadataWritePlan()
+        for image in images:
+            types = changed_types[image.id] if changed_types is not None else None
+            if types is not None and not types:
+                continue
+            metadata = image.as_metadata()
+            attachment_names = [att.name for att in image.attachments.all() if FileType.from_path(att.name) != FileType.SIDECAR]
+            for name in [image.name, *attachment_names]:
+                ext = os.path.splitext(name)[1]
+                strategy = serializers.write_strategy(ext)
+                if strategy.in_file and (types is None or any(serializers.supports_metadata_type(ext, t) for t in types)):
+                    params = serializers.serialize_metadata(ext, metadata)
+                    if params:
+                        plan.add(image.id, params, os.path.join(path, name))
+                if strategy.sidecar and (types is None or any(serializers.supports_metadata_type(".xmp", t) for t in types)):
+                    # the existing sidecar if there is one, otherwise a new one named after the file
+                    existing = next((n for n in sidecar_names(name) if os.path.isfile(os.path.join(path, n))), None)
+                    sidecar = existing or sidecar_names(name)[0]
+                    plan.add(image.id, serializers.serialize_metadata(".xmp", metadata), os.path.join(path, sidecar), new=existing is None)
+        return plan
+
+    def write_planned(self, plan: MetadataWritePlan, workers=None) -> MetadataWriteResult:
+        """ Files that get exactly the same arguments are written with one exiftool command (of at most chunk_size files),
+        new files are created with one command each. Since most files get arguments of their own, the commands are sent
+        to exiftool in batches of up to chunk_size, which exiftool runs one after the other without waiting for us in
+        between. The batches are spread over up to `workers` exiftool processes. A file that fails does not stop the
+        others, the result tells which files were written. """
+        commands = [(params, files[i:i + self.chunk_size], False) for params, files in plan.commands.items() for i in range(0, len(files), self.chunk_size)]
+        commands.extend((params, [path], True) for path, params in plan.new_files.items())
+        workers = max(1, min(workers or self.pool.size, self.pool.size))
+        # enough batches to keep all workers busy
+        batch_size = max(1, min(self.chunk_size, -(-len(commands) // workers)))
+        batches = [commands[i:i + batch_size] for i in range(0, len(commands), batch_size)]
+        result = MetadataWriteResult()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for written, failed in executor.map(self._write, batches):
+                result.written.extend(written)
+                result.failed.update(failed)
+        return result
+
+    def _write(self, commands):
+        """ Runs on a worker thread. Returns the files that were written, and the error per file that was not. """
+        try:
+            with self.pool.lease() as et:
+                # exiftool can only create a file from scratch (for XMP) with -o
+                outputs = et.execute_many([("-use", "MWG", *params, "-o", files[0]) if new else ("-overwrite_original", "-use", "MWG", "-preserve", *params, *files) for params, files, new in commands])
+        except ExifToolError as exc:
+            return [], {f: str(exc) for _, files, _ in commands for f in files}
+
+        written = []
+        failed = {}
+        for (_, files, _), (_, errors) in zip(commands, outputs):
+            paths = set(files)
+            for line in errors.splitlines():
+                # e.g. "Error: File not found - /photos/IMG_1.JPG"
+                message, _, file = line.rpartition(" - ")
+                if line.startswith("Error") and file in paths:
+                    failed[file] = message
+                elif line.strip():
+                    self.logger.warning("exiftool: %s", line)
+            written.extend(f for f in files if f not in failed)
+        return written, failed
 
 
 class MetadataParserService:
@@ -65,11 +184,25 @@ class MetadataParserService:
         self.parsers = [FujiXT20ImageParser(), FallbackImageParser()]
 
     def parse_metadata(self, json: dict) -> Metadata:
-        for p in self.parsers:
-            if p.can_parse(json):
-                return p.parse(json)
-        self.logger.warn('No parser found for %s' % json);
-        return Metadata(None, None, None, None, None, None, None, None, None, None, None, None, None)
+        return self.parse_many([json])[0]
+
+    def parse_many(self, records: List[dict]) -> List[Metadata]:
+        """ Parses the exiftool records of a scan or re-parse in one go: every record is matched to its parser once, and
+        every parser then parses all of its records. The result is in the order of records. """
+        results = [None] * len(records)
+        positions_by_parser = {}
+        for i, json in enumerate(records):
+            for p in self.parsers:
+                if p.can_parse(json):
+                    positions_by_parser.setdefault(p, []).append(i)
+                    break
+            else:
+                self.logger.warning('No parser found for %s', json)
+                results[i] = Metadata(None, None, None, None, None, None, None, None, None, None, None, None, None)
+        for p, positions in positions_by_parser.items():
+            for i, metadata in zip(positions, p.parse_many([records[i] for i in positions])):
+                results[i] = metadata
+        return results
 
 
 class MetadataSerializerService:
@@ -84,7 +217,11 @@ class MetadataSerializerService:
             return cls.__instance
 
     def __init__(self):
-        self.serializers = [JpegImageSerializer(), OriginalFileSerializer(), BasicRawImageSerializer(), MovVideoSerializer()]
+        self.serializers = [JpegImageSerializer(), OriginalFileSerializer(), XmpSidecarSerializer(), BasicRawImageSerializer(), MovVideoSerializer()]
+        self.write_strategies = {ext.casefold(): WriteStrategy(strategy) for ext, strategy in getattr(settings, 'METADATA_WRITE_STRATEGIES', {}).items()}
+
+    def write_strategy(self, extension: str) -> WriteStrategy:
+        return self.write_strategies.get(extension.casefold(), WriteStrategy.IN_FILE)
 
     def serialize_metadata(self, extension, metadata: Metadata) -> list:
         for p in self.serializers:
@@ -195,29 +332,120 @@ class ThumbnailService:
         else:
             cls.__instance = ThumbnailService()
             cls.__instance.logger = logging.getLogger(__name__)
+            atexit.register(cls.__instance.pool.shutdown)
             return cls.__instance
 
     def __init__(self):
-        img_thumbnailer = ImageThumbnailCreator()
-        self.dummy_thumbnail = img_thumbnailer.create_dummy_thumbnail()
+        self.mode = getattr(settings, 'THUMBNAIL_MODE', 'fast')
+        self.qualities = getattr(settings, 'IMAGE_QUALITY', None)
+        img_thumbnailer = ImageThumbnailCreator(self.mode, self.qualities)
+        # shown while there is no thumbnail yet, it is never written to disk
+        self.placeholder = img_thumbnailer.create_dummy_thumbnail().getvalue()
         self.thumbnailers = [img_thumbnailer, VideoThumbnailCreator()]
 
-        self.executor = ThreadPoolExecutor(max_workers=10)
-
-    def create_dummy_thumbnail(self) -> BytesIO:
-        return self.dummy_thumbnail
-
-    def create_thumbnail_async(self, img_abs_path: str, thumbnail_file) -> BytesIO:
-        self.executor.submit(self.refresh_thumbnail, img_abs_path, thumbnail_file)
-
-    def refresh_thumbnail(self, img_abs_path: str, thumbnail_file):
+        # decoding and resizing is CPU-bound, so it runs in processes: one per core by default
+        self.pool = PriorityProcessPool(
+            render_keyed_thumbnail, self._store_thumbnail,
+            workers=getattr(settings, 'THUMBNAIL_WORKERS', None),
+            max_backlog=getattr(settings, 'THUMBNAIL_BACKLOG', 200))
+        # path of the image -> set once it is stored (or failed)
+        self.queued: Dict[str, threading.Event] = {}
+        self.lock = threading.Lock()
+        # one file per directory with all of its thumbnails, instead of a file per thumbnail
+        self.use_packs = getattr(settings, 'THUMBNAIL_PACKS', False)
+        self.packs: Dict[int, ThumbnailPack] = {}
+
+    def create_thumbnail_async(self, img_abs_path: str, storage, directory_id=None, on_done=None, urgent=False, image_id=None, fingerprint=None):
+        """ Makes the thumbnail of the file at img_abs_path and saves it in storage under the name of its key (see
+        thumbnail_key) or, with THUMBNAIL_PACKS, under image_id in the pack of the directory. on_done is called with
+        key= and either name= the name it was saved as, or offset= and length= of the pack record; with none of them
+        when it failed. With the fingerprint of the file, the preview levels that are not cached yet are made in the
+        same go (see PreviewService) when the job is urgent or the directory is the one being viewed: a scan in the
+        background would push the previews of what is being viewed out of the cache. Does nothing when the file is
+        already queued. Blocks while the backlog is full, unless the job is urgent or the directory is the one being
+        viewed. """
+        with self.lock:
+            if img_abs_path in self.queued:
+                return
+            self.queued[img_abs_path] = threading.Event()
+        pack_key = (directory_id, image_id) if self.use_packs and image_id is not None else None
+        # a file that is stored already (of an identical image, or from before a move) is not made again
+        root = storage.path("") if pack_key is None else None
+        in_view = urgent or self.pool.is_focused(directory_id)
+        levels = PreviewService.instance().missing_levels(fingerprint) if fingerprint is not None and in_view else []
+        # next to the JPEG, for the browsers that accept them; packs only have the JPEG
+        formats = PreviewService.instance().formats if pack_key is None else []
+        self.pool.submit((img_abs_path, 300, 200, self.mode, root, levels, formats, self.qualities), (img_abs_path, storage, pack_key, fingerprint, on_done), group=directory_id, urgent=urgent)
+
+    def pack(self, directory_id: int) -> ThumbnailPack:
+        with self.lock:
+            pack = self.packs.get(directory_id)
+            if pack is None:
+                pack = self.packs[directory_id] = ThumbnailPack(os.path.join(settings.MEDIA_ROOT, "thumbnails", f"{directory_id}.pack"))
+            return pack
+
+    def delete_pack(self, directory_id: int):
+        with self.lock:
+            pack = self.packs.pop(directory_id, None) or ThumbnailPack(os.path.join(settings.MEDIA_ROOT, "thumbnails", f"{directory_id}.pack"))
+        pack.delete()
+
+    def is_queued(self, img_abs_path: str) -> bool:
+        with self.lock:
+            return img_abs_path in self.queued
+
+    def wait(self, img_abs_path: str, timeout: float) -> bool:
+        """ Waits until the thumbnail is no longer queued. Returns False on timeout. """
+        with self.lock:
+            done = self.queued.get(img_abs_path)
+        return done is None or done.wait(timeout)
+
+    def negotiate(self, image, accept: str) -> str:
+        """ The format of the thumbnail of image to send to a browser with this Accept header: one of the other
+        formats if that was made, JPEG otherwise. """
+        format = PreviewService.instance().negotiate(accept)
+        if format == 'JPEG' or image.thumbnail_offset is not None or not image.thumbnail_key or image.thumbnail.name != thumbnail_file_name(image.thumbnail_key):
+            return 'JPEG'
+        return format if image.thumbnail.storage.exists(thumbnail_file_name(image.thumbnail_key, format)) else 'JPEG'
+
+    def prioritize(self, directory_id):
+        """ The thumbnails of this directory are made before the others, since that is the one being viewed. """
+        self.pool.prioritize(directory_id)
+
+    def stats(self) -> dict:
+        return self.pool.stats()
+
+    def _store_thumbnail(self, context, result, exc):
+        img_abs_path, storage, pack_key, fingerprint, on_done = context
+        location = {}
         try:
-            img_raw = self.create_thumbnail(img_abs_path)
-            if img_raw:
-                with thumbnail_file.open("wb") as out:
-                    out.write(img_raw.getbuffer())
-        except Exception as exc:
-            self.logger.error(exc, exc_info=True)
+            result = result if exc is None else RenderedThumbnail()
+            for level, preview in result.previews.items():
+                PreviewService.instance().store_level(fingerprint, level, preview)
+            if exc is not None:
+                self.logger.error("Could not create thumbnail for %s: %s", img_abs_path, exc)
+            elif result.key is None:
+                self.logger.warning("No thumbnail service found for %s", img_abs_path)
+            elif pack_key is not None:
+                directory_id, image_id = pack_key
+                location['offset'], location['length'] = self.pack(directory_id).append(image_id, result.data)
+            else:
+                with self.lock:
+                    # data is None when they were there already, and they might have been stored for an identical
+                    # file since
+                    for format, data in [('JPEG', result.data), *result.variants.items()]:
+                        name = thumbnail_file_name(result.key, format)
+                        if data is not None and not storage.exists(name):
+                            storage.save(name, ContentFile(data))
+                location['name'] = thumbnail_file_name(result.key)
+            if location:
+                location['key'] = result.key
+            if on_done is not None:
+                on_done(**location)
+        finally:
+            with self.lock:
+                done = self.queued.pop(img_abs_path, None)
+            if done is not None:
+                done.set()
 
     def create_thumbnail(self, path: str) -> BytesIO:
         extension = os.path.splitext(path)[1]
@@ -225,4 +453,81 @@ class ThumbnailService:
             if p.can_thumbnail(extension):
                 return p.create_thumbnail(path, 300, 200)
         self.logger.warn('No thumbnail service found for %s' % extension);
-        return None
\ No newline at end of file
+        return None
+
+class PreviewService:
+    """ Scaled down versions of images, for the viewer. They are kept in a PreviewCache, by the fingerprint of the file
+    and the size, so flipping between images does not decode the originals again.
+
+    The window size decides which size is asked for, so a few fixed sizes are kept as well: the PREVIEW_LEVELS, by the
+    length of their long edge. The ThumbnailService makes them together with the thumbnails of the directory being
+    viewed, the others are made when they are first needed. A preview is scaled down from the smallest level that is
+    big enough, instead of from the original.
+
+    Browsers that accept them get WebP or AVIF previews (IMAGE_FORMATS), the levels are always JPEG. """
+    __instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is not None:
+            return cls.__instance
+        else:
+            cls.__instance = PreviewService()
+            cls.__instance.logger = logging.getLogger(__name__)
+            return cls.__instance
+
+    def __init__(self):
+        self.cache = PreviewCache(os.path.join(settings.MEDIA_ROOT, "previews"), getattr(settings, 'PREVIEW_CACHE_BYTES', 2 * 1024 * 1024 * 1024))
+        self.levels = sorted(getattr(settings, 'PREVIEW_LEVELS', [1280, 2560]))
+        self.qualities = getattr(settings, 'IMAGE_QUALITY', None)
+        # the formats besides JPEG, best first, of the ones this Pillow can write
+        self.formats = [format for format in writable_formats() if format in getattr(settings, 'IMAGE_FORMATS', []) and format != 'JPEG']
+
+    def negotiate(self, accept: str) -> str:
+        """ The format to send to a browser with this Accept header """
+        return negotiate_format(accept, self.formats)
+
+    def preview(self, img_abs_path: str, fingerprint: Tuple[int, int, int], max_width: int, max_height: int, format: str = 'JPEG'):
+        """ The preview of the file at img_abs_path, which has the given fingerprint (see file_fingerprint), as a file
+        opened for reading that the caller closes. It is rendered when it is not cached yet. """
+        key = self.key(fingerprint, max_width, max_height, format)
+        f = self.cache.open(key)
+        if f is not None:
+            return f
+        level = next((level for level in self.levels if level >= max(max_width, max_height)), None)
+        if level is None:
+            self.logger.info("Rendering preview of %s at %dx%d", img_abs_path, max_width, max_height)
+            return self._put(key, render_preview(img_abs_path, max_width, max_height, format, self.qualities))
+        level_file = self.cache.open(self.level_key(fingerprint, level))
+        if level_file is None:
+            self.logger.info("Rendering preview level %d of %s", level, img_abs_path)
+            level_file = self._put(self.level_key(fingerprint, level), render_preview(img_abs_path, level, level, 'JPEG', self.qualities))
+        with PIL_Image.open(level_file) as level_image:
+            fits = format == 'JPEG' and fit(level_image.size, max_width, max_height) == level_image.size
+        level_file.seek(0)
+        if fits:
+            return level_file
+        with level_file:
+            return self._put(key, render_preview(level_file, max_width, max_height, format, self.qualities))
+
+    def _put(self, key: str, data: bytes):
+        self.cache.put(key, data)
+        # not from the cache, it could be evicted again before we open it
+        return BytesIO(data)
+
+    def missing_levels(self, fingerprint: Tuple[int, int, int]) -> List[int]:
+        return [level for level in self.levels if not self.cache.contains(self.level_key(fingerprint, level))]
+
+    def store_level(self, fingerprint: Tuple[int, int, int], level: int, data: bytes):
+        self.cache.put(self.level_key(fingerprint, level), data)
+
+    def key(self, fingerprint: Tuple[int, int, int], max_width: int, max_height: int, format: str) -> str:
+        size, mtime_ns, inode = fingerprint
+        return f"{size}-{mtime_ns}-{inode}-{max_width}x{max_height}-{format.lower()}"
+
+    def level_key(self, fingerprint: Tuple[int, int, int], level: int) -> str:
+        size, mtime_ns, inode = fingerprint
+        return f"{size}-{mtime_ns}-{inode}-level{level}-jpeg"
+
+    def stats(self) -> dict:
+        return self.cache.stats()
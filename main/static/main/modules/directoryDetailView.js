@@ -134,6 +134,7 @@ export default {
                 fetch(`/main/api/dir/${id}/detail`, { method: 'get', headers: { 'content-type': 'application/json' } })
                     .then(res => this.backendService.parseResponse(res, `Could not load directory with id ${id}`, true) )
                     .then(json => {
+                        this.revokeThumbnailUrls();
                         this.directory = json;
                         // set simplified mimetypes for performance
                         this.directory.images.forEach(el => {
@@ -156,12 +157,53 @@ export default {
                                 this.lastSelectedItem = item;
                             }
                         }
+                        if(this.directory.thumbnail_packs) {
+                            this.loadThumbnails(this.directory.images);
+                        }
                     })
             ]).then(() => {
                 this.loading = false;
                 document.title = `Workflow - ${this.directory.path}`;
             });
         },
+        loadThumbnails(images) {
+            // the thumbnails that are ready in a few requests instead of one per image, from the thumbnail packs. Their
+            // own url is only used for the ones that are not in the response, so they are not downloaded twice.
+            const ready = images.filter(img => img.thumbnail_state == 'ready');
+            for(let start = 0; start < ready.length; start += 500) {
+                const chunk = ready.slice(start, start + 500);
+                const urls = new Map(chunk.map(img => [img.id, img.thumbnail]));
+                // this runs before the images are rendered, so they don't start loading their url
+                chunk.forEach(img => img.thumbnail = null);
+                fetch(`/main/img/thumbnails?ids=${chunk.map(img => img.id).join(',')}`, { method: 'get' })
+                    .then(res => res.ok ? res.arrayBuffer() : Promise.reject(res.status))
+                    .then(buffer => {
+                        const indexLength = new DataView(buffer).getUint32(0);
+                        const index = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, indexLength)));
+                        const dataStart = 4 + indexLength;
+                        const byId = new Map(index.map(entry => [entry.id, entry]));
+                        for(let img of chunk) {
+                            const entry = byId.get(img.id);
+                            if(entry) {
+                                const blob = new Blob([new Uint8Array(buffer, dataStart + entry.offset, entry.length)], { type: 'image/jpeg' });
+                                img.thumbnail = URL.createObjectURL(blob);
+                            } else {
+                                img.thumbnail = urls.get(img.id);
+                            }
+                        }
+                    })
+                    .catch(() => chunk.forEach(img => img.thumbnail = urls.get(img.id)));
+            }
+        },
+        revokeThumbnailUrls() {
+            if(this.directory && this.directory.images) {
+                for(let img of this.directory.images) {
+                    if(img.thumbnail && img.thumbnail.startsWith('blob:')) {
+                        URL.revokeObjectURL(img.thumbnail);
+                    }
+                }
+            }
+        },
         removeFromDb() {
             const parentId = this.directory.parent.id;
             this.$refs.confirmDialog.show('Remove current directory from db', 'Any changes that were not written to the metadata yet will be lost.<br>Are you sure you want to continue?').then(() => {
@@ -177,12 +219,26 @@ export default {
         },
         findNew() {
             return this.postDirectoryAction('scan', { 'reload': false })
+                .then(json => this.waitForScanJob(json.job))
                 .then(() => this.loadData(this.$route.params.id));
         },
         rescan() {
             this.$refs.confirmDialog.show('Re-scan directory', 'Any changes that were not written to the metadata yet will be lost.<br>Are you sure you want to continue?').then(() => {
                 return this.postDirectoryAction('scan', { 'reload': true });
-            }).then(() => this.loadData(this.$route.params.id));
+            }).then(json => this.waitForScanJob(json.job))
+            .then(() => this.loadData(this.$route.params.id));
+        },
+        waitForScanJob(jobId) {
+            this.loading = true;
+            return fetch(`/main/api/scanjob/${jobId}`, { method: 'get', headers: { 'content-type': 'application/json' } })
+                .then(res => this.backendService.parseResponse(res, `Could not load scan job with id ${jobId}`, false))
+                .then(json => {
+                    if(json.status == 'queued' || json.status == 'running') {
+                        return new Promise(resolve => setTimeout(resolve, 1000)).then(() => this.waitForScanJob(jobId));
+                    } else if(json.status == 'failed') {
+                        throw new UiError(`Scan failed: ${json.error}`);
+                    }
+                });
         },
         organize() {
             let ids = this.applyToItems
@@ -487,6 +543,7 @@ export default {
     },
     destroyed() {
         this.windowManager.closed(this);
+        this.revokeThumbnailUrls();
     },
     async beforeRouteUpdate(to, from) {
         return this.loadData(to.params.id);
@@ -1,3 +1,722 @@
-from django.test import TestCase
+import io, os, re, shutil, tempfile, threading, time
 
-# Create your tests here.
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
+from PIL import Image as PIL_Image
+
+from django.db import transaction
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from .models import Attachment, Directory, DirectoryWatcherService, Image, MetadataReparseService, MetadataWriteBack, ScanService, Tag, TagIndex, WriteBackService
+from .services import ExifToolService, PreviewService
+from .model.attachments import AttachmentMatcher
+from .model.jpeg_metadata import JpegMetadataReader
+from .model.metadata_writer import MetadataWritePlan
+from .model.scan import DirectoryContents
+from .model.preview import negotiate_format
+from .model.thumbnail import render_keyed_thumbnail, thumbnail_file_name
+from .utils.exifdata import _fast_naive, _fast_offset
+from .utils.exiftool_ctxmngr import ExifTool, ExifToolError, ExifToolPool, ExifToolTimeoutError
+from .utils.http_range import RangeNotSatisfiable, parse_range
+from .utils.preview_cache import PreviewCache
+from .utils.priority_pool import PriorityProcessPool
+from .utils.thumbnail_pack import ThumbnailPack
+
+
+def save_jpeg(path, make="FUJIFILM", model="X-T20", date_time="2021:05:01 10:00:00", orientation=1):
+    exif = PIL_Image.Exif()
+    exif[0x010F] = make
+    exif[0x0110] = model
+    exif[0x0112] = orientation
+    exif[0x8769] = {0x9003: date_time, 0x9011: "+02:00"}
+    PIL_Image.new("RGB", (64, 48), (200, 0, 0)).save(path, exif=exif)
+
+
+def leaving_out(*names):
+    """ Makes exiftool leave out the records of these files, like it does for files it cannot read """
+    get_metadata = ExifTool.get_metadata
+    def without(et, *filenames):
+        return [json for json in get_metadata(et, *filenames) if os.path.basename(json["SourceFile"]) not in names]
+    return mock.patch.object(ExifTool, "get_metadata", without)
+
+
+def like_exiftool_for_removed_files():
+    """ Makes the fake exiftool answer like exiftool does when none of the files of a read exist: nothing on stdout """
+    execute_many = ExifTool.execute_many
+    def removed(et, commands, timeout=None):
+        outputs = execute_many(et, commands, timeout)
+        for i, args in enumerate(commands):
+            files = [arg for arg in args if os.path.isabs(arg)]
+            if "-j" in args and files and not any(os.path.exists(f) for f in files):
+                outputs[i] = ("", "".join(f"Error: File not found - {f}\n" for f in files))
+        return outputs
+    return mock.patch.object(ExifTool, "execute_many", removed)
+
+
+def real_exiftool() -> bool:
+    with ExifToolService.instance().pool.lease() as et:
+        return re.match(r"\d+\.\d+", et.execute("-ver").strip()) is not None
+
+
+class ReadMetadataTest(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ["IMG_1.jpg", "IMG_2.jpg", "IMG_3.jpg"]:
+            save_jpeg(os.path.join(self.path, name))
+        self.images = [Image(name=name) for name in ["IMG_1.jpg", "IMG_2.jpg", "IMG_3.jpg"]]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_records_in_order(self):
+        records = list(ExifToolService.instance().read_metadata(self.path, *self.images))
+        self.assertEqual([os.path.basename(json["SourceFile"]) for json in records], ["IMG_1.jpg", "IMG_2.jpg", "IMG_3.jpg"])
+
+    def test_unreadable_file_is_left_out(self):
+        with leaving_out("IMG_2.jpg"):
+            chunks = list(ExifToolService.instance().read_metadata_chunks(self.path, *self.images, chunk_size=2))
+        self.assertEqual([[os.path.basename(json["SourceFile"]) for json in chunk] for chunk in chunks], [["IMG_1.jpg"], ["IMG_3.jpg"]])
+
+    def test_chunk_of_removed_files(self):
+        for name in ["IMG_1.jpg", "IMG_2.jpg"]:
+            os.remove(os.path.join(self.path, name))
+        with like_exiftool_for_removed_files():
+            chunks = list(ExifToolService.instance().read_metadata_chunks(self.path, *self.images, chunk_size=2))
+        self.assertEqual([[os.path.basename(json["SourceFile"]) for json in chunk] for chunk in chunks], [[], ["IMG_3.jpg"]])
+
+    def test_unreadable_file_with_native_reader(self):
+        service = ExifToolService.instance()
+        with mock.patch.object(service, "native_reader", JpegMetadataReader()), \
+                mock.patch.object(JpegMetadataReader, "read", side_effect=lambda path: None), leaving_out("IMG_1.jpg"):
+            records = list(service.read_metadata(self.path, *self.images, fast=True))
+        self.assertEqual([os.path.basename(json["SourceFile"]) for json in records], ["IMG_2.jpg", "IMG_3.jpg"])
+
+    def test_sidecars_are_matched_by_source_file(self):
+        for name in ["VID_1.MOV", "VID_2.MOV", "VID_1.MOV.xmp", "VID_2.MOV.xmp"]:
+            open(os.path.join(self.path, name), "w").close()
+        def get_metadata(et, *filenames):
+            # nothing for VID_1.MOV, as if exiftool could not read it
+            return [{"SourceFile": f, "XMP-xmp:Rating": 3 if f.endswith(".xmp") else 0} for f in filenames if not f.endswith("VID_1.MOV")]
+        with mock.patch.object(ExifTool, "get_metadata", get_metadata):
+            records = list(ExifToolService.instance().read_metadata(self.path, Image(name="VID_1.MOV"), Image(name="VID_2.MOV")))
+        self.assertEqual([(os.path.basename(json["SourceFile"]), json["XMP-xmp:Rating"]) for json in records], [("VID_2.MOV", 3)])
+
+    @skipUnless(real_exiftool(), "needs exiftool")
+    def test_native_reader_matches_exiftool(self):
+        save_jpeg(os.path.join(self.path, "IMG_4.jpg"), make="Apple", model="iPhone", date_time="2022:12:31 23:59:59", orientation=6)
+        paths = [os.path.join(self.path, name) for name in ["IMG_1.jpg", "IMG_4.jpg"]]
+        with ExifToolService.instance().pool.lease() as et:
+            exiftool = et.get_metadata(*paths)
+        for path, expected in zip(paths, exiftool):
+            native = JpegMetadataReader().read(path)
+            self.assertIsNotNone(native)
+            for key, value in native.items():
+                if key not in ["SourceFile", "System:FileModifyDate"]:
+                    self.assertEqual(value, expected.get(key), f"{key} of {os.path.basename(path)}")
+
+
+class ExifToolPoolTest(SimpleTestCase):
+    def setUp(self):
+        self.pool = ExifToolPool(size=1)
+        self.addCleanup(self.pool.close)
+        with self.pool.lease() as et:
+            self.process = et.process
+
+    def test_empty_answer(self):
+        with like_exiftool_for_removed_files(), self.pool.lease() as et:
+            self.assertEqual(et.get_metadata("/nonexistent/IMG_1.jpg"), [])
+        with self.pool.lease() as et:
+            self.assertIs(et.process, self.process)
+
+    def test_failed_answer_leaves_the_process_usable(self):
+        with mock.patch.object(ExifTool, "execute", return_value="Warning: not JSON"), self.assertRaises(ExifToolError):
+            with self.pool.lease() as et:
+                et.get_metadata("/nonexistent/IMG_1.jpg")
+        with self.pool.lease() as et:
+            self.assertIs(et.process, self.process)
+            self.assertTrue(et.execute("-ver").strip())
+
+    def test_process_out_of_step_is_replaced(self):
+        with self.assertRaises(ExifToolTimeoutError):
+            with self.pool.lease() as et:
+                et.execute("-j", "/nonexistent/HANG", timeout=0.5)
+        with self.pool.lease() as et:
+            self.assertIsNot(et.process, self.process)
+            self.assertTrue(et.execute("-ver").strip())
+
+        with mock.patch("select.select", side_effect=KeyboardInterrupt), self.assertRaises(KeyboardInterrupt):
+            with self.pool.lease() as et:
+                process = et.process
+                et.execute("-ver")
+        self.assertIsNotNone(process.poll())
+        self.assertEqual(self.pool.idle, [])
+
+
+class WriteMetadataTest(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.files = [os.path.join(self.path, f"IMG_{i}.jpg") for i in range(10)]
+        for path in self.files:
+            save_jpeg(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_execute_many(self):
+        missing = os.path.join(self.path, "missing.jpg")
+        with ExifToolService.instance().pool.lease() as et:
+            outputs = et.execute_many([("-overwrite_original", "-XMP-xmp:Rating=1", self.files[0]), ("-overwrite_original", "-XMP-xmp:Rating=2", missing), ("-ver",)])
+        self.assertEqual(len(outputs), 3)
+        self.assertNotIn("Error", outputs[0][1])
+        self.assertIn(f"Error: File not found - {missing}", outputs[1][1])
+        self.assertNotIn("Error", outputs[2][1])
+
+    def test_files_with_their_own_arguments_share_round_trips(self):
+        plan = MetadataWritePlan()
+        for i, path in enumerate(self.files):
+            plan.add(i, [f"-XMP-xmp:Rating={i % 5}", f"-XMP-dc:Title=title {i}"], path)
+        plan.add(10, ["-XMP-xmp:Rating=1"], os.path.join(self.path, "missing.jpg"))
+
+        service = ExifToolService.instance()
+        with mock.patch.object(ExifTool, "execute_many", autospec=True, side_effect=ExifTool.execute_many) as execute_many:
+            result = service.write_planned(plan, workers=2)
+        self.assertEqual(execute_many.call_count, 2)
+        self.assertEqual(sum(len(call.args[1]) for call in execute_many.call_args_list), 11)
+        self.assertEqual(sorted(result.written), sorted(self.files))
+        self.assertEqual(list(result.failed), [os.path.join(self.path, "missing.jpg")])
+
+
+class ScanTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ["IMG_1.jpg", "IMG_2.jpg", "IMG_3.jpg"]:
+            save_jpeg(os.path.join(self.path, name))
+        # the thumbnails are made in the background, the scans here don't need them
+        patcher = mock.patch.object(Image, "refresh_thumbnails")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_unreadable_file_does_not_stop_the_scan(self):
+        directory = Directory.objects.create(path=self.path)
+        with leaving_out("IMG_2.jpg"):
+            directory.scan()
+        self.assertEqual(sorted(directory.images.values_list("name", flat=True)), ["IMG_1.jpg", "IMG_3.jpg"])
+
+        # read again once exiftool can
+        directory.scan()
+        self.assertEqual(sorted(directory.images.values_list("name", flat=True)), ["IMG_1.jpg", "IMG_2.jpg", "IMG_3.jpg"])
+
+    def test_rescan_keeps_unwritten_edits(self):
+        directory = Directory.objects.create(path=self.path)
+        directory.scan()
+        directory.images.filter(name="IMG_1.jpg").update(rating=5, metadata_dirty=True)
+
+        path = os.path.join(self.path, "IMG_1.jpg")
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+        directory.scan()
+        img = directory.images.get(name="IMG_1.jpg")
+        self.assertEqual((img.rating, img.metadata_dirty), (5, True))
+        self.assertEqual(img.file_mtime_ns, os.stat(path).st_mtime_ns)
+
+    def test_reparse_keeps_unwritten_edits(self):
+        directory = Directory.objects.create(path=self.path)
+        directory.scan()
+        directory.images.filter(name="IMG_1.jpg").update(rating=5, metadata_dirty=True)
+
+        self.assertEqual(MetadataReparseService.instance().reparse(), (2, 1))
+        self.assertEqual(directory.images.get(name="IMG_1.jpg").rating, 5)
+
+        self.assertEqual(MetadataReparseService.instance().reparse(discard_edits=True), (3, 0))
+        img = directory.images.get(name="IMG_1.jpg")
+        self.assertEqual((img.rating, img.metadata_dirty), (0, False))
+
+
+class SidecarScanTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        save_jpeg(os.path.join(self.path, "IMG_1.jpg"))
+        # the fake exiftool reads the tags of a file from its JSON contents
+        for name, tags in [("VID_1.MOV", '{}'), ("VID_1.MOV.xmp", '{"MWG:Rating": 4}')]:
+            with open(os.path.join(self.path, name), "w") as f:
+                f.write(tags)
+        patcher = mock.patch.object(Image, "refresh_thumbnails")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = Directory.objects.create(path=self.path)
+        self.directory.scan()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def to_read(self):
+        contents = DirectoryContents.read(self.path, self.directory.known_fingerprints(), reads_sidecar=ExifToolService.instance().reads_sidecar)
+        return sorted(f.name for f in contents.to_read)
+
+    def test_removed_sidecar(self):
+        self.assertEqual(self.directory.images.get(name="VID_1.MOV").rating, 4)
+        os.remove(os.path.join(self.path, "VID_1.MOV.xmp"))
+        self.assertEqual(self.to_read(), ["VID_1.MOV"])
+        self.directory.scan()
+        self.assertEqual(self.directory.images.get(name="VID_1.MOV").rating, 0)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_sidecar_of_a_file_written_in_place(self):
+        with open(os.path.join(self.path, "IMG_1.jpg.xmp"), "w") as f:
+            f.write('{"MWG:Rating": 4}')
+        self.assertEqual(self.to_read(), [])
+        self.directory.scan()
+        os.remove(os.path.join(self.path, "IMG_1.jpg.xmp"))
+        self.assertEqual(self.to_read(), [])
+
+
+class WriteBackTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ["IMG_1.jpg", "IMG_2.jpg"]:
+            save_jpeg(os.path.join(self.path, name))
+        patcher = mock.patch.object(Image, "refresh_thumbnails")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = Directory.objects.create(path=self.path)
+        self.directory.scan()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_edit_while_writing_stays_dirty(self):
+        self.directory.images.update(rating=5, metadata_dirty=True)
+        images = list(self.directory.images.order_by("name"))
+        for img in images:
+            MetadataWriteBack.objects.create(image=img, due=timezone.now())
+
+        write_planned = ExifToolService.write_planned
+        def edited_while_writing(service, *args, **kwargs):
+            result = write_planned(service, *args, **kwargs)
+            Image.objects.filter(id=images[0].id).update(rating=4)
+            MetadataWriteBack.objects.filter(image=images[0]).update(version=F("version") + 1)
+            return result
+        with mock.patch.object(ExifToolService, "write_planned", edited_while_writing):
+            self.directory.write_metadata_of(images)
+
+        edited, written = self.directory.images.order_by("name")
+        self.assertEqual((edited.rating, edited.metadata_dirty), (4, True))
+        self.assertEqual((written.rating, written.metadata_dirty), (5, False))
+        # the rating that was written is not written again, the new one is
+        self.assertEqual([t.name for t in edited.changed_metadata_types()], ["RATING"])
+
+    def test_edit_while_writing_is_not_claimed_twice(self):
+        service = WriteBackService()
+        service.enabled, service.delay = True, 0
+        img = self.directory.images.get(name="IMG_1.jpg")
+        Image.objects.filter(id=img.id).update(rating=5, metadata_dirty=True)
+        MetadataWriteBack.objects.create(image=img, due=timezone.now())
+
+        write_metadata_of = Directory.write_metadata_of
+        def edited_while_writing(directory, images, *args, **kwargs):
+            Image.objects.filter(id=img.id).update(rating=4)
+            service.enqueue([img.id])
+            # no other worker can claim it while it is written
+            self.assertEqual(list(MetadataWriteBack.objects.values_list("status", "version")), [("writing", 1)])
+            return write_metadata_of(directory, images, *args, **kwargs)
+        with mock.patch.object(service, "ensure_running"), mock.patch.object(Directory, "write_metadata_of", edited_while_writing):
+            self.assertEqual(service.write_due(), 1)
+        self.assertEqual(list(MetadataWriteBack.objects.values_list("status", "version", "claimed_at")), [("pending", 1, None)])
+
+        # the new version is written next
+        self.assertEqual(service.write_due(), 1)
+
+    def test_only_stale_rows_are_reclaimed(self):
+        now = timezone.now()
+        img_1, img_2 = self.directory.images.order_by("name")
+        MetadataWriteBack.objects.create(image=img_1, due=now, status="writing", claimed_at=now - timedelta(minutes=1))
+        MetadataWriteBack.objects.create(image=img_2, due=now, status="writing", claimed_at=now - WriteBackService.CLAIM_TIMEOUT - timedelta(minutes=1))
+
+        self.assertEqual(WriteBackService().reclaim_stale(), 1)
+        self.assertEqual(dict(MetadataWriteBack.objects.values_list("image__name", "status")), {"IMG_1.jpg": "writing", "IMG_2.jpg": "pending"})
+
+
+class ThumbnailBatchViewTest(TestCase):
+    def test_malformed_id(self):
+        self.assertEqual(self.client.get("/main/img/thumbnails?ids=1,x").status_code, 400)
+
+    def test_no_thumbnails_ready(self):
+        response = self.client.get("/main/img/thumbnails?ids=1,2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"\0\0\0\x02[]")
+
+
+class RenderKeyedThumbnailTest(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, "IMG_1.jpg")
+        save_jpeg(self.file)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_existing_thumbnail_is_not_made_again(self):
+        root = os.path.join(self.path, "media")
+        made = render_keyed_thumbnail(self.file, 300, 200, root=root, levels=[1280])
+        self.assertIsNotNone(made.data)
+        self.assertEqual(list(made.previews), [1280])
+
+        os.makedirs(os.path.dirname(os.path.join(root, thumbnail_file_name(made.key))))
+        with open(os.path.join(root, thumbnail_file_name(made.key)), "wb") as f:
+            f.write(made.data)
+        # e.g. the image moved: the previews are made when the viewer asks for them, not by decoding it here
+        again = render_keyed_thumbnail(self.file, 300, 200, root=root, levels=[1280])
+        self.assertEqual((again.key, again.data, again.previews), (made.key, None, {}))
+
+
+class TagIndexTest(TestCase):
+    def setUp(self):
+        places = Tag.objects.create(name="Places")
+        Tag.objects.create(parent=places, name="Belgium")
+        self.index = TagIndex()
+
+    def test_find(self):
+        belgium = Tag.objects.get(name="Belgium")
+        self.assertEqual(self.index.find("Places/Belgium"), belgium.id)
+        self.assertEqual(self.index.full_name(belgium.id), "Places/Belgium")
+        self.assertIsNone(self.index.find("Places/France"))
+
+    def test_tag_of_another_process(self):
+        self.index.find("Places")
+        # no signals, like a tag that was added by another process
+        Tag.objects.bulk_create([Tag(parent=Tag.objects.get(name="Places"), name="France")])
+        self.assertEqual(self.index.find("Places/France"), Tag.objects.get(name="France").id)
+
+    def test_invalidated_while_loading(self):
+        load = self.index._load
+        def invalidated_while_loading():
+            index = load()
+            self.index.invalidate()
+            return index
+        with mock.patch.object(self.index, "_load", invalidated_while_loading):
+            self.index.find("Places")
+        self.assertIsNone(self.index.index)
+
+    def test_invalidated_on_commit(self):
+        index = TagIndex.instance()
+        # left over by other tests
+        index.invalidate()
+        index.find("Places")
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.filter(name="Belgium").update(name="Belgie")
+            Tag.objects.get(name="Belgie").save()
+            self.assertIsNotNone(index.index)
+        self.assertIsNone(index.index)
+        self.assertEqual(index.full_name(Tag.objects.get(name="Belgie").id), "Places/Belgie")
+
+
+class PriorityProcessPoolTest(SimpleTestCase):
+    def test_slow_on_done_does_not_hold_up_the_workers(self):
+        release = threading.Event()
+        done = []
+        def on_done(context, result, exc):
+            release.wait(10)
+            done.append((context, result, threading.current_thread().name))
+        pool = PriorityProcessPool(abs, on_done, workers=1)
+        self.addCleanup(pool.shutdown)
+        for i in range(4):
+            pool.submit((-i,), context=i)
+
+        deadline = time.monotonic() + 30
+        while pool.stats()["completed"] < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(pool.stats()["completed"], 4)
+        self.assertEqual(done, [])
+
+        release.set()
+        while len(done) < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(done, [(i, i, "priority-pool-completer") for i in range(4)])
+
+
+class ParallelScanTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for subdir in ["", "a", "a/b", "c"]:
+            os.makedirs(os.path.join(self.path, subdir), exist_ok=True)
+            for i in range(3):
+                save_jpeg(os.path.join(self.path, subdir, f"IMG_{i}.jpg"), date_time=f"2021:05:0{i + 1} 10:00:00")
+                with open(os.path.join(self.path, subdir, f"IMG_{i}.RAF"), "w") as f:
+                    f.write("raw")
+        with open(os.path.join(self.path, "a", "IMG_0.jpg.xmp"), "w") as f:
+            f.write("<x:xmpmeta/>")
+        patcher = mock.patch.object(Image, "refresh_thumbnails")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def db_state(self):
+        """ Everything a scan writes, without the ids """
+        dirs = {d.id: d.get_absolute_path() for d in Directory.objects.all()}
+        fields = ["name", *Image.METADATA_FIELDS, *Image.FINGERPRINT_FIELDS]
+        images = sorted((dirs[img.parent_id], *[getattr(img, field) for field in fields]) for img in Image.objects.all())
+        attachments = sorted((dirs[att.parent.parent_id], att.parent.name, att.name, att.attachment_type, *[getattr(att, field) for field in Image.FINGERPRINT_FIELDS]) for att in Attachment.objects.select_related("parent"))
+        tags = sorted((dirs[row.image.parent_id], row.image.name, row.tag_id) for row in Image.tags.through.objects.select_related("image"))
+        return sorted(dirs.values()), images, attachments, tags
+
+    def test_same_db_state_as_the_serial_scan(self):
+        Directory.objects.create(path=self.path).scan()
+        serial = self.db_state()
+        self.assertEqual(len(serial[0]), 4)
+        self.assertEqual(len(serial[1]), 12)
+
+        Directory.objects.all().delete()
+        ScanService.instance().scan(Directory.objects.create(path=self.path), workers=3)
+        self.assertEqual(self.db_state(), serial)
+
+    def test_same_db_state_after_changes(self):
+        directory = Directory.objects.create(path=self.path)
+        directory.scan()
+        os.remove(os.path.join(self.path, "c", "IMG_1.jpg"))
+        shutil.rmtree(os.path.join(self.path, "a", "b"))
+        save_jpeg(os.path.join(self.path, "a", "IMG_3.jpg"))
+        save_jpeg(os.path.join(self.path, "IMG_0.jpg"), model="X-T30")
+
+        with transaction.atomic():
+            directory.scan()
+            serial = self.db_state()
+            transaction.set_rollback(True)
+        ScanService.instance().scan(directory, workers=3)
+        self.assertEqual(self.db_state(), serial)
+
+
+class ParseRangeTest(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range("bytes=0-99", 1000), [(0, 99)])
+        self.assertEqual(parse_range("bytes=900-", 1000), [(900, 999)])
+        self.assertEqual(parse_range("bytes=-100", 1000), [(900, 999)])
+        self.assertEqual(parse_range("bytes=-2000", 1000), [(0, 999)])
+        self.assertEqual(parse_range("bytes=0-5000", 1000), [(0, 999)])
+        self.assertEqual(parse_range("bytes=0-9, 20-29,-5", 1000), [(0, 9), (20, 29), (995, 999)])
+        # the ones past the end are left out
+        self.assertEqual(parse_range("bytes=0-9,2000-3000", 1000), [(0, 9)])
+
+    def test_ignored(self):
+        for header in ["items=0-9", "bytes=", "bytes=9-0", "bytes=a-9", "bytes=-", "bytes=0-9;1", ",".join(["bytes=0-0"] + ["1-1"] * 32)]:
+            self.assertIsNone(parse_range(header, 1000), header)
+
+    def test_not_satisfiable(self):
+        for header in ["bytes=1000-", "bytes=5000000-", "bytes=1000-2000", "bytes=-0"]:
+            with self.assertRaises(RangeNotSatisfiable, msg=header):
+                parse_range(header, 1000)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range("bytes=-10", 0)
+
+
+class FastDateTimeTest(SimpleTestCase):
+    def test_naive_like_strptime(self):
+        for value in ["2021:05:01 10:00:00", "1999:12:31 23:59:59", "2024:02:29 00:00:00", "2021:05:01 10:00:00.123"]:
+            self.assertEqual(_fast_naive(value), datetime.strptime(value[:19], "%Y:%m:%d %H:%M:%S"), value)
+
+    def test_naive_leaves_the_rest_to_strptime(self):
+        for value in ["0000:00:00 00:00:00", "2023:02:29 10:00:00", "2021-05-01 10:00:00", "2021:05:01", "2021:05:01 1a:00:00", "２０２１:05:01 10:00:00"]:
+            self.assertIsNone(_fast_naive(value), value)
+
+    def test_offset_like_strptime(self):
+        for value in ["+02:00", "-05:30", "+0100", "-1200", "+00:00", "Z"]:
+            expected = datetime.strptime("2021:05:01 10:00:00" + value, "%Y:%m:%d %H:%M:%S%z").tzinfo
+            self.assertEqual(_fast_offset(value), expected, value)
+
+    def test_offset_leaves_the_rest_to_strptime(self):
+        for value in ["", "+2:00", "+02:60", "+24:00", "02:00", "+02-00", "UTC"]:
+            self.assertIsNone(_fast_offset(value), value)
+
+
+class ThumbnailPackTest(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pack = ThumbnailPack(os.path.join(self.path, "1.pack"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append_and_read(self):
+        first = self.pack.append(1, b"first")
+        second = self.pack.append(2, b"second")
+        self.assertEqual(self.pack.read(1, *first), b"first")
+        self.assertEqual(self.pack.read(2, *second), b"second")
+        # not the record of that key
+        self.assertIsNone(self.pack.read(2, *first))
+        self.assertFalse(self.pack.contains(1, first[0] + 1, first[1]))
+        self.assertIsNone(self.pack.read(3, first[0], 10 ** 6))
+
+    def test_compact(self):
+        live = {1: self.pack.append(1, b"one")}
+        self.pack.append(2, b"two, removed")
+        live[2] = self.pack.append(2, b"two")
+        live[3] = self.pack.append(3, b"three")
+        before = self.pack.size()
+
+        moved = self.pack.compact({key: live[key] for key in [2, 3]})
+        self.assertEqual(self.pack.size(), self.pack.used_bytes(moved))
+        self.assertLess(self.pack.size(), before)
+        self.assertEqual({key: self.pack.read(key, *location) for key, location in moved.items()}, {2: b"two", 3: b"three"})
+        # where they were before is no longer valid
+        self.assertIsNone(self.pack.read(3, *live[3]))
+
+    def test_compact_leaves_out_unknown_records(self):
+        location = self.pack.append(1, b"one")
+        self.assertEqual(self.pack.compact({1: location, 2: (location[0], 2)}), {1: location})
+
+
+class NegotiateFormatTest(SimpleTestCase):
+    def test_negotiate(self):
+        chrome = "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8"
+        self.assertEqual(negotiate_format(chrome, ["AVIF", "WEBP"]), "AVIF")
+        self.assertEqual(negotiate_format(chrome, ["WEBP"]), "WEBP")
+        self.assertEqual(negotiate_format("image/webp;q=0.9, image/avif;q=0", ["AVIF", "WEBP"]), "WEBP")
+        self.assertEqual(negotiate_format("IMAGE/WEBP", ["WEBP"]), "WEBP")
+
+    def test_jpeg_without_a_match(self):
+        for accept in [None, "", "*/*", "image/*", "image/webp;q=x", "image/png,image/jpeg"]:
+            self.assertEqual(negotiate_format(accept, ["AVIF", "WEBP"]), "JPEG", accept)
+        self.assertEqual(negotiate_format("image/webp", []), "JPEG")
+
+
+class AttachmentMatcherTest(SimpleTestCase):
+    def test_find_related_image(self):
+        jpg, mov = Image(name="IMG_1.JPG"), Image(name="MVI_2.MOV")
+        matcher = AttachmentMatcher([jpg, mov], ["IMG_1.RAF"])
+        for name, image in [("IMG_1.RAF", jpg), ("IMG_1.xmp", jpg), ("IMG_1.JPG.xmp", jpg), ("IMG_1.JPG.XMP", jpg),
+                ("IMG_1.RAF.xmp", jpg), ("IMG_1.JPG_original", jpg), ("MVI_2.MOV.xmp", mov), ("MVI_2.THM", mov),
+                ("IMG_3.RAF", None), ("IMG_3.RAF.xmp", None), ("notes.txt", None)]:
+            self.assertIs(matcher.find_related_image(name), image, name)
+        self.assertTrue(matcher.is_known("IMG_1.RAF"))
+        self.assertFalse(matcher.is_known("IMG_1.xmp"))
+
+    def test_first_image_with_a_stem_wins(self):
+        jpg, heic = Image(name="IMG_1.JPG"), Image(name="IMG_1.HEIC")
+        matcher = AttachmentMatcher([jpg, heic])
+        self.assertIs(matcher.find_related_image("IMG_1.RAF"), jpg)
+        self.assertIs(matcher.find_related_image("IMG_1.HEIC.xmp"), heic)
+
+
+class PreviewCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_open_file_survives_eviction(self):
+        cache = PreviewCache(self.path, 10)
+        cache.put("a", b"12345678")
+        with cache.open("a") as f:
+            cache.put("b", b"12345678")
+            self.assertIsNone(cache.open("a"))
+            self.assertEqual(f.read(), b"12345678")
+        self.assertEqual(cache.stats()["files"], 1)
+
+    def test_preview_when_everything_is_evicted(self):
+        src = os.path.join(self.path, "IMG_1.jpg")
+        PIL_Image.new("RGB", (3000, 2000), (200, 0, 0)).save(src)
+        service = PreviewService.instance()
+        # room for one file: storing the preview evicts the level it was made from
+        patcher = mock.patch.object(service, "cache", PreviewCache(os.path.join(self.path, "previews"), 1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        fingerprint = (1, 2, 3)
+        for _ in range(2):
+            with service.preview(src, fingerprint, 800, 600) as f, PIL_Image.open(f) as preview:
+                self.assertEqual(preview.size, (800, 533))
+        with service.preview(src, fingerprint, 1280, 1280) as f, PIL_Image.open(f) as preview:
+            self.assertEqual(preview.size, (1280, 853))
+
+
+class PreviewViewTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, "IMG_1.jpg")
+        save_jpeg(self.file)
+        patcher = mock.patch.object(Image, "refresh_thumbnails")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        directory = Directory.objects.create(path=self.path)
+        directory.scan()
+        self.url = f"/main/img/{directory.images.get().id}/download?maxw=32&maxh=32"
+        patcher = mock.patch.object(PreviewService.instance(), "cache", PreviewCache(os.path.join(self.path, "previews"), 10 ** 6))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_file_edited_since_the_scan(self):
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        PIL_Image.new("RGB", (64, 48), (0, 0, 200)).save(self.file)
+        os.utime(self.file, ns=(os.stat(self.file).st_atime_ns, os.stat(self.file).st_mtime_ns + 10**9))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        with PIL_Image.open(io.BytesIO(b"".join(response.streaming_content))) as preview:
+            self.assertGreater(preview.getpixel((0, 0))[2], 150)
+
+
+class DirectoryWatcherTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for subdir in ["a", "b"]:
+            os.makedirs(os.path.join(self.path, subdir))
+        save_jpeg(os.path.join(self.path, "a", "IMG_1.jpg"))
+        for name in ["IMG_1.RAF", "IMG_1.jpg.xmp"]:
+            with open(os.path.join(self.path, "a", name), "w") as f:
+                f.write(name)
+        patcher = mock.patch.object(Image, "refresh_thumbnails")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.root = Directory.objects.create(path=self.path)
+        self.root.scan()
+        self.watcher = DirectoryWatcherService()
+        self.addCleanup(self.watcher.inotify.close)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def listdir(self, subdir):
+        return sorted(os.listdir(os.path.join(self.path, subdir)))
+
+    def test_attachments_moved_along_keep_their_rows(self):
+        a, b = self.root.subdirs.get(path="a"), self.root.subdirs.get(path="b")
+        # like mv IMG_1.jpg IMG_1.RAF ../b, leaving the sidecar behind
+        for name in ["IMG_1.jpg", "IMG_1.RAF"]:
+            os.rename(os.path.join(self.path, "a", name), os.path.join(self.path, "b", name))
+            self.watcher._rename(a.id, name, b.id, name)
+
+        # the watcher only changes the DB
+        self.assertEqual(self.listdir("a"), ["IMG_1.jpg.xmp"])
+        self.assertEqual(self.listdir("b"), ["IMG_1.RAF", "IMG_1.jpg"])
+        img = Image.objects.get(name="IMG_1.jpg")
+        raf = img.attachments.get(name="IMG_1.RAF")
+        self.assertEqual(img.parent_id, b.id)
+
+        a.scan()
+        b.scan()
+        self.assertEqual(self.listdir("a"), ["IMG_1.jpg.xmp"])
+        self.assertEqual(list(img.attachments.values_list("id", "name")), [(raf.id, "IMG_1.RAF")])
+        self.assertEqual(Image.objects.count(), 1)
+
+    def test_only_the_image_moved(self):
+        a, b = self.root.subdirs.get(path="a"), self.root.subdirs.get(path="b")
+        os.rename(os.path.join(self.path, "a", "IMG_1.jpg"), os.path.join(self.path, "b", "IMG_1.jpg"))
+        self.watcher._rename(a.id, "IMG_1.jpg", b.id, "IMG_1.jpg")
+
+        self.assertEqual(self.listdir("a"), ["IMG_1.RAF", "IMG_1.jpg.xmp"])
+        self.assertEqual(self.listdir("b"), ["IMG_1.jpg"])
+        a.scan()
+        b.scan()
+        self.assertEqual(Image.objects.get(name="IMG_1.jpg").parent_id, b.id)
+        self.assertEqual(Attachment.objects.count(), 0)
@@ -7,6 +7,9 @@ from .rest import views
 app_name = "main"
 urlpatterns = [
     path("img/<int:pk>/download", image.ImageDownloadView.as_view(), name="img_download"),
+    path("img/<int:pk>/thumbnail", image.ImageThumbnailView.as_view(), name="img_thumbnail"),
+    path("img/<int:pk>/thumbnail/<slug:key>", image.ImageThumbnailView.as_view(), name="img_thumbnail_key"),
+    path("img/thumbnails", image.ThumbnailBatchView.as_view(), name="img_thumbnails"),
 
     path("api/dirs", views.RootListView.as_view(), name="root-list"),
     path("api/dir/<int:pk>/detail", views.DirectoryDetailView.as_view(), name="directory-detail"),
@@ -14,6 +17,11 @@ urlpatterns = [
     path("api/dir/<int:pk>/actions", views.DirectoryActionsView.as_view(), name="directory-actions"),
     path("api/dir/<int:pk>/tracks", views.DirectoryTracksView.as_view(), name="directory-track"),
 
+    path("api/scanjob/<int:pk>", views.ScanJobDetailView.as_view(), name="scanjob-detail"),
+    path("api/scanjob/<int:pk>/actions", views.ScanJobActionsView.as_view(), name="scanjob-actions"),
+    path("api/writeback", views.WriteBackStatusView.as_view(), name="writeback-status"),
+    path("api/thumbnails", views.ThumbnailStatusView.as_view(), name="thumbnail-status"),
+
     path("api/imgset/actions", views.ImageSetActionsView.as_view(), name="image-set-actions"),
 
     path("api/img/<int:pk>/metadata", views.ImageMetadataView.as_view(), name="image-metadata"),
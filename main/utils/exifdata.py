@@ -1,33 +1,92 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from .datetime import has_timezone
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# the offsets seen so far, e.g. "+02:00". There are only a handful of them, so every file of a trip shares one object.
+_offsets = {}
+
+
+def _fast_offset(tz_str: str) -> timezone:
+    """ The timezone of an offset in the form exiftool writes it ("+HH:MM", "+HHMM" or "Z"), or None for anything
+    else, which is then left to strptime. """
+    tz = _offsets.get(tz_str)
+    if tz is None:
+        if tz_str == "Z":
+            tz = timezone.utc
+        elif len(tz_str) in (5, 6) and tz_str[0] in "+-" and (len(tz_str) == 5 or tz_str[3] == ":"):
+            digits = tz_str[1:3] + tz_str[-2:]
+            if not (digits.isascii() and digits.isdigit()) or int(digits[2:]) >= 60:
+                return None
+            delta = timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+            if delta >= timedelta(hours=24):
+                return None
+            tz = timezone(-delta if tz_str[0] == "-" else delta)
+        else:
+            return None
+        _offsets[tz_str] = tz
+    return tz
+
+
+def _fast_naive(dt_str: str) -> datetime:
+    """ Decodes the fixed-width "YYYY:MM:DD HH:MM:SS" by slicing, which is a lot cheaper than strptime. Returns None
+    when dt_str is not exactly that, so the caller can fall back to strptime. """
+    if len(dt_str) < 19 or dt_str[4] != ":" or dt_str[7] != ":" or dt_str[10] != " " or dt_str[13] != ":" or dt_str[16] != ":":
+        return None
+    digits = dt_str[0:4] + dt_str[5:7] + dt_str[8:10] + dt_str[11:13] + dt_str[14:16] + dt_str[17:19]
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    try:
+        return datetime(int(digits[0:4]), int(digits[4:6]), int(digits[6:8]), int(digits[8:10]), int(digits[10:12]), int(digits[12:14]))
+    except ValueError:
+        # e.g. the "0000:00:00 00:00:00" some cameras write
+        return None
+
+
+def _fast_full(dt_str: str) -> datetime:
+    naive = _fast_naive(dt_str)
+    if naive is None:
+        return None
+    tz = _fast_offset(dt_str[19:])
+    return naive.replace(tzinfo=tz) if tz is not None else None
+
+
 def parse_file_filemodifytime(dt_str: str) -> datetime:
-    return datetime.strptime(dt_str, "%Y:%m:%d %H:%M:%S%z")
+    dt = _fast_full(dt_str)
+    return dt if dt is not None else datetime.strptime(dt_str, "%Y:%m:%d %H:%M:%S%z")
 
 
 """ Returns a *naive* datetime (no timezone information) """
 def parse_exif_datetimeoriginal(dt_str: str) -> datetime:
+    if len(dt_str) == 19:
+        dt = _fast_naive(dt_str)
+        if dt is not None:
+            return dt
     try:
         return datetime.strptime(dt_str, "%Y:%m:%d %H:%M:%S")
     except ValueError:
-        logger.warn(f"Could not parse {dt_str} to a valid naive date")
+        logger.warning("Could not parse %s to a valid naive date", dt_str)
         return None
 
 
 """ Returns a *full* datetime (including timezone information) """
 def parse_exif_fulldatetime(dt_str: str) -> datetime:
+    dt = _fast_full(dt_str)
+    if dt is not None:
+        return dt
     try:
         return datetime.strptime(dt_str, "%Y:%m:%d %H:%M:%S%z")
     except ValueError:
-        logger.warn(f"Could not parse {dt_str} to a valid full date")
+        logger.warning("Could not parse %s to a valid full date", dt_str)
         return None
 
 
 def parse_exif_offsettime(et_str: str) -> timezone:
+    tz = _fast_offset(et_str)
+    if tz is not None:
+        return tz
     try:
         dt = datetime.strptime(et_str.replace(":", ""), "%z")
         if has_timezone(dt):
@@ -35,7 +94,7 @@ def parse_exif_offsettime(et_str: str) -> timezone:
         else:
             return None
     except ValueError:
-        logger.warn(f"Could not parse {et_str} to a time offset")
+        logger.warning("Could not parse %s to a time offset", et_str)
         return None
 
 
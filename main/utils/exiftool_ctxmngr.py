@@ -4,43 +4,230 @@ import subprocess
 import os
 import json
 import logging
+import select
+import threading
+import time
 
+from contextlib import contextmanager
 
-class ExifTool(object):
 
-    sentinel = b"{ready}\n"
+class ExifToolError(Exception):
+    pass
+
+
+class ExifToolTimeoutError(ExifToolError):
+    pass
+
+
+def read_response(stdout_fd: int, stderr_fd: int, stdout_sentinel: bytes, stderr_sentinel: bytes, deadline: float = None):
+    """ Reads from both pipes until each of them ended with its sentinel, and returns (stdout, stderr) without the
+    sentinels. Reading both at the same time means exiftool can never block on a full stderr pipe while we wait for
+    stdout. The output is collected in growable buffers, and every pass only searches the newly read bytes for the
+    sentinel, so this is linear in the size of the output. deadline is a time.monotonic() value. """
+    buffers = {stdout_fd: bytearray(), stderr_fd: bytearray()}
+    sentinels = {stdout_fd: stdout_sentinel, stderr_fd: stderr_sentinel}
+    # where the sentinel ends, once we found it
+    ends = {}
+    while len(ends) < len(buffers):
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            raise ExifToolTimeoutError("exiftool did not answer in time")
+        readable, _, _ = select.select([fd for fd in buffers if fd not in ends], [], [], timeout)
+        for fd in readable:
+            buffer = buffers[fd]
+            sentinel = sentinels[fd]
+            blk = os.read(fd, 256 * 1024)
+            if not blk:
+                raise ExifToolError("exiftool closed its output unexpectedly")
+            # the sentinel can be split over two reads
+            search_from = max(0, len(buffer) - len(sentinel) + 1)
+            buffer += blk
+            pos = buffer.find(sentinel, search_from)
+            if pos >= 0:
+                ends[fd] = pos
+    return bytes(buffers[stdout_fd][:ends[stdout_fd]]), bytes(buffers[stderr_fd][:ends[stderr_fd]])
+
+
+class ExifTool(object):
+    """ One exiftool process in -stay_open mode. Every command gets a number, which exiftool echoes in the sentinels
+    it writes to stdout (-executeNUM) and stderr (-echo4), so we know exactly which output belongs to which command.
+    A command that does not finish before its timeout kills the process, the next command starts a new one. """
 
-    def __init__(self, working_dir, executable="/usr/local/bin/exiftool"):
+    def __init__(self, working_dir=None, executable="/usr/local/bin/exiftool", timeout=None):
         self.logger = logging.getLogger(__name__)
         self.executable = executable
         self.working_dir = working_dir
+        self.timeout = timeout
+        self.process = None
+        self.commands_executed = 0
+        # commands were sent of which we did not read the whole answer: the process is out of step with us
+        self.busy = False
+        # for metrics: everything exiftool wrote to us (stdout and stderr), over all processes
+        self.bytes_read = 0
+        self.command_number = 0
 
     def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.terminate()
+
+    def start(self):
         self.process = subprocess.Popen(
             [self.executable, "-stay_open", "True", "-@", "-"],
-            universal_newlines=True,
             cwd=self.working_dir,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
-        return self
+        self.commands_executed = 0
+        self.busy = False
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.process.stdin.write("-stay_open\nFalse\n")
-        self.process.stdin.flush()
+    def terminate(self):
+        if not self.running:
+            return
+        try:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
 
-    def execute(self, *args):
-        args = args + ("-execute\n",)
-        self.logger.debug(args)
-        self.process.stdin.write(str.join("\n", args))
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, *args, timeout=None):
+        """ Returns the output of the command. Anything exiftool wrote to stderr is logged as a warning. """
+        output, errors = self.execute_with_errors(*args, timeout=timeout)
+        if errors:
+            self.logger.warning("exiftool %s: %s", args[:-1] if len(args) > 1 else args, errors.strip())
+        return output
+
+    def execute_with_errors(self, *args, timeout=None):
+        """ Returns (stdout, stderr) of the command. """
+        return self.execute_many([args], timeout=timeout)[0]
+
+    def execute_many(self, commands, timeout=None):
+        """ Sends all commands (each a tuple of arguments) at once, and returns (stdout, stderr) of every one of them.
+        This saves a round-trip per command, but nothing is read before all of them are sent, so it is meant for
+        commands with little output, like writes: exiftool stops once the pipes are full. The timeout is per
+        command. """
+        if not self.running:
+            self.start()
+        sentinels = []
+        lines = []
+        for args in commands:
+            self.command_number = self.command_number + 1
+            ready = f"{{ready{self.command_number}}}"
+            lines.extend(args + ("-echo4", ready, f"-execute{self.command_number}"))
+            sentinels.append(f"{ready}\n".encode("utf-8"))
+        self.logger.debug(lines)
+        self.busy = True
+        self.process.stdin.write((str.join("\n", lines) + "\n").encode("utf-8"))
         self.process.stdin.flush()
-        output = b""
-        fd = self.process.stdout.fileno()
-        while not output.endswith(self.sentinel):
-            blk = os.read(fd, 4096)
-            self.logger.debug(blk)
-            output += blk
-        return output[: -len(self.sentinel)].decode("utf-8")
+        self.commands_executed = self.commands_executed + len(commands)
+
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = time.monotonic() + timeout * len(commands) if timeout is not None else None
+        try:
+            # the last sentinels come after all output
+            output, errors = read_response(self.process.stdout.fileno(), self.process.stderr.fileno(), sentinels[-1], sentinels[-1], deadline)
+        except ExifToolTimeoutError:
+            self.logger.error("exiftool did not finish %s within %ss, killing it", commands[0] if len(commands) == 1 else commands, timeout)
+            self.kill()
+            raise
+        except ExifToolError:
+            raise ExifToolError(f"exiftool exited unexpectedly (exit code {self.process.poll()})")
+        self.busy = False
+        self.bytes_read = self.bytes_read + len(output) + len(errors) + sum(2 * len(sentinel) for sentinel in sentinels)
+        outputs = self._split(output + sentinels[-1], sentinels)
+        errors = self._split(errors + sentinels[-1], sentinels)
+        return [(out.decode("utf-8"), err.decode("utf-8", errors="replace")) for out, err in zip(outputs, errors)]
+
+    def _split(self, output: bytes, sentinels):
+        """ The output of every command, from the output of all of them """
+        parts = []
+        start = 0
+        for sentinel in sentinels:
+            end = output.index(sentinel, start)
+            parts.append(output[start:end])
+            start = end + len(sentinel)
+        return parts
 
     def get_metadata(self, *filenames):
-        return json.loads(self.execute("-use", "MWG", "-G1", "-j", "-n", *filenames))
+        """ The JSON records of the files. exiftool leaves out the files it cannot read, and writes nothing at all when
+        that is all of them (e.g. they were removed meanwhile). """
+        output = self.execute("-use", "MWG", "-G1", "-j", "-n", *filenames)
+        try:
+            return json.loads(output) if output.strip() else []
+        except ValueError as err:
+            raise ExifToolError(f"exiftool returned invalid JSON: {err}")
+
+
+class ExifToolPool(object):
+    """ A pool of long-running exiftool processes, so we don't pay the startup cost of exiftool on every call. Processes
+    are leased out to one thread at a time, and replaced when they died or executed max_commands commands. Since the
+    processes are shared, they have no working directory: always pass absolute paths. """
+
+    def __init__(self, size=4, max_commands=1000, executable="/usr/local/bin/exiftool", timeout=None):
+        self.logger = logging.getLogger(__name__)
+        self.size = size
+        self.max_commands = max_commands
+        self.executable = executable
+        self.timeout = timeout
+        # for metrics: everything the processes of this pool wrote to us
+        self.bytes_read = 0
+        self.idle = []
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def lease(self):
+        self.available.acquire()
+        et = None
+        leased = None
+        try:
+            et = leased = self._take()
+            bytes_read_before = et.bytes_read
+            yield et
+        except BaseException:
+            # a process that failed in the middle of a command (e.g. half of the output is unread) can't be used again,
+            # one that failed on a complete answer can
+            if et is not None and (et.busy or not et.running):
+                et.terminate()
+                et = None
+            raise
+        finally:
+            with self.lock:
+                if leased is not None:
+                    self.bytes_read = self.bytes_read + leased.bytes_read - bytes_read_before
+                if et is not None:
+                    self.idle.append(et)
+            self.available.release()
+
+    def _take(self):
+        with self.lock:
+            et = self.idle.pop() if self.idle else None
+        if et is not None and not self._healthy(et):
+            et.terminate()
+            et = None
+        if et is None:
+            self.logger.info("Starting new exiftool process")
+            et = ExifTool(executable=self.executable, timeout=self.timeout)
+            et.start()
+        return et
+
+    def _healthy(self, et):
+        return et.running and not et.busy and et.commands_executed < self.max_commands
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for et in idle:
+            et.terminate()
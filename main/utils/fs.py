@@ -6,4 +6,8 @@ def rename_safely(src, dst):
     if os.path.exists(dst):
         raise IOError(f'File already exists: {dst}')
     else:
-        os.rename(src, dst)
\ No newline at end of file
+        os.rename(src, dst)
+
+def file_fingerprint(stat_result):
+    """ Returns (size, mtime in ns, inode) of a stat result. If any of those changes, the file was modified. """
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
@@ -0,0 +1,87 @@
+from typing import Iterator, List, Tuple
+
+# requests with more ranges than this get the whole file: answering them costs more than it saves
+MAX_RANGES = 32
+# how much is read from the file at once when we copy it ourselves
+CHUNK_SIZE = 1024 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> List[Tuple[int, int]]:
+    """ The byte ranges of a Range header for a file of size bytes, as (start, end) with end included. Ranges that
+    start after the end of the file are left out, and RangeNotSatisfiable is raised when that leaves nothing. Returns
+    None when the header should be ignored: not in bytes, malformed, or too many ranges. """
+    unit, _, ranges_spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = [spec.strip() for spec in ranges_spec.split(",") if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.partition("-")
+        if not dash or not (first or last) or not (first or "0").isdigit() or not (last or "0").isdigit():
+            return None
+        if not first:
+            # the last bytes of the file
+            suffix = int(last)
+            if suffix > 0 and size > 0:
+                ranges.append((max(0, size - suffix), size - 1))
+            continue
+        start, end = int(first), int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    return ranges
+
+
+class FileRange(object):
+    """ length bytes of the open file f, from start. It has the fileno of f, so a server that sends files with
+    sendfile (like gunicorn) can still do that: it sends from the position of the file, as many bytes as the
+    Content-Length says. Others read it. """
+    def __init__(self, f, start: int, length: int):
+        self.f = f
+        self.remaining = length
+        f.seek(start)
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining = self.remaining - len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+def multipart_byteranges(path: str, ranges: List[Tuple[int, int]], size: int, content_type: str, boundary: str) -> Tuple[Iterator[bytes], int]:
+    """ The body of a multipart/byteranges response with these ranges of the file at path, and its length """
+    headers = [f"--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n".encode() for start, end in ranges]
+    closing = f"--{boundary}--\r\n".encode()
+    length = sum(len(header) + end + 1 - start + 2 for header, (start, end) in zip(headers, ranges)) + len(closing)
+
+    def body():
+        with open(path, "rb") as f:
+            for header, (start, end) in zip(headers, ranges):
+                yield header
+                f.seek(start)
+                remaining = end + 1 - start
+                while remaining > 0:
+                    data = f.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        return
+                    remaining = remaining - len(data)
+                    yield data
+                yield b"\r\n"
+        yield closing
+    return body(), length
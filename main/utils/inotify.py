@@ -0,0 +1,66 @@
+import ctypes, ctypes.util
+import os, select, struct
+
+from collections import namedtuple
+from typing import List
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+InotifyEvent = namedtuple('InotifyEvent', ['wd', 'mask', 'cookie', 'name'])
+
+_event_header = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """ Minimal wrapper around the Linux inotify API, so we don't need an extra dependency for it. """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            self._raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        # fails if the watch was already removed by the kernel (e.g. the directory was deleted), that's fine
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float = None) -> List[InotifyEvent]:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset = offset + _event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset = offset + length
+            events.append(InotifyEvent(wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+    def _raise_errno(self, path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
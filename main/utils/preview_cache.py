@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+
+
+class PreviewCache(object):
+    """ Rendered previews as files in root, at most max_bytes of them: when there is no room for a new one, the least
+    recently used ones are removed. Files are named after a hash of their key, and their modification time is set when
+    they are used, so the order survives a restart: the index is built from the files on first use. Another process
+    can share root, it then only evicts the files it knows of.
+
+    Files are handed out open, not by path: one could be evicted between looking it up and opening it, while a file
+    that is open can still be read after that. """
+    def __init__(self, root: str, max_bytes: int):
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # file name -> size, least recently used first
+        self.index: OrderedDict = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, key: str):
+        """ The file for key, opened for reading, or None when it is not cached. The caller closes it. """
+        name = self._name(key)
+        path = self._path(name)
+        with self.lock:
+            self._load()
+            if name not in self.index:
+                self.misses = self.misses + 1
+                return None
+            try:
+                f = open(path, "rb")
+                os.utime(f.fileno())
+            except FileNotFoundError:
+                # evicted by another process
+                self.size = self.size - self.index.pop(name)
+                self.misses = self.misses + 1
+                return None
+            self.index.move_to_end(name)
+            self.hits = self.hits + 1
+            return f
+
+    def contains(self, key: str) -> bool:
+        with self.lock:
+            self._load()
+            return self._name(key) in self.index
+
+    def put(self, key: str, data: bytes):
+        """ Stores data for key """
+        name = self._name(key)
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        # readers never see half a file
+        os.replace(tmp_path, path)
+        with self.lock:
+            self._load()
+            self.size = self.size - self.index.pop(name, 0) + len(data)
+            self.index[name] = len(data)
+            self._evict()
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._load()
+            return {'files': len(self.index), 'bytes': self.size, 'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.index) > 1:
+            name, size = self.index.popitem(last=False)
+            self.size = self.size - size
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def _load(self):
+        if self.index is not None:
+            return
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    # being written
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, filename, stat.st_size))
+        self.index = OrderedDict((filename, size) for mtime, filename, size in sorted(entries))
+        self.size = sum(self.index.values())
+        self.logger.info("Preview cache %s has %d files, %d bytes", self.root, len(self.index), self.size)
+        self._evict()
+
+    def _name(self, key: str) -> str:
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name[:2], name)
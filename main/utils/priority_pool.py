@@ -0,0 +1,172 @@
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class PriorityProcessPool(object):
+    """ Runs fn in worker processes, so CPU-bound work does not compete with the web threads for the GIL. Jobs wait in
+    a queue of our own instead of the executor's, so we can pick what runs next: the jobs of the focused group go
+    first, the rest in the order they were submitted. Only a few jobs per worker are handed to the executor at a time.
+
+    The queue is bounded for background jobs: submit() blocks while max_backlog jobs are waiting, which makes a
+    producer like a scan go at the pace of the workers. Jobs of the focused group are always accepted. on_done is
+    called with the context of the job and the result, or with the exception, one job at a time on a thread of the
+    pool: not on the thread of the executor that collects the results, which would wait for what on_done does (saving
+    files, DB updates) before it hands out the next job. The context stays in this process, only args are sent to the
+    workers. """
+    URGENT = 0
+    BACKGROUND = 1
+
+    # the window over which the throughput is measured, in seconds
+    THROUGHPUT_WINDOW = 60
+
+    def __init__(self, fn, on_done, workers=None, max_backlog=200):
+        self.logger = logging.getLogger(__name__)
+        self.fn = fn
+        self.on_done = on_done
+        self.workers = workers or os.cpu_count() or 1
+        self.max_backlog = max_backlog
+        self.executor = None
+        self.focus = None
+        self.queue = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.dispatcher = None
+        # (context, result, exception) of the jobs that are done, for on_done
+        self.completions = queue.Queue()
+        self.completer = None
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.finished_at = deque()
+
+    def submit(self, args: tuple, context=None, group=None, block=True, urgent=False) -> bool:
+        """ Returns False when the queue is full and block is False. An urgent job goes first, like the ones of the
+        focused group. """
+        with self.cond:
+            priority = self.URGENT if urgent or (group is not None and group == self.focus) else self.BACKGROUND
+            while priority == self.BACKGROUND and len(self.queue) >= self.max_backlog:
+                if not block:
+                    return False
+                self.cond.wait()
+            heapq.heappush(self.queue, (priority, next(self.seq), group, args, context))
+            self.submitted = self.submitted + 1
+            self._ensure_dispatching()
+            self.cond.notify_all()
+        return True
+
+    def prioritize(self, group):
+        """ Moves the queued jobs of group ahead of the others, and makes that group go first from now on. """
+        with self.cond:
+            self.focus = group
+            self.queue = [(self.URGENT if g == group else priority, seq, g, args, context) for priority, seq, g, args, context in self.queue]
+            heapq.heapify(self.queue)
+
+    def is_focused(self, group) -> bool:
+        with self.cond:
+            return group is not None and group == self.focus
+
+    def stats(self) -> dict:
+        with self.cond:
+            now = time.monotonic()
+            self._forget_finished_before(now - self.THROUGHPUT_WINDOW)
+            elapsed = now - self.finished_at[0] if len(self.finished_at) > 1 else 0
+            return {
+                'workers': self.workers,
+                'queued': len(self.queue),
+                'queued_urgent': sum(1 for priority, *_ in self.queue if priority == self.URGENT),
+                'max_backlog': self.max_backlog,
+                'in_flight': self.in_flight,
+                'completing': self.completions.qsize(),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'per_second': round(len(self.finished_at) / elapsed, 2) if elapsed else 0.0,
+            }
+
+    def shutdown(self):
+        with self.cond:
+            self.queue = []
+            self.cond.notify_all()
+            executor = self.executor
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _ensure_dispatching(self):
+        if self.dispatcher is None or not self.dispatcher.is_alive():
+            self.dispatcher = threading.Thread(target=self._dispatch, name="priority-pool-dispatcher", daemon=True)
+            self.dispatcher.start()
+        if self.completer is None or not self.completer.is_alive():
+            self.completer = threading.Thread(target=self._complete, name="priority-pool-completer", daemon=True)
+            self.completer.start()
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                # a few jobs per worker, so the next one is ready when a worker frees up, but the rest stay in our queue
+                while not self.queue or self.in_flight >= self.workers * 2:
+                    self.cond.wait()
+                _, _, _, args, context = heapq.heappop(self.queue)
+                self.in_flight = self.in_flight + 1
+                # room for producers that wait on a full queue
+                self.cond.notify_all()
+            try:
+                future = self._executor().submit(self.fn, *args)
+            except BrokenProcessPool as exc:
+                # a worker died (e.g. a decoder crashed on a bad file): start over with fresh processes
+                self.logger.error("Worker process died, restarting the pool: %s", exc)
+                self.executor = None
+                self._finished(context, None, exc)
+                continue
+            future.add_done_callback(lambda f, context=context: self._future_done(context, f))
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawn: forking a process with running threads (the web server, the exiftool pool) is not safe
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def _future_done(self, context, future):
+        if future.cancelled():
+            # by shutdown()
+            self._finished(context, None, CancelledError())
+        elif future.exception() is not None:
+            self._finished(context, None, future.exception())
+        else:
+            self._finished(context, future.result(), None)
+
+    def _finished(self, context, result, exc):
+        with self.cond:
+            self.in_flight = self.in_flight - 1
+            if exc is None:
+                self.completed = self.completed + 1
+            else:
+                self.failed = self.failed + 1
+                if isinstance(exc, BrokenProcessPool):
+                    self.executor = None
+            self.finished_at.append(time.monotonic())
+            self._forget_finished_before(time.monotonic() - self.THROUGHPUT_WINDOW)
+            self.cond.notify_all()
+        self.completions.put((context, result, exc))
+
+    def _complete(self):
+        while True:
+            context, result, exc = self.completions.get()
+            try:
+                self.on_done(context, result, exc)
+            except Exception as err:
+                self.logger.error(err, exc_info=True)
+
+    def _forget_finished_before(self, moment):
+        while self.finished_at and self.finished_at[0] < moment:
+            self.finished_at.popleft()
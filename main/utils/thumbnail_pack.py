@@ -0,0 +1,135 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from typing import Dict, Tuple
+
+
+class ThumbnailPack(object):
+    """ All thumbnails of one directory in a single file, read through a memory map. Every record is a header with its
+    key and length, followed by the JPEG. The caller keeps the index: append() and compact() return where the data of a
+    record is, as (offset, length), and read() takes that back.
+
+    The file is only appended to, so replacing a thumbnail leaves the old record behind until compact() rewrites the
+    file with the records that are still used. Several processes can use the same pack: appends and compactions lock
+    the file, and since every read checks the header of the record, a reader that still maps the file from before a
+    compaction notices and maps the new one. """
+    HEADER = struct.Struct(">4sQI")
+    MAGIC = b"THMB"
+
+    def __init__(self, path: str):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.mm = None
+
+    def append(self, key: int, data: bytes) -> Tuple[int, int]:
+        record = self.HEADER.pack(self.MAGIC, key, len(data)) + data
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            while True:
+                with open(self.path, "ab") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    if not self._is_current(f):
+                        # replaced by a compaction while we waited for the lock
+                        continue
+                    start = f.seek(0, os.SEEK_END)
+                    f.write(record)
+                    f.flush()
+                    return start + self.HEADER.size, len(data)
+
+    def read(self, key: int, offset: int, length: int) -> bytes:
+        """ The data of the record, or None when it is not (or no longer) there """
+        with self.lock:
+            mm = self._mapped_record(key, offset, length)
+            return mm[offset:offset + length] if mm is not None else None
+
+    def contains(self, key: int, offset: int, length: int) -> bool:
+        with self.lock:
+            return self._mapped_record(key, offset, length) is not None
+
+    def compact(self, live: Dict[int, Tuple[int, int]]) -> Dict[int, Tuple[int, int]]:
+        """ Rewrites the pack with only the records in live, {key: (offset, length)}. Returns where they are now; a
+        record that could not be found is left out. """
+        moved = {}
+        if not self.size():
+            return moved
+        tmp_path = self.path + ".tmp"
+        with self.lock:
+            with open(self.path, "rb") as f:
+                # blocks appends while we copy
+                fcntl.flock(f, fcntl.LOCK_EX)
+                size = os.fstat(f.fileno()).st_size
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, open(tmp_path, "wb") as out:
+                    for key, (offset, length) in sorted(live.items(), key=lambda item: item[1][0]):
+                        if not self._is_record(mm, key, offset, length):
+                            continue
+                        start = out.tell()
+                        out.write(mm[offset - self.HEADER.size:offset + length])
+                        moved[key] = (start + self.HEADER.size, length)
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.replace(tmp_path, self.path)
+            self._unmap()
+        self.logger.info("Compacted %s from %d to %d bytes", self.path, size, self.used_bytes(moved))
+        return moved
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def used_bytes(self, live: Dict[int, Tuple[int, int]]) -> int:
+        return sum(self.HEADER.size + length for offset, length in live.values())
+
+    def delete(self):
+        with self.lock:
+            self._unmap()
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _is_current(self, f) -> bool:
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _is_record(self, mm, key: int, offset: int, length: int) -> bool:
+        start = offset - self.HEADER.size
+        if start < 0 or offset + length > len(mm):
+            return False
+        return self.HEADER.unpack_from(mm, start) == (self.MAGIC, key, length)
+
+    def _mapped_record(self, key: int, offset: int, length: int):
+        """ The memory map, if the record is there """
+        for attempt in range(2):
+            mm = self._map(offset + length)
+            if mm is not None and self._is_record(mm, key, offset, length):
+                return mm
+            # the file might have been compacted by another process: map it again
+            self._unmap()
+        return None
+
+    def _map(self, end: int):
+        """ The memory map of the file, mapped again when it has grown since """
+        if self.mm is None or len(self.mm) < end:
+            self._unmap()
+            try:
+                with open(self.path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return None
+                    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                return None
+        return self.mm
+
+    def _unmap(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
@@ -1,9 +1,16 @@
-from django.http import HttpResponse, FileResponse
-from django.views.generic import DetailView
-from PIL import Image as PIL_Image, ImageOps as PIL_ImageOps
-import os, ffmpeg
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, FileResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_response_headers, patch_vary_headers
+from django.utils.http import http_date
+from django.views.generic import DetailView, View
+import os, hashlib, json, secrets, struct
 
+from main.model.preview import MIME_TYPES
+from main.model.thumbnail import thumbnail_file_name
 from main.models import Image
+from main.services import PreviewService, ThumbnailService
+from main.utils.fs import file_fingerprint
+from main.utils.http_range import CHUNK_SIZE, FileRange, RangeNotSatisfiable, multipart_byteranges, parse_range
 
 
 class ImageDownloadView(DetailView):
@@ -13,54 +20,132 @@ class ImageDownloadView(DetailView):
         image = self.get_object()
         src = os.path.join(image.parent.get_absolute_path(), image.name)
 
-        if image.is_image:    
-            pil_image = PIL_Image.open(src)
-            pil_image = PIL_ImageOps.exif_transpose(pil_image)
+        if image.is_image and "maxw" in request.GET and "maxh" in request.GET:
+            max_width = int(request.GET.get("maxw", "250"))
+            max_height = int(request.GET.get("maxh", "250"))
+            # of the file as it is now, not as of the last scan: it may have been edited since
+            fingerprint = file_fingerprint(os.stat(src))
+            format = PreviewService.instance().negotiate(request.META.get("HTTP_ACCEPT"))
+            etag = '"%s"' % PreviewService.instance().key(fingerprint, max_width, max_height, format)
+            last_modified = fingerprint[1] // 1_000_000_000
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = FileResponse(PreviewService.instance().preview(src, fingerprint, max_width, max_height, format), content_type=MIME_TYPES[format])
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            # the browser may keep it, but checks with us whether the file changed
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ["Accept"])
+            return response
+        else:
+            # the original, as it is: browsers turn images upright themselves. Videos are sent as mp4 also when they
+            # are mov, since more browsers play that.
+            return file_response(request, src, image.mime_type if image.is_image else "video/mp4")
 
-            if "maxw" in request.GET and "maxh" in request.GET:
-                max_width = int(request.GET.get("maxw", "250"))
-                max_height = int(request.GET.get("maxh", "250"))
 
-                width_percent = (max_width / float(pil_image.size[0]))
-                height_percent = (max_height / float(pil_image.size[1]))
+def file_response(request, path: str, content_type: str):
+    """ The file at path, or the parts in the Range header of the request. One part is sent with FileResponse, so the
+    server can use sendfile; several as multipart/byteranges. """
+    f = open(path, "rb")
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    etag = '"%s"' % "-".join(str(part) for part in file_fingerprint(stat))
+    last_modified = stat.st_mtime_ns // 1_000_000_000
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    ranges = None
+    if response is None and "HTTP_RANGE" in request.META and request.META.get("HTTP_IF_RANGE", etag) in (etag, http_date(last_modified)):
+        try:
+            ranges = parse_range(request.META["HTTP_RANGE"], size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f"bytes */{size}"
 
-                percent = min(width_percent, height_percent)
+    if response is not None:
+        f.close()
+    elif not ranges:
+        response = FileResponse(f, content_type=content_type)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = FileResponse(FileRange(f, start, end + 1 - start), content_type=content_type, status=206)
+        response['Content-Length'] = end + 1 - start
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    else:
+        f.close()
+        boundary = secrets.token_hex(16)
+        body, length = multipart_byteranges(path, ranges, size, content_type, boundary)
+        response = StreamingHttpResponse(body, content_type=f"multipart/byteranges; boundary={boundary}", status=206)
+        response['Content-Length'] = length
+    if isinstance(response, FileResponse):
+        # for servers that copy the file themselves, in bigger blocks than the default
+        response.block_size = CHUNK_SIZE
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
 
-                target_width = int((float(pil_image.size[0]) * float(percent)))
-                target_height = int((float(pil_image.size[1]) * float(percent)))
-                print("Resizing image %s to (%d, %d)" % (image.name, target_width, target_height))
-                pil_image = pil_image.resize((target_width, target_height), PIL_Image.ANTIALIAS)
 
-            response = HttpResponse(content_type="image/jpeg")
-            pil_image.save(response, "JPEG")
-            return response
-        else:
-            http_range = request.META.get('HTTP_RANGE')
-            if http_range:
-                with open(src, "rb") as f:
-                    stat = os.fstat(f.fileno())
-                    file_length = stat.st_size
-                    start, end = http_range.split('=')[1].split('-')
-                    if not start:
-                        # handle the -x case, which wants to get the x last bytes
-                        start = max(0, file_length - int(end))
-                        end = ''
-                    start, end = int(start), int(end or file_length - 1)
-                    start = max(0, start)
-                    end = min(end, file_length - 1, start + 5000000)
-                    f.seek(start)
-                    response = HttpResponse(content_type="video/mp4")
-                    response.status_code = 206
-                    response['Accept-Ranges'] = 'bytes'
-                    response['Content-Length'] = end + 1 - start
-                    response['Content-Range'] = f"bytes {start}-{end}/{file_length}"
-                    c = start
-                    while c < end:
-                        buf = f.read(min(1024, end - c + 1))
-                        c += len(buf)
-                        response.write(buf)
-                    return response
+class ImageThumbnailView(DetailView):
+    """ The thumbnail of an image. One that is not made yet is made first, and while it takes longer than
+    THUMBNAIL_WAIT_SECONDS, a placeholder is returned. When the URL has the key of the thumbnail, the browser may keep
+    it forever: another thumbnail has another key. """
+    model = Image
+
+    # a year, the longest that is allowed
+    IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+    def get(self, request, *args, **kwargs):
+        image = self.get_object()
+        if image.ensure_thumbnail(getattr(settings, 'THUMBNAIL_WAIT_SECONDS', 5)):
+            format = ThumbnailService.instance().negotiate(image, request.META.get("HTTP_ACCEPT"))
+            if format != 'JPEG':
+                response = FileResponse(image.thumbnail.storage.open(thumbnail_file_name(image.thumbnail_key, format), "rb"), content_type=MIME_TYPES[format])
+            elif image.thumbnail_offset is None:
+                response = FileResponse(image.thumbnail.open("rb"), content_type="image/jpeg")
             else:
-                response = FileResponse(open(src, "rb"), content_type="video/mp4")
-                response['Accept-Ranges'] = 'bytes'
+                data = image.read_thumbnail()
+                response = HttpResponse(data, content_type="image/jpeg") if data is not None else None
+            if response is not None:
+                if kwargs.get("key") is not None and kwargs["key"] == image.thumbnail_key:
+                    patch_response_headers(response, self.IMMUTABLE_MAX_AGE)
+                    patch_cache_control(response, public=True, immutable=True)
+                patch_vary_headers(response, ["Accept"])
                 return response
+
+        response = HttpResponse(ThumbnailService.instance().placeholder, content_type="image/jpeg")
+        # so the browser asks again next time
+        response['Cache-Control'] = 'no-store'
+        return response
+
+
+class ThumbnailBatchView(View):
+    """ Many thumbnails in one response, for the images in the ids parameter (comma separated). Only the thumbnails that
+    are ready are included, the others can be requested one by one. The response starts with the length of a JSON
+    index as a 4 byte big-endian number, followed by that index, a list of {id, offset, length}, and then the JPEGs.
+    The offsets are relative to the end of the index. The ETag is made of the keys of the thumbnails, so as long as
+    none of them changed, the browser gets a 304 and uses the response it has. """
+    def get(self, request, *args, **kwargs):
+        try:
+            ids = [int(i) for i in request.GET.get("ids", "").split(",") if i]
+        except ValueError:
+            return HttpResponseBadRequest("ids must be a comma separated list of image ids")
+        images = list(Image.objects.filter(id__in=ids, thumbnail_state='ready').order_by('parent_id', 'thumbnail_offset'))
+        etag = '"%s"' % hashlib.blake2b(" ".join(f"{image.id}:{image.thumbnail_key or image.thumbnail}:{image.thumbnail_offset}" for image in images).encode(), digest_size=16).hexdigest()
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        index = []
+        chunks = []
+        offset = 0
+        for image in images:
+            data = image.read_thumbnail()
+            if data is None:
+                continue
+            index.append({'id': image.id, 'offset': offset, 'length': len(data)})
+            chunks.append(data)
+            offset = offset + len(data)
+        index_json = json.dumps(index).encode()
+        response = HttpResponse(b"".join([struct.pack(">I", len(index_json)), index_json, *chunks]), content_type="application/octet-stream")
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
@@ -174,9 +174,77 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
-    },
-    'tags': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'tags-location',
     }
-}
\ No newline at end of file
+}
+
+# Photo workflow
+
+# number of directories that are read (listing + exiftool) in parallel during a scan
+SCAN_WORKERS = 4
+
+# exiftool processes are kept running and shared between requests
+EXIFTOOL_EXECUTABLE = '/usr/local/bin/exiftool'
+EXIFTOOL_POOL_SIZE = 4
+# an exiftool process is restarted after this many commands
+EXIFTOOL_MAX_COMMANDS = 1000
+# number of files of which the metadata is read in one exiftool command
+EXIFTOOL_CHUNK_SIZE = 200
+# seconds an exiftool command may take, after that the process is killed and replaced
+EXIFTOOL_TIMEOUT = 300
+
+# the directory watcher waits until no events came in for this many seconds before it scans a directory
+WATCHER_DEBOUNCE_SECONDS = 2
+
+# read the EXIF and XMP of JPEGs ourselves when scanning, instead of through exiftool. Falls back to exiftool for files
+# it can't decode. Check with `manage.py benchmark_metadata_reader <dir>` that it gives the same results for your files.
+NATIVE_JPEG_READER = False
+
+# where metadata is written to, per file extension: 'in_file' (the default), 'sidecar' (an XMP file next to it, e.g.
+# IMG_1.MOV.xmp) or 'both'. Sidecars are read back when scanning.
+METADATA_WRITE_STRATEGIES = {
+    '.mov': 'sidecar',
+    '.mp4': 'sidecar',
+}
+
+# write the metadata of edited images to their files in the background, once they were not edited for
+# METADATA_WRITE_BACK_DELAY seconds. Without it, metadata is only written by the write_metadata directory action.
+METADATA_WRITE_BACK = False
+METADATA_WRITE_BACK_DELAY = 10
+
+# the thumbnails are made by this many processes, None for one per CPU core. A scan waits when THUMBNAIL_BACKLOG
+# thumbnails are queued; the directory being viewed always goes first.
+THUMBNAIL_WORKERS = None
+THUMBNAIL_BACKLOG = 200
+
+# how image thumbnails are made: 'quality' decodes the full image, 'fast' lets the JPEG decoder scale down while
+# decoding, 'fastest' also uses the preview embedded by the camera when it is big enough. Compare them on your files
+# with `manage.py benchmark_thumbnails <dir>`.
+THUMBNAIL_MODE = 'fast'
+
+# a thumbnail that is not made yet is made when it is requested; the request waits this long for it before it gets a
+# placeholder. A thumbnail that failed is retried after THUMBNAIL_RETRY_DELAY seconds.
+THUMBNAIL_WAIT_SECONDS = 5
+THUMBNAIL_RETRY_DELAY = 3600
+
+# keep the thumbnails of a directory in one pack file (media/thumbnails/<dir id>.pack) instead of a file each. A pack is
+# rewritten without unused thumbnails once they take more than THUMBNAIL_PACK_COMPACT_RATIO of it.
+THUMBNAIL_PACKS = False
+THUMBNAIL_PACK_COMPACT_RATIO = 0.5
+
+# how much disk space the previews of the image viewer (media/previews) may take, the least recently used are removed
+PREVIEW_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+# the previews that are made together with the thumbnails of the directory being viewed, by the length of their long
+# edge; for other images when the viewer asks for them. The viewer gets a preview scaled down from the smallest one
+# that is big enough. Empty to only make previews of the size that is asked for.
+PREVIEW_LEVELS = [1280, 2560]
+
+# the formats that thumbnails and previews are made in besides JPEG, for the browsers that accept them. The ones this
+# Pillow can't write are skipped (AVIF needs Pillow 11.2, or the pillow-avif-plugin package).
+IMAGE_FORMATS = ['AVIF', 'WEBP']
+# encoder quality per format, as (long edge, quality): the first step with a long edge at least that of the image is
+# used, the last one for anything bigger. Small images need a higher quality to look sharp.
+IMAGE_QUALITY = {
+    'JPEG': [(300, 80), (2560, 75)],
+    'WEBP': [(300, 80), (2560, 75)],
+    'AVIF': [(300, 60), (2560, 50)],
+}